@@ -1,15 +1,24 @@
-from flask import Flask, render_template, request, jsonify, send_file, make_response
+from flask import Flask, render_template, request, jsonify, send_file
 import os
+import sys
+import copy
 import json
+import re
 import tempfile
-from music21 import converter, stream, environment, chord, note, roman, meter, interval, analysis, key, clef
-from collections import Counter
+from music21 import converter, stream, chord, pitch, roman, meter, interval, analysis, key, clef, instrument, freezeThaw, VERSION_STR
+from music21.midi.percussion import PercussionMapper
+from music21.musicxml.m21ToXml import GeneralObjectExporter
+from collections import Counter, OrderedDict
 import xml.etree.ElementTree as ET
 import datetime
+from fractions import Fraction
+import numpy as np
+import hashlib
 import io
 from openai import OpenAI
 import time
-from threading import Lock
+from threading import Event, Lock, Thread
+from concurrent.futures import Future, ThreadPoolExecutor
 
 app = Flask(__name__)
 
@@ -20,55 +29,2744 @@ AI_MODELS_CONFIG_FILE = 'config/ai_models.json'
 # ========================================
 # SCORE CACHE SYSTEM
 # ========================================
-# Cache global de scores para evitar re-parsing
-score_cache = {}
+# Cache global de scores para evitar re-parsing.
+# As entradas são indexadas pelo SHA-256 do conteúdo do ficheiro (e não pelo
+# caminho temporário), para que o mesmo score carregado duas vezes partilhe
+# a mesma entrada.
+# Cada entrada guarda o Score completo e a sua NoteTable (forma compacta só
+# com notas); quando o orçamento de memória é ultrapassado, as entradas menos
+# usadas perdem primeiro o Score (ficando só a NoteTable) e depois são
+# removidas por completo.
+score_cache = OrderedDict()  # score_key -> entry (ordem LRU)
 score_cache_lock = Lock()
 CACHE_EXPIRY = 3600  # 1 hora
+CACHE_MAX_BYTES = int(os.environ.get('MIAL_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+SCORE_ELEMENT_BYTES = 3072  # Estimativa de memória por elemento music21
+FACTS_MAX_SUBSETS = 8  # Factos por conjunto de partes guardados por score (por tipo)
+
+# score_key -> Future dos parses em curso (um por score)
+score_cache_inflight = {}
+
+# file_path -> ((mtime_ns, size), sha256) para não voltar a ler o ficheiro
+file_hash_cache = {}
+
+# Cache persistente em disco (sobrevive a reinícios): Score serializado
+# (pickle do music21) e NoteTable (.npz), indexados pelo hash do
+# conteúdo e pela versão do music21.
+DISK_CACHE_DIR = os.environ.get('MIAL_DISK_CACHE_DIR', 'score_cache')
+DISK_CACHE_MAX_BYTES = int(os.environ.get('MIAL_DISK_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+DISK_CACHE_PREWARM = int(os.environ.get('MIAL_DISK_CACHE_PREWARM', 3))
+DISK_CACHE_TEMP_SUFFIX = '.tmp'
+DISK_CACHE_TEMP_MAX_AGE = 15 * 60  # Temporários mais antigos são de escritas falhadas
+disk_cache_lock = Lock()
+
+score_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'disk_hits': 0,
+    'demotions': 0,
+    'evictions': 0,
+    'expirations': 0
+}
+
+def get_file_hash(file_path):
+    """
+    Calcula (ou obtém da memória) o SHA-256 do conteúdo de um ficheiro.
+
+    Args:
+        file_path: Caminho para ficheiro MusicXML
+
+    Returns:
+        str: Digest hexadecimal do conteúdo
+    """
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    cached = file_hash_cache.get(file_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    file_hash_cache[file_path] = (signature, digest)
+    return digest
+
+def estimate_entry_size(entry):
+    """Estimativa (bytes) da memória ocupada por uma entrada do cache."""
+    size = 0
+    if entry.get('score') is not None:
+        size += entry['score_elements'] * SCORE_ELEMENT_BYTES
+    for table_name in ('notes', 'expanded_notes'):
+        if entry.get(table_name) is not None:
+            size += entry[table_name].nbytes
+    if entry.get('facts') is not None:
+        size += entry['facts'].nbytes
+    return size
+
+def estimate_payload_size(value):
+    """Estimativa (bytes) de um resultado guardado (dicts/listas de valores simples)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_payload_size(k) + estimate_payload_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_payload_size(v) for v in value)
+    return size
+
+def refresh_cache_entry_size(score_key):
+    """
+    Recalcula o tamanho de uma entrada depois de lhe serem juntados dados
+    (factos calculados, caches da NoteTable) e volta a aplicar o orçamento.
+    """
+    if score_key is None:
+        return
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is None:
+            return
+        entry['size'] = estimate_entry_size(entry)
+        enforce_cache_budget(protected_key=score_key)
+
+def enforce_cache_budget(protected_key=None):
+    """
+    Garante que o cache fica dentro de CACHE_MAX_BYTES.
+    Deve ser chamada com score_cache_lock adquirido.
+
+    Primeiro reduz as entradas menos recentes à NoteTable; se não for
+    suficiente, remove-as. A entrada protected_key (a acabada de usar)
+    nunca é tocada.
+    """
+    total = sum(entry['size'] for entry in score_cache.values())
+
+    for score_key, entry in score_cache.items():
+        if total <= CACHE_MAX_BYTES:
+            return
+        if score_key == protected_key or entry['score'] is None:
+            continue
+        entry['score'] = None
+        new_size = estimate_entry_size(entry)
+        total -= entry['size'] - new_size
+        entry['size'] = new_size
+        score_cache_stats['demotions'] += 1
+        print(f"[CACHE DEMOTE] Dropped full score {score_key[:12]}, keeping note table")
+
+    for score_key in list(score_cache.keys()):
+        if total <= CACHE_MAX_BYTES:
+            return
+        if score_key == protected_key:
+            continue
+        total -= score_cache.pop(score_key)['size']
+        score_cache_stats['evictions'] += 1
+        print(f"[CACHE EVICT] Evicted {score_key[:12]}")
+
+def make_cache_entry(score_key, score, notes=None):
+    """Cria uma entrada do cache para um score (e a sua NoteTable)."""
+    if notes is None:
+        notes = NoteTable.from_score(score)
+    notes.score_key = score_key
+    entry = {
+        'score': score,
+        'score_elements': sum(1 for _ in score.recurse()),
+        'notes': notes,
+        'expanded_notes': None,  # NoteTable com repetições expandidas (lazy)
+        'facts': None,  # ScoreFacts (lazy)
+        'timestamp': time.time()
+    }
+    entry['size'] = estimate_entry_size(entry)
+    return entry
+
+def get_disk_cache_paths(score_key):
+    """Caminhos (score, notas) de uma entrada do cache em disco."""
+    # Caminho absoluto: o StreamFreezer resolve caminhos relativos na scratch dir do music21
+    base = os.path.join(os.path.abspath(DISK_CACHE_DIR), f"{score_key}-m21_{VERSION_STR}")
+    return base + '.score.p', base + '.notes.npz'
+
+def load_score_from_disk(score_key):
+    """
+    Carrega um score (e a NoteTable) do cache em disco.
+
+    Returns:
+        tuple: (score, notes) ou None se não existir ou estiver corrompido
+    """
+    score_path, notes_path = get_disk_cache_paths(score_key)
+    if not (os.path.exists(score_path) and os.path.exists(notes_path)):
+        return None
+
+    try:
+        thawer = freezeThaw.StreamThawer()
+        thawer.open(score_path)
+        score = thawer.stream
+
+        with np.load(notes_path, allow_pickle=False) as data:
+            notes = NoteTable.from_arrays(data)
+
+        # Atualizar mtime para a limpeza LRU
+        for path in (score_path, notes_path):
+            os.utime(path)
+        return score, notes
+    except Exception as e:
+        print(f"[DISK CACHE ERROR] Could not load {score_key[:12]}: {e}")
+        for path in (score_path, notes_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return None
+
+def save_score_to_disk(score_key, score, notes):
+    """
+    Guarda um score e a NoteTable no cache em disco.
+
+    Pensada para correr numa thread em background. score tem de ser uma
+    cópia privada (copy.deepcopy feito antes de o score entrar no cache):
+    o freeze altera os sites dos objetos e não volta a copiá-lo.
+    """
+    score_path, notes_path = get_disk_cache_paths(score_key)
+    if os.path.exists(score_path) and os.path.exists(notes_path):
+        return
+
+    temp_paths = []
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+
+        # Escrever para ficheiros temporários e renomear (escrita atómica);
+        # nomes únicos, porque o mesmo score pode ser guardado duas vezes ao
+        # mesmo tempo
+        for path in (score_path, notes_path):
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix=DISK_CACHE_TEMP_SUFFIX,
+                                             dir=os.path.dirname(path))
+            os.close(fd)
+            temp_paths.append(temp_path)
+        score_temp, notes_temp = temp_paths
+
+        freezer = freezeThaw.StreamFreezer(score, fastButUnsafe=True)
+        freezer.write(fmt='pickle', fp=score_temp)
+
+        with open(notes_temp, 'wb') as f:
+            np.savez(f, **notes.to_arrays())
+
+        os.replace(notes_temp, notes_path)
+        os.replace(score_temp, score_path)
+        print(f"[DISK CACHE] Stored {score_key[:12]}")
+    except Exception as e:
+        print(f"[DISK CACHE ERROR] Could not store {score_key[:12]}: {e}")
+        for temp_path in temp_paths:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return
+
+    cleanup_disk_cache()
+
+def get_disk_cache_base(file_name):
+    """Nome base da entrada a que pertence um ficheiro do cache em disco (ou None)."""
+    for suffix in ('.score.p', '.notes.npz'):
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return None
+
+def list_disk_cache_entries():
+    """
+    Lista as entradas do cache em disco.
+
+    Returns:
+        list: [(base_name, total_bytes, last_used)] ordenada do mais antigo
+              para o mais recente
+    """
+    entries = {}
+    if not os.path.isdir(DISK_CACHE_DIR):
+        return []
+
+    for name in os.listdir(DISK_CACHE_DIR):
+        base = get_disk_cache_base(name)
+        if base is None:
+            continue
+        stat = os.stat(os.path.join(DISK_CACHE_DIR, name))
+        size, last_used = entries.get(base, (0, 0))
+        entries[base] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+    return sorted(((base, size, last_used) for base, (size, last_used) in entries.items()),
+                  key=lambda item: item[2])
+
+def cleanup_disk_cache():
+    """
+    Remove os temporários abandonados (escritas interrompidas) e as entradas
+    menos usadas até o cache em disco caber em DISK_CACHE_MAX_BYTES.
+    """
+    with disk_cache_lock:
+        if os.path.isdir(DISK_CACHE_DIR):
+            now = time.time()
+            for name in os.listdir(DISK_CACHE_DIR):
+                if not name.endswith(DISK_CACHE_TEMP_SUFFIX):
+                    continue
+                path = os.path.join(DISK_CACHE_DIR, name)
+                try:
+                    if now - os.stat(path).st_mtime > DISK_CACHE_TEMP_MAX_AGE:
+                        os.remove(path)
+                        print(f"[DISK CACHE CLEANUP] Removed stale temporary file {name}")
+                except OSError:
+                    pass
+
+        entries = list_disk_cache_entries()
+        total = sum(size for _, size, _ in entries)
+
+        for base, size, _ in entries:
+            if total <= DISK_CACHE_MAX_BYTES:
+                break
+            for name in os.listdir(DISK_CACHE_DIR):
+                if get_disk_cache_base(name) == base:
+                    try:
+                        os.remove(os.path.join(DISK_CACHE_DIR, name))
+                    except OSError:
+                        pass
+            total -= size
+            print(f"[DISK CACHE CLEANUP] Removed {base[:12]}")
+
+def prewarm_score_cache(limit=DISK_CACHE_PREWARM):
+    """
+    Carrega para memória as entradas do cache em disco usadas mais
+    recentemente (pensada para correr no arranque, em background).
+    """
+    suffix = f"-m21_{VERSION_STR}"
+    recent = [base for base, _, _ in list_disk_cache_entries() if base.endswith(suffix)][-limit:] if limit > 0 else []
+
+    # Do mais antigo para o mais recente, para manter a ordem LRU
+    for base in recent:
+        score_key = base[:-len(suffix)]
+        with score_cache_lock:
+            if score_key in score_cache or score_key in score_cache_inflight:
+                continue
+
+        loaded = load_score_from_disk(score_key)
+        if loaded is None:
+            continue
+
+        entry = make_cache_entry(score_key, *loaded)
+        with score_cache_lock:
+            if score_key not in score_cache:
+                score_cache[score_key] = entry
+                enforce_cache_budget(protected_key=score_key)
+        print(f"[CACHE PREWARM] Loaded {score_key[:12]} from disk")
+
+def get_cached_score(file_path):
+    """
+    Obtém score do cache ou faz parse e guarda no cache.
+    Evita múltiplas chamadas a converter.parse() para o mesmo conteúdo.
+
+    O lock global só protege os dicionários; o parse corre fora dele.
+    Cada score em parse tem um Future em score_cache_inflight, por isso
+    pedidos concorrentes para o mesmo score esperam por esse parse, enquanto
+    parses de scores diferentes correm em paralelo e os cache hits nunca
+    ficam bloqueados atrás de um miss.
+
+    Args:
+        file_path: Caminho para ficheiro MusicXML
+
+    Returns:
+        music21.stream.Score: Score parseado
+
+    Raises:
+        Exception: Se falhar o parsing
+    """
+    score_key = get_file_hash(file_path)
+
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is not None:
+            if time.time() - entry['timestamp'] >= CACHE_EXPIRY:
+                # Expirado, remover
+                print(f"[CACHE EXPIRED] Removing expired cache for {score_key[:12]}")
+                del score_cache[score_key]
+                score_cache_stats['expirations'] += 1
+            elif entry['score'] is not None:
+                score_cache.move_to_end(score_key)
+                score_cache_stats['hits'] += 1
+                print(f"[CACHE HIT] Using cached score {score_key[:12]} for {file_path}")
+                return entry['score']
+
+        pending = score_cache_inflight.get(score_key)
+        if pending is None:
+            pending = Future()
+            score_cache_inflight[score_key] = pending
+            score_cache_stats['misses'] += 1
+            is_owner = True
+        else:
+            is_owner = False
+
+    if not is_owner:
+        print(f"[CACHE WAIT] Waiting for in-flight parse of {score_key[:12]}")
+        return pending.result()
+
+    # Carregar do disco ou fazer parse, fora do lock, e guardar no cache
+    try:
+        loaded = load_score_from_disk(score_key)
+        if loaded is not None:
+            print(f"[CACHE DISK HIT] Loaded {score_key[:12]} from disk cache")
+            new_entry = make_cache_entry(score_key, *loaded)
+        else:
+            print(f"[CACHE MISS] Parsing and caching {score_key[:12]} ({file_path})")
+            score = converter.parse(file_path)
+            new_entry = make_cache_entry(score_key, score)
+            # Cópia privada para o freeze, feita antes de o score ser
+            # partilhado: a thread não pode tocar no score em uso
+            Thread(target=save_score_to_disk, args=(score_key, copy.deepcopy(score), new_entry['notes']),
+                   daemon=True).start()
+        score = new_entry['score']
+    except Exception as e:
+        with score_cache_lock:
+            score_cache_inflight.pop(score_key, None)
+        pending.set_exception(e)
+        raise
+
+    with score_cache_lock:
+        # Uma entrada reduzida à NoteTable mantém os factos já calculados
+        old_entry = score_cache.get(score_key)
+        if old_entry is not None and old_entry['facts'] is not None:
+            new_entry['facts'] = old_entry['facts']
+            new_entry['size'] = estimate_entry_size(new_entry)
+        score_cache[score_key] = new_entry
+        score_cache.move_to_end(score_key)
+        score_cache_inflight.pop(score_key, None)
+        if loaded is not None:
+            score_cache_stats['disk_hits'] += 1
+        enforce_cache_budget(protected_key=score_key)
+    pending.set_result(score)
+    return score
+
+def get_note_table(file_path, expand_repeats=False):
+    """
+    Obtém a NoteTable de um score (construída uma vez por score em cache).
+
+    A NoteTable normal é usada mesmo que o Score completo já tenha sido
+    descartado; só faz parse se o score não estiver no cache.
+
+    Args:
+        file_path: Caminho para ficheiro MusicXML
+        expand_repeats: Se True, devolve a tabela do score com as repetições
+                        expandidas (usada pelo piano roll e comparação)
+
+    Returns:
+        NoteTable
+    """
+    score_key = get_file_hash(file_path)
+    table_name = 'expanded_notes' if expand_repeats else 'notes'
+
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if (entry is not None and entry[table_name] is not None
+                and time.time() - entry['timestamp'] < CACHE_EXPIRY):
+            score_cache.move_to_end(score_key)
+            score_cache_stats['hits'] += 1
+            return entry[table_name]
+
+    score = get_cached_score(file_path)
+    if not expand_repeats:
+        # A entrada pode já ter sido removida por outro pedido
+        with score_cache_lock:
+            entry = score_cache.get(score_key)
+            if entry is not None:
+                return entry['notes']
+        return NoteTable.from_score(score)
+
+    try:
+        expanded = score.expandRepeats()
+    except Exception as e:
+        print(f"Warning: Could not expand repeats: {e}")
+        expanded = score
+    table = NoteTable.from_score(expanded)
+    table.score_key = score_key
+
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is not None:
+            entry['expanded_notes'] = table
+            entry['size'] = estimate_entry_size(entry)
+            enforce_cache_budget(protected_key=score_key)
+    return table
+
+def get_score_facts(file_path):
+    """
+    Obtém os ScoreFacts de um score, para que a tonalidade, compassos, etc.
+    sejam calculados uma só vez.
+
+    A entrada do cache guarda uns ScoreFacts sem score (os valores
+    calculados); cada pedido recebe uma vista ligada ao seu próprio score,
+    que a redução do cache não pode desligar a meio de um cálculo.
+
+    Args:
+        file_path: Caminho para ficheiro MusicXML
+
+    Returns:
+        ScoreFacts
+    """
+    score = get_cached_score(file_path)
+    score_key = get_file_hash(file_path)
+
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is None:
+            return ScoreFacts(score)
+        if entry['facts'] is None:
+            entry['facts'] = ScoreFacts(None, score_key=score_key)
+        return entry['facts'].bind(score)
+
+def get_cache_stats():
+    """Contadores e ocupação atual do cache de scores."""
+    disk_entries = list_disk_cache_entries()
+
+    with score_cache_lock:
+        lookups = score_cache_stats['hits'] + score_cache_stats['misses']
+        return {
+            **score_cache_stats,
+            'hit_rate': round(score_cache_stats['hits'] / lookups, 4) if lookups else 0,
+            'entries': len(score_cache),
+            'full_scores': sum(1 for e in score_cache.values() if e['score'] is not None),
+            'bytes_used': sum(e['size'] for e in score_cache.values()),
+            'bytes_budget': CACHE_MAX_BYTES,
+            'disk_entries': len(disk_entries),
+            'disk_bytes_used': sum(size for _, size, _ in disk_entries),
+            'disk_bytes_budget': DISK_CACHE_MAX_BYTES,
+            'part_entries': len(part_cache),
+            'part_bytes_used': part_cache_bytes,
+            'part_bytes_budget': PART_CACHE_MAX_BYTES,
+            'excerpt_entries': len(excerpt_cache),
+            'excerpt_bytes_used': excerpt_cache_bytes,
+            'roman_numerals': get_roman_cache_stats()
+        }
+
+def clear_expired_cache():
+    """Limpar entradas expiradas do cache."""
+    with score_cache_lock:
+        now = time.time()
+        expired_keys = [
+            k for k, entry in score_cache.items()
+            if now - entry['timestamp'] >= CACHE_EXPIRY
+        ]
+        for key in expired_keys:
+            print(f"[CACHE CLEANUP] Removing expired cache for {key[:12]}")
+            del score_cache[key]
+            score_cache_stats['expirations'] += 1
+
+        if expired_keys:
+            print(f"[CACHE CLEANUP] Removed {len(expired_keys)} expired entries")
+# ========================================
+
+# ========================================
+# SCORE FACTS
+# ========================================
+class DistributionKeyAnalysis(analysis.discrete.AardenEssen):
+    """
+    O algoritmo de score.analyze('key') (Aarden-Essen) aplicado a uma
+    distribuição de classes de altura já calculada.
+    """
+
+    def __init__(self, distribution):
+        super().__init__()
+        self.distribution = distribution
+
+    def _getPitchClassDistribution(self, streamObj):
+        return self.distribution
+
+class ScoreFacts:
+    """
+    Factos derivados de um score (tonalidade global, tonalidade de um
+    subconjunto de partes, fórmulas de compasso, número de compassos...),
+    calculados na primeira utilização e partilhados por todas as rotas.
+
+    A entrada do cache guarda um objeto sem score (score=None) com os
+    valores calculados, que sobrevivem à redução da entrada à NoteTable.
+    get_score_facts() devolve uma vista ligada ao score do pedido (bind),
+    que partilha os valores e os locks mas não o score.
+
+    Cada facto tem o seu lock, para que um cálculo demorado (p.ex. no
+    pipeline de pré-análise) não bloqueie pedidos de outros factos.
+
+    Os factos por conjunto de partes (nomes ('chord_report', partes),
+    ('parts_key', partes)) guardam só os FACTS_MAX_SUBSETS conjuntos mais
+    recentes de cada tipo. O tamanho dos valores guardados conta para o
+    orçamento do cache (nbytes).
+    """
+    SUBSET_FACTS = ('chord_report', 'parts_key')
+
+    def __init__(self, score, shared=None, score_key=None):
+        self.score = score
+        if shared is None:
+            self.score_key = score_key
+            self.values = OrderedDict()
+            self.sizes = {}
+            self.lock = Lock()
+            self.locks = {}
+        else:
+            self.score_key = shared.score_key
+            self.values = shared.values
+            self.sizes = shared.sizes
+            self.lock = shared.lock
+            self.locks = shared.locks
+
+    def bind(self, score):
+        """Vista destes factos ligada a score (partilha valores e locks)."""
+        return ScoreFacts(score, self)
+
+    @property
+    def nbytes(self):
+        """Estimativa (bytes) da memória ocupada pelos valores guardados."""
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def get(self, name, compute, memoize_if=None):
+        """
+        Valor do facto name, calculado com compute() na primeira vez.
+
+        Se memoize_if(valor) for falso (p.ex. um resultado com 'error'), o
+        valor é devolvido sem ser guardado e volta a ser calculado no
+        pedido seguinte.
+        """
+        with self.lock:
+            if name in self.values:
+                self.values.move_to_end(name)
+                return self.values[name]
+            name_lock = self.locks.setdefault(name, Lock())
+
+        with name_lock:
+            with self.lock:
+                if name in self.values:
+                    return self.values[name]
+            value = compute()
+            if memoize_if is not None and not memoize_if(value):
+                return value
+            size = estimate_payload_size(value)
+            with self.lock:
+                self.values[name] = value
+                self.sizes[name] = size
+                if isinstance(name, tuple) and name[0] in self.SUBSET_FACTS:
+                    self.forget_old_subsets(name[0])
+
+        refresh_cache_entry_size(self.score_key)
+        return value
+
+    def forget_old_subsets(self, kind):
+        """Descarta os conjuntos de partes menos recentes do tipo kind (com self.lock)."""
+        names = [name for name in self.values if isinstance(name, tuple) and name[0] == kind]
+        for name in names[:-FACTS_MAX_SUBSETS]:
+            del self.values[name]
+            self.sizes.pop(name, None)
+            self.locks.pop(name, None)
+
+    @property
+    def global_key(self):
+        """Tonalidade global (score.analyze('key'))."""
+        return self.get('global_key', lambda: self.score.analyze('key'))
+
+    def parts_key(self, part_indices):
+        """Tonalidade de um subconjunto de partes (None se não houver partes válidas)."""
+        parts = tuple(sorted({i for i in part_indices if 0 <= i < self.num_parts}))
+        if not parts:
+            return None
+
+        def compute():
+            # Soma das distribuições de cada parte, em vez de inserir as
+            # partes do score em cache noutro Score (o que alteraria os seus
+            # sites, partilhados por outros pedidos)
+            distributions = [self.part_pitch_class_distribution(i) for i in parts]
+            distributions = [d for d in distributions if d is not None]
+            if not distributions:
+                raise analysis.discrete.DiscreteAnalysisException('no notes in the selected parts')
+            total = [sum(values) for values in zip(*distributions)]
+            return DistributionKeyAnalysis(total).getSolution(stream.Stream())
+
+        return self.get(('parts_key', parts), compute)
+
+    def part_pitch_class_distribution(self, part_idx):
+        """
+        Duração total (quarterLength) de cada classe de altura da parte,
+        como no music21 (None se a parte não tiver notas).
+        """
+        def compute():
+            notes = self.score.parts[part_idx].flatten().notes.getElementsNotOfClass('Unpitched')
+            if not notes:
+                return None
+            distribution = [0] * 12
+            for n in notes:
+                for p in n.pitches:
+                    distribution[p.pitchClass] += n.quarterLength
+            return distribution
+
+        return self.get(('pc_distribution', part_idx), compute)
+
+    @property
+    def num_parts(self):
+        return self.get('num_parts', lambda: len(self.score.parts))
+
+    @property
+    def instrument_names(self):
+        """Nomes das partes (ou 'Part N' se não tiverem nome)."""
+        return self.get('instrument_names', lambda: [
+            p.partName if p.partName else f"Part {i+1}" for i, p in enumerate(self.score.parts)
+        ])
+
+    @property
+    def part_instruments(self):
+        """Nome do instrumento de cada parte (ou 'Unknown')."""
+        def compute():
+            names = []
+            for part in self.score.parts:
+                part_instrument = part.getInstrument()
+                names.append(part_instrument.instrumentName if part_instrument else "Unknown")
+            return names
+
+        return self.get('part_instruments', compute)
+
+    @property
+    def total_measures(self):
+        """Número de compassos da primeira parte."""
+        return self.get('total_measures', lambda: (
+            len(self.score.parts[0].getElementsByClass('Measure')) if self.score.parts else 0
+        ))
+
+    @property
+    def time_signatures(self):
+        """Fórmulas de compasso distintas (ratioString), por ordem de aparição."""
+        def compute():
+            ratios = []
+            for ts in self.score.recurse().getElementsByClass(meter.TimeSignature):
+                if ts.ratioString not in ratios:
+                    ratios.append(ts.ratioString)
+            return ratios
+
+        return self.get('time_signatures', compute)
+
+    @property
+    def first_time_signature(self):
+        """Primeira TimeSignature do score (ou None)."""
+        return self.get('first_time_signature',
+                        lambda: self.score.recurse().getElementsByClass(meter.TimeSignature).first())
+
+# ========================================
+
+# ========================================
+# NOTE TABLE (COLUMNAR NOTE DATA)
+# ========================================
+# Modificadores de acidente do music21 (alter -> modifier), para reconstruir
+# nomes de notas a partir das colunas diatonic/alter sem objetos Pitch.
+ACCIDENTAL_MODIFIERS = {
+    0.0: '', 1.0: '#', -1.0: '-', 2.0: '##', -2.0: '--', 3.0: '###', -3.0: '---',
+    4.0: '####', -4.0: '----', 0.5: '~', 1.5: '#~', -0.5: '`', -1.5: '-`'
+}
+STEP_NAMES = 'CDEFGAB'
+SONORITIES_MAX_SUBSETS = 8  # Conjuntos de partes com sonoridades guardadas por tabela
+
+class NoteTable:
+    """
+    Tabela colunar (arrays NumPy) com todas as notas de um score.
+
+    Construída uma vez por score em cache e usada como input das análises,
+    em vez de percorrer part.recurse().notes em cada uma. Há uma linha por
+    nota (as notas de um acorde partilham o mesmo chord id; notas simples têm
+    chord = -1). As linhas estão agrupadas por parte e, dentro de cada parte,
+    pela ordem de part.recurse().notes.
+
+    Colunas:
+        part, measure (índice 0-based na grelha de compassos), offset,
+        duration (quarterLength), end, midi, pc, velocity, tie
+        (TIE_START|TIE_STOP), chord, diatonic (diatonicNoteNum) e alter
+        (para a ortografia das notas)
+
+    offset e end são calculados em frações exatas (como no music21) e
+    convertidos para float64 uma só vez: o mesmo instante dá sempre o mesmo
+    float, pelo que o fim de uma nota e o onset seguinte coincidem mesmo
+    depois de tercinas. As análises usam a coluna end em vez de somarem
+    offset + duration.
+    """
+    COLUMNS = {
+        'part': np.int16,
+        'measure': np.int32,
+        'offset': np.float64,
+        'duration': np.float64,
+        'end': np.float64,
+        'midi': np.int16,
+        'pc': np.int8,
+        'velocity': np.int16,
+        'tie': np.int8,
+        'chord': np.int32,
+        'diatonic': np.int16,
+        'alter': np.float32
+    }
+    TIE_START = 1
+    TIE_STOP = 2
+    TIE_FLAGS = {'start': TIE_START, 'stop': TIE_STOP, 'continue': TIE_START | TIE_STOP}
+
+    def __init__(self, columns, part_names, part_event_counts, measure_numbers,
+                 measure_offsets, measure_lengths):
+        for name, dtype in self.COLUMNS.items():
+            setattr(self, name, np.asarray(columns[name], dtype=dtype))
+
+        self.part_names = list(part_names)
+        self.part_event_counts = np.asarray(part_event_counts, dtype=np.int32)
+        self.measure_numbers = np.asarray(measure_numbers, dtype=np.int32)
+        self.measure_offsets = np.asarray(measure_offsets, dtype=np.float64)
+        self.measure_lengths = np.asarray(measure_lengths, dtype=np.float64)
+
+        # Linhas agrupadas por parte: limites [start, end) de cada parte
+        bounds = np.searchsorted(self.part, np.arange(len(self.part_names) + 1))
+        self.part_slices = [slice(int(bounds[i]), int(bounds[i + 1])) for i in range(len(self.part_names))]
+
+        # Estruturas derivadas, calculadas na primeira utilização: sonoridades
+        # por conjunto de partes (as SONORITIES_MAX_SUBSETS mais recentes),
+        # intervalos verticais e histogramas. Contam para o tamanho da
+        # entrada do cache score_key (None se a tabela não estiver no cache).
+        self.score_key = None
+        self.derived_lock = Lock()
+        self.sonorities = OrderedDict()
+        self.vertical_intervals = None
+        self.histograms = None
+
+    def __len__(self):
+        return len(self.midi)
+
+    @property
+    def num_parts(self):
+        return len(self.part_names)
+
+    @property
+    def num_measures(self):
+        return len(self.measure_numbers)
+
+    @property
+    def nbytes(self):
+        with self.derived_lock:
+            derived = (sum(s.nbytes for s in self.sonorities.values())
+                       + (self.vertical_intervals.nbytes if self.vertical_intervals is not None else 0)
+                       + (self.histograms.nbytes if self.histograms is not None else 0))
+        return sum(getattr(self, name).nbytes for name in self.COLUMNS) + self.measure_offsets.nbytes * 3 + derived
+
+    @classmethod
+    def from_score(cls, score):
+        """Extrai a NoteTable de um music21 Score numa única passagem."""
+        columns = {name: [] for name in cls.COLUMNS}
+        part_event_counts = []
+        chord_id = 0
+
+        grid = score.parts[0].getElementsByClass('Measure') if score.parts else []
+        measure_numbers = [m.number for m in grid]
+        measure_offsets = [float(m.offset) for m in grid]
+        measure_lengths = [float(m.duration.quarterLength) for m in grid]
+
+        def add_row(part_idx, offset, duration, end, p, velocity, tie, chord_idx):
+            columns['part'].append(part_idx)
+            columns['offset'].append(offset)
+            columns['duration'].append(duration)
+            columns['end'].append(end)
+            columns['midi'].append(p.midi)
+            columns['pc'].append(p.pitchClass)
+            columns['velocity'].append(velocity)
+            columns['tie'].append(cls.TIE_FLAGS.get(tie.type, 0) if tie is not None else 0)
+            columns['chord'].append(chord_idx)
+            columns['diatonic'].append(p.diatonicNoteNum)
+            columns['alter'].append(p.alter)
+
+        for part_idx, part in enumerate(score.parts):
+            part_start = len(columns['part'])
+            event_count = 0
+
+            iterator = part.recurse().notes
+            for element in iterator:
+                event_count += 1
+                exact_offset = Fraction(iterator.currentHierarchyOffset())
+                offset = float(exact_offset)
+                duration = float(element.quarterLength)
+                end = float(exact_offset + Fraction(element.quarterLength))
+                velocity = element.volume.velocity if element.hasVolumeInformation() and element.volume.velocity else 64
+
+                if element.isNote:
+                    add_row(part_idx, offset, duration, end, element.pitch, velocity, element.tie, -1)
+                elif element.isChord:
+                    chord_notes = [n for n in element.notes if hasattr(n, 'pitch')]
+                    for chord_note in chord_notes:
+                        add_row(part_idx, offset, duration, end, chord_note.pitch, velocity,
+                                chord_note.tie or element.tie, chord_id)
+                    if chord_notes:
+                        chord_id += 1
+
+            # Compasso de cada nota, pelos offsets dos compassos desta parte
+            part_measure_offsets = [float(m.offset) for m in part.getElementsByClass('Measure')] or measure_offsets or [0.0]
+            measure_idx = np.searchsorted(part_measure_offsets, columns['offset'][part_start:], side='right') - 1
+            columns['measure'].extend(np.maximum(measure_idx, 0).tolist())
+            part_event_counts.append(event_count)
+
+        return cls(
+            columns,
+            [p.partName for p in score.parts],
+            part_event_counts,
+            measure_numbers,
+            measure_offsets,
+            measure_lengths
+        )
+
+    def to_arrays(self):
+        """Arrays para serialização (np.savez)."""
+        arrays = {name: getattr(self, name) for name in self.COLUMNS}
+        arrays['part_names'] = np.array([name or '' for name in self.part_names], dtype=str)
+        arrays['part_event_counts'] = self.part_event_counts
+        arrays['measure_numbers'] = self.measure_numbers
+        arrays['measure_offsets'] = self.measure_offsets
+        arrays['measure_lengths'] = self.measure_lengths
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Reconstrói a tabela a partir do resultado de to_arrays() (ou np.load)."""
+        return cls(
+            {name: arrays[name] for name in cls.COLUMNS},
+            [str(name) or None for name in arrays['part_names']],
+            arrays['part_event_counts'],
+            arrays['measure_numbers'],
+            arrays['measure_offsets'],
+            arrays['measure_lengths']
+        )
+
+    def get_sonorities(self, parts=None):
+        """
+        Sonoridades verticais (SonorityTable) de um conjunto de partes
+        (por omissão, todas), calculadas uma vez e guardadas na tabela.
+        """
+        parts = tuple(sorted(set(range(self.num_parts) if parts is None else parts)))
+        with self.derived_lock:
+            sonorities = self.sonorities.get(parts)
+            if sonorities is not None:
+                self.sonorities.move_to_end(parts)
+                return sonorities
+
+        sonorities = SonorityTable.from_note_table(self, parts)
+        with self.derived_lock:
+            self.sonorities[parts] = sonorities
+            while len(self.sonorities) > SONORITIES_MAX_SUBSETS:
+                self.sonorities.popitem(last=False)
+        refresh_cache_entry_size(self.score_key)
+        return sonorities
+
+    def get_vertical_intervals(self):
+        """Pares de notas simultâneas (VerticalIntervals) de todas as partes, calculados uma vez."""
+        if self.vertical_intervals is None:
+            vertical_intervals = VerticalIntervals.from_note_table(self)
+            with self.derived_lock:
+                self.vertical_intervals = vertical_intervals
+            refresh_cache_entry_size(self.score_key)
+        return self.vertical_intervals
+
+    def get_histograms(self):
+        """Histogramas em somas prefixas (ScoreHistograms) de todas as partes, calculados uma vez."""
+        if self.histograms is None:
+            histograms = ScoreHistograms.from_note_table(self)
+            with self.derived_lock:
+                self.histograms = histograms
+            refresh_cache_entry_size(self.score_key)
+        return self.histograms
+
+    def part_rows(self, part_idx):
+        """Slice com as linhas de uma parte."""
+        return self.part_slices[part_idx]
+
+    def single_note_rows(self, part_idx):
+        """Índices das notas simples (não acordes) de uma parte, por ordem."""
+        rows = self.part_slices[part_idx]
+        return np.flatnonzero(self.chord[rows] < 0) + rows.start
+
+    def time_ordered_rows(self, part_idx):
+        """Índices das linhas de uma parte ordenados por offset (como part.flatten().notes)."""
+        rows = self.part_slices[part_idx]
+        return np.argsort(self.offset[rows], kind='stable') + rows.start
+
+    def pitch_names(self, rows, with_octave=False):
+        """Nomes das notas (como Pitch.name / Pitch.nameWithOctave) das linhas indicadas."""
+        diatonic = self.diatonic[rows] - 1
+        names = []
+        for step_idx, octave, alter in zip((diatonic % 7).tolist(), (diatonic // 7).tolist(), self.alter[rows].tolist()):
+            name = STEP_NAMES[step_idx] + ACCIDENTAL_MODIFIERS.get(alter, '')
+            names.append(f"{name}{octave}" if with_octave else name)
+        return names
+
+# ========================================
+
+# ========================================
+# VERTICAL SONORITIES (SWEEP LINE)
+# ========================================
+class SonorityTable:
+    """
+    Sonoridades verticais de um conjunto de partes, calculadas numa só
+    passagem (sweep line) sobre a NoteTable, em substituição de chordify().
+
+    O tempo é cortado em todos os onsets, fins de notas e inícios de
+    compasso; cada segmento com pelo menos uma nota a soar é uma sonoridade.
+    Tal como no chordify(), notas com a mesma ortografia e oitava contam uma
+    só vez e segmentos sem notas (pausas) não aparecem.
+
+    Arrays por sonoridade: start, end, measure (índice na grelha), mask
+    (conjunto de pitch classes em 12 bits), bass (MIDI da nota mais grave).
+    As notas de cada sonoridade (do grave para o agudo) estão em formato
+    CSR: linhas da NoteTable em note_rows[pitch_ptr[i]:pitch_ptr[i + 1]].
+    """
+
+    def __init__(self, table, parts, start, end, measure, mask, bass, pitch_ptr, note_rows):
+        self.table = table
+        self.parts = tuple(parts)
+        self.start = start
+        self.end = end
+        self.measure = measure
+        self.mask = mask
+        self.bass = bass
+        self.pitch_ptr = pitch_ptr
+        self.note_rows = note_rows
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.start, self.end, self.measure, self.mask,
+                                      self.bass, self.pitch_ptr, self.note_rows))
+
+    @property
+    def pitch_counts(self):
+        """Número de notas distintas em cada sonoridade."""
+        return np.diff(self.pitch_ptr)
+
+    @classmethod
+    def from_note_table(cls, table, parts):
+        """Constrói as sonoridades das partes indicadas a partir da NoteTable."""
+        rows = np.flatnonzero(np.isin(table.part, list(parts)) & (table.duration > 0))
+        empty = np.zeros(0, dtype=np.int64)
+        if len(rows) == 0:
+            return cls(table, parts, np.zeros(0), np.zeros(0), empty, empty, empty, np.zeros(1, dtype=np.int64), empty)
+
+        note_start = table.offset[rows]
+        note_end = table.end[rows]
+        bounds = np.unique(np.concatenate([note_start, note_end, table.measure_offsets]))
+
+        # Segmentos [first, last) cobertos por cada nota, expandidos em pares (segmento, nota)
+        first = np.searchsorted(bounds, note_start)
+        counts = np.searchsorted(bounds, note_end) - first
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        segment = np.repeat(first, counts) + (np.arange(counts.sum()) - run_starts)
+        note_rows = np.repeat(rows, counts)
+
+        # Ordenar por segmento e altura; remover notas repetidas (mesma ortografia e oitava)
+        order = np.lexsort((table.alter[note_rows], table.diatonic[note_rows], table.midi[note_rows], segment))
+        segment, note_rows = segment[order], note_rows[order]
+        keep = np.ones(len(segment), dtype=bool)
+        keep[1:] = ((segment[1:] != segment[:-1])
+                    | (table.diatonic[note_rows[1:]] != table.diatonic[note_rows[:-1]])
+                    | (table.alter[note_rows[1:]] != table.alter[note_rows[:-1]]))
+        segment, note_rows = segment[keep], note_rows[keep]
+
+        occupied, ptr_start = np.unique(segment, return_index=True)
+        pitch_ptr = np.append(ptr_start, len(segment))
+        pc_bits = np.left_shift(1, table.pc[note_rows].astype(np.int64))
+
+        start = bounds[occupied]
+        measure = np.searchsorted(table.measure_offsets, start, side='right') - 1
+
+        return cls(
+            table,
+            parts,
+            start,
+            bounds[occupied + 1],
+            np.maximum(measure, 0),
+            np.bitwise_or.reduceat(pc_bits, ptr_start),
+            table.midi[note_rows[ptr_start]].astype(np.int64),
+            pitch_ptr,
+            note_rows
+        )
+
+    def measure_bounds(self, measure_idx):
+        """Intervalo [start, end) das sonoridades de um compasso."""
+        return (int(np.searchsorted(self.measure, measure_idx, side='left')),
+                int(np.searchsorted(self.measure, measure_idx, side='right')))
+
+    def pitch_rows(self, i):
+        """Linhas da NoteTable das notas da sonoridade i (do grave para o agudo)."""
+        return self.note_rows[self.pitch_ptr[i]:self.pitch_ptr[i + 1]]
+
+    def pitch_names(self, i):
+        """Nomes (com oitava) das notas da sonoridade i."""
+        return self.table.pitch_names(self.pitch_rows(i), with_octave=True)
+
+    def make_chord(self, i):
+        """music21 Chord equivalente à sonoridade i."""
+        return chord.Chord(self.pitch_names(i))
+
+# ========================================
+
+# ========================================
+# PITCH-CLASS SET TABLE
+# ========================================
+# Os 4096 conjuntos de pitch classes (máscara de 12 bits, bit p = pitch
+# class p), calculados no primeiro uso (get_pcset_table) e guardados em
+# disco junto do cache de scores, se possível: forte_class (Tn, como
+# Chord.forteClass), normal_order, prime_form, interval_vector e
+# common_names (nomes do conjunto, sem ortografia).
+pcset_table = []
+pcset_table_lock = Lock()
+
+# Nome de acorde (Chord.pitchedCommonName) por sonoridade; a chave inclui a
+# máscara, o baixo e a ortografia das notas (ver sonority_chord_key)
+chord_name_table = {}
+
+# Forma normal transposta para 0 -> índice de Forte, por cardinalidade
+pcset_forte_index = {
+    card: {chord.tables.FORTE[card][index][0]: index for index in range(1, len(chord.tables.FORTE[card]))}
+    for card in range(1, 13)
+}
+
+def get_pcset_table_path():
+    """Caminho do ficheiro da tabela de conjuntos de pitch classes."""
+    return os.path.join(os.path.abspath(DISK_CACHE_DIR), f"pcset-m21_{VERSION_STR}.json")
+
+def pcset_table_address(pcs):
+    """
+    Endereço nas tabelas de Forte (como chord.tables.seekChordTablesAddress)
+    de uma lista ordenada de pitch classes distintas.
+
+    Returns:
+        tuple: (cardinality, forte_index, inversion, pc_original)
+    """
+    card = len(pcs)
+    if card == 1:
+        return (1, 1, 0, pcs[0])
+    if card == 12:
+        return (12, 1, 0, 0)
+
+    forte_rows = chord.tables.FORTE[card]
+    best = None
+    for rot in range(card):
+        original_pc = pcs[rot]
+        rotation = [(x - original_pc) % 12 for x in pcs[rot:] + pcs[:rot]]
+        inverted = [(12 - x) % 12 for x in reversed(rotation)]
+        inverted = tuple((x - inverted[0]) % 12 for x in inverted)
+
+        for candidate, inversion in ((tuple(rotation), 1), (inverted, -1)):
+            index = pcset_forte_index[card].get(candidate)
+            if index is not None and (best is None or index < best[1]):
+                if forte_rows[index][2][1] > 0:
+                    inversion = 0
+                best = (card, index, inversion, original_pc)
+    return best
+
+def build_pcset_entry(mask):
+    """Entrada da tabela para uma máscara de pitch classes."""
+    pcs = [pc for pc in range(12) if mask >> pc & 1]
+    if not pcs:
+        return {'forte_class': 'N/A', 'normal_order': [], 'prime_form': [],
+                'interval_vector': [0] * 6, 'common_names': []}
+
+    address = chord.tables.ChordTableAddress(*pcset_table_address(pcs))
+    transposed = chord.tables.addressToTransposedNormalForm(address)
+    normal_order = next(
+        [(pc + t) % 12 for pc in transposed]
+        for t in pcs
+        if {(pc + t) % 12 for pc in transposed} == set(pcs)
+    )
+    return {
+        'forte_class': chord.tables.addressToForteName(address, 'tn'),
+        'normal_order': normal_order,
+        'prime_form': list(chord.tables.addressToPrimeForm(address)),
+        'interval_vector': list(chord.tables.addressToIntervalVector(address)),
+        'common_names': chord.tables.addressToCommonNames(address) or []
+    }
+
+def load_pcset_table():
+    """Carrega a tabela do disco ou, se não existir, calcula-a e guarda-a."""
+    table_path = get_pcset_table_path()
+    try:
+        with open(table_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        if len(entries) == 4096:
+            pcset_table[:] = entries
+            return
+    except (OSError, ValueError):
+        pass
+
+    pcset_table[:] = [build_pcset_entry(mask) for mask in range(4096)]
+    try:
+        os.makedirs(os.path.dirname(table_path), exist_ok=True)
+        tmp_path = table_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(pcset_table, f)
+        os.replace(tmp_path, table_path)
+    except OSError as e:
+        print(f"[PCSET] Could not save pitch-class set table: {str(e)}")
+
+def get_pcset_table():
+    """Tabela de conjuntos de pitch classes, carregada (ou calculada) no primeiro uso."""
+    if not pcset_table:
+        with pcset_table_lock:
+            if not pcset_table:
+                load_pcset_table()
+    return pcset_table
+
+def sonority_voicing(sonorities, i):
+    """Disposição da sonoridade i: (nome, passos diatónicos acima do baixo) de cada nota."""
+    rows = sonorities.pitch_rows(i)
+    names = sonorities.table.pitch_names(rows)
+    spans = (sonorities.table.diatonic[rows] - sonorities.table.diatonic[rows[0]]).tolist()
+    return tuple(zip(names, spans))
+
+def sonority_chord_key(sonorities, i):
+    """
+    Chave de chord_name_table da sonoridade i. Com 3 ou mais pitch classes o
+    nome só depende da ortografia e do baixo; com 1 ou 2 conta também a
+    disposição (oitavas, intervalos compostos).
+    """
+    mask = int(sonorities.mask[i])
+    if len(get_pcset_table()[mask]['normal_order']) <= 2:
+        return (mask, sonority_voicing(sonorities, i))
+    names = sonorities.table.pitch_names(sonorities.pitch_rows(i))
+    return (mask, names[0], tuple(sorted(set(names))))
+
+def sonority_chord_name(sonorities, i):
+    """Nome do acorde da sonoridade i (como Chord.pitchedCommonName)."""
+    chord_key = sonority_chord_key(sonorities, i)
+    name = chord_name_table.get(chord_key)
+    if name is None:
+        name = sonorities.make_chord(i).pitchedCommonName
+        chord_name_table[chord_key] = name
+    return name
+
+# ========================================
+
+# ========================================
+# ROMAN NUMERAL CACHE
+# ========================================
+# Cache LRU das figuras de roman.romanNumeralFromChord por sonoridade e
+# tonalidade. A figura depende da ortografia e das dobragens (ex.: 'iv' vs
+# 'iv53b3'), por isso a chave inclui a disposição além da máscara e do baixo.
+ROMAN_CACHE_MAX_ENTRIES = int(os.environ.get('MIAL_ROMAN_CACHE_MAX_ENTRIES', 8192))
+roman_figure_cache = OrderedDict()
+roman_cache_lock = Lock()
+roman_cache_stats = {'hits': 0, 'misses': 0}
+
+def sonority_roman_figure(sonorities, i, key_obj):
+    """Figura em numeração romana da sonoridade i na tonalidade key_obj."""
+    roman_key = (
+        int(sonorities.mask[i]),
+        int(sonorities.bass[i]) % 12,
+        sonority_voicing(sonorities, i),
+        key_obj.tonic.name,
+        key_obj.mode
+    )
+    with roman_cache_lock:
+        figure = roman_figure_cache.get(roman_key)
+        if figure is not None:
+            roman_figure_cache.move_to_end(roman_key)
+            roman_cache_stats['hits'] += 1
+            return figure
+        roman_cache_stats['misses'] += 1
+
+    figure = roman.romanNumeralFromChord(sonorities.make_chord(i), key_obj).figure
+
+    with roman_cache_lock:
+        roman_figure_cache[roman_key] = figure
+        while len(roman_figure_cache) > ROMAN_CACHE_MAX_ENTRIES:
+            roman_figure_cache.popitem(last=False)
+    return figure
+
+def get_roman_cache_stats():
+    """Contadores e ocupação do cache de numeração romana."""
+    with roman_cache_lock:
+        lookups = roman_cache_stats['hits'] + roman_cache_stats['misses']
+        return {
+            **roman_cache_stats,
+            'hit_rate': round(roman_cache_stats['hits'] / lookups, 4) if lookups else 0,
+            'entries': len(roman_figure_cache),
+            'max_entries': ROMAN_CACHE_MAX_ENTRIES
+        }
+
+# ========================================
+
+# ========================================
+# KEY TRACKING (PREFIX-SUM PROFILES)
+# ========================================
+def build_key_profiles():
+    """
+    Perfis das 24 tonalidades (os de Aarden-Essen, usados por
+    score.analyze('key')), já centrados e normalizados: a correlação de
+    Pearson com um histograma normalizado é então um produto interno.
+
+    Returns:
+        tuple: (profiles (24, 12), names) - linhas 0-11 maior, 12-23 menor;
+               names[k] é o nome como key_obj.tonic.name + ' ' + mode
+    """
+    analyzer = analysis.discrete.AardenEssen()
+    profiles = []
+    names = []
+    for mode, valid_tonics in (('major', analyzer.keysValidMajor), ('minor', analyzer.keysValidMinor)):
+        weights = np.asarray(analyzer.getWeights(mode), dtype=np.float64)
+        for tonic_pc in range(12):
+            # Peso da pitch class j na tonalidade de tónica t: weights[(j - t) % 12]
+            profiles.append(np.roll(weights, tonic_pc))
+            tonic = pitch.Pitch(tonic_pc)
+            if tonic.name not in valid_tonics:
+                tonic = tonic.getEnharmonic()
+            names.append(f"{tonic.name} {mode}")
+
+    profiles = np.array(profiles)
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    profiles /= np.linalg.norm(profiles, axis=1, keepdims=True)
+    return profiles, names
+
+KEY_PROFILES, KEY_NAMES = build_key_profiles()
+
+def measure_pitch_class_histograms(table, parts=None):
+    """
+    Histogramas de pitch classes por compasso, pesados pela duração
+    (quarterLength), de um conjunto de partes (por omissão, todas).
+
+    Returns:
+        np.ndarray: (num_measures, 12)
+    """
+    rows = np.arange(len(table)) if parts is None else np.flatnonzero(np.isin(table.part, list(parts)))
+    bins = table.measure[rows].astype(np.int64) * 12 + table.pc[rows]
+    counts = np.bincount(bins, weights=table.duration[rows], minlength=table.num_measures * 12)
+    return counts[:table.num_measures * 12].reshape(table.num_measures, 12)
+
+def track_local_keys(table, window_size=4, hop=None, parts=None):
+    """
+    Tonalidade local em janelas deslizantes de window_size compassos,
+    avançando hop compassos de cada vez (por omissão, janelas seguidas).
+
+    Os histogramas de cada janela saem de somas prefixas por compasso e são
+    correlacionados com os 24 perfis numa só multiplicação de matrizes.
+    Janelas sem notas são ignoradas.
+
+    Returns:
+        list: [{'start': int, 'end': int, 'key': str, 'correlation': float}],
+              com start/end índices de compasso 0-based, end exclusivo
+    """
+    hop = hop or window_size
+    num_measures = table.num_measures
+    if num_measures == 0:
+        return []
+
+    starts = np.arange(0, num_measures, hop)
+    ends = np.minimum(starts + window_size, num_measures)
+    valid, best, correlations = correlate_key_windows(table, starts, ends, parts)
+
+    return [
+        {'start': start, 'end': end, 'key': KEY_NAMES[k], 'correlation': corr}
+        for start, end, k, corr in zip(
+            starts[valid].tolist(),
+            ends[valid].tolist(),
+            best.tolist(),
+            correlations.tolist()
+        )
+    ]
+
+def measure_local_keys(table, window_size=8, parts=None):
+    """
+    Tonalidade local de cada compasso, numa janela de window_size compassos
+    centrada nele. Compassos cuja janela não tem notas ficam com a
+    tonalidade do compasso anterior (ou, no início, do seguinte).
+
+    Returns:
+        np.ndarray: (num_measures,) índices em KEY_NAMES (k < 12: maior,
+                    tónica k; k >= 12: menor, tónica k - 12); -1 se não houver notas
+    """
+    num_measures = table.num_measures
+    keys = np.full(num_measures, -1, dtype=np.int64)
+    if num_measures == 0:
+        return keys
+
+    starts = np.clip(np.arange(num_measures) - window_size // 2, 0, max(num_measures - window_size, 0))
+    ends = np.minimum(starts + window_size, num_measures)
+    valid, best, _ = correlate_key_windows(table, starts, ends, parts)
+    if len(valid) == 0:
+        return keys
+
+    keys[valid] = best
+    # Preencher compassos vazios com a tonalidade válida mais próxima para trás (ou para a frente)
+    filled = np.maximum.accumulate(np.where(keys >= 0, np.arange(num_measures), -1))
+    filled[filled < 0] = valid[0]
+    return keys[filled]
+
+def correlate_key_windows(table, starts, ends, parts=None):
+    """
+    Correlação dos histogramas das janelas [starts, ends) (em compassos)
+    com os 24 perfis, via somas prefixas e uma multiplicação de matrizes.
+
+    Returns:
+        tuple: (valid, best, correlation) - janelas com notas, índice da
+               melhor tonalidade e a sua correlação
+    """
+    histograms = measure_pitch_class_histograms(table, parts)
+    prefix = np.vstack([np.zeros((1, 12)), np.cumsum(histograms, axis=0)])
+    windows = prefix[ends] - prefix[starts]
+
+    centered = windows - windows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1)
+    valid = np.flatnonzero(norms > 1e-9)
+    correlations = (centered[valid] / norms[valid, None]) @ KEY_PROFILES.T
+    best = correlations.argmax(axis=1)
+    return valid, best, correlations[np.arange(len(valid)), best]
+
+# ========================================
+
+# ========================================
+# CADENCE ENGINE
+# ========================================
+# Cadências da partitura completa numa só passagem linear sobre as
+# sonoridades em cache. A fundamental e a qualidade de cada sonoridade vêm
+# de tabelas pré-calculadas por (baixo, máscara); o grau é contado a partir
+# da tónica local do compasso de chegada (measure_local_keys).
+CHORD_TEMPLATES = (
+    ('dominant-seventh', (0, 4, 7, 10)),
+    ('major-seventh', (0, 4, 7, 11)),
+    ('minor-seventh', (0, 3, 7, 10)),
+    ('half-diminished', (0, 3, 6, 10)),
+    ('diminished-seventh', (0, 3, 6, 9)),
+    ('major', (0, 4, 7)),
+    ('minor', (0, 3, 7)),
+    ('diminished', (0, 3, 6)),
+    ('augmented', (0, 4, 8)),
+    ('fifth', (0, 7)),
+    ('major-third', (0, 4)),
+    ('minor-third', (0, 3)),
+    ('unison', (0,))
+)
+QUALITY_INDEX = {name: q for q, (name, _) in enumerate(CHORD_TEMPLATES)}
+
+CADENCE_TYPES = {
+    'PAC': ('Perfect Authentic (V-I)', 0.95),
+    'IAC': ('Imperfect Authentic (V-I)', 0.80),
+    'HC': ('Half (V)', 0.70),
+    'PC': ('Plagal (IV-I)', 0.80),
+    'DC': ('Deceptive (V-vi)', 0.70)
+}
+CADENCE_KEY_WINDOW = 8       # compassos da janela de tonalidade local
+CADENCE_MIN_ARRIVAL = 1.0    # duração mínima (quarterLength) do acorde de chegada
+CADENCE_MIN_HALF = 2.0       # duração mínima do V numa cadência à dominante
+CADENCE_MIN_SPACING = 2      # cadências a menos de 2 compassos: fica a última
+
+def build_chord_root_tables():
+    """
+    Fundamental e qualidade de cada par (baixo, máscara) de pitch classes.
+
+    Um modelo de CHORD_TEMPLATES transposto para a fundamental r serve se
+    estiver contido na máscara, com no máximo uma nota estranha (díades e
+    uníssonos só servem exatamente). Ganha o modelo maior, depois o de maior
+    prioridade e, em empate, a fundamental igual ao baixo.
+
+    Returns:
+        tuple: (roots, qualities) - arrays (12, 4096) int8; -1 sem acorde
+    """
+    masks = np.arange(4096, dtype=np.int64)
+    popcount = np.array([bin(m).count('1') for m in range(4096)])
+
+    template_masks, roots, scores = [], [], []
+    for priority, (_, intervals) in enumerate(CHORD_TEMPLATES):
+        for root in range(12):
+            template_masks.append(sum(1 << ((root + i) % 12) for i in intervals))
+            roots.append(root)
+            scores.append(len(intervals) * 100 - priority)
+    template_masks = np.array(template_masks)[:, None]
+    sizes = np.array([len(CHORD_TEMPLATES[c // 12][1]) for c in range(len(roots))])[:, None]
+    roots = np.array(roots)
+
+    extras = popcount[None, :] - sizes
+    fits = ((masks[None, :] & template_masks) == template_masks) & np.where(sizes >= 3, extras <= 1, extras == 0)
+    candidate_scores = np.where(fits, np.array(scores)[:, None] * 2, -1)
+
+    # Desempate pela fundamental no baixo: (12 baixos, candidatos, máscaras)
+    with_bass = candidate_scores[None, :, :] + (roots[None, :, None] == np.arange(12)[:, None, None])
+    best = with_bass.argmax(axis=1)
+    valid = with_bass.max(axis=1) >= 0
+
+    return (np.where(valid, roots[best], -1).astype(np.int8),
+            np.where(valid, best // 12, -1).astype(np.int8))
+
+CHORD_ROOTS, CHORD_QUALITIES = build_chord_root_tables()
+
+DOMINANT_QUALITIES = {QUALITY_INDEX['major'], QUALITY_INDEX['dominant-seventh']}
+LEADING_TONE_QUALITIES = {QUALITY_INDEX[q] for q in ('diminished', 'half-diminished', 'diminished-seventh')}
+SUBDOMINANT_QUALITIES = {QUALITY_INDEX[q] for q in ('major', 'minor', 'major-seventh', 'minor-seventh')}
+TONIC_QUALITIES = {QUALITY_INDEX[q] for q in ('major', 'minor', 'fifth', 'major-third', 'minor-third', 'unison')}
+
+def sonority_harmonies(sonorities):
+    """
+    Agrupa sonoridades seguidas com a mesma fundamental e qualidade em
+    harmonias. Sonoridades sem acorde reconhecido são ignoradas (não
+    interrompem a harmonia em curso).
+
+    Returns:
+        dict: arrays por harmonia - first/last (sonoridade), root, quality,
+              start, end (quarterLength)
+    """
+    roots = CHORD_ROOTS[sonorities.bass % 12, sonorities.mask].astype(np.int64)
+    qualities = CHORD_QUALITIES[sonorities.bass % 12, sonorities.mask].astype(np.int64)
+    chordal = np.flatnonzero(roots >= 0)
+    codes = roots[chordal] * len(CHORD_TEMPLATES) + qualities[chordal]
+
+    is_first = np.ones(len(chordal), dtype=bool)
+    is_first[1:] = codes[1:] != codes[:-1]
+    first = chordal[is_first]
+    last = chordal[np.append(np.flatnonzero(is_first)[1:] - 1, len(chordal) - 1)] if len(chordal) else first
+
+    return {
+        'first': first,
+        'last': last,
+        'root': roots[first],
+        'quality': qualities[first],
+        'start': sonorities.start[first],
+        'end': sonorities.end[last]
+    }
+
+def find_cadences(table):
+    """
+    Cadências (PAC, IAC, HC, plagal, deceptiva) de todas as partes, numa só
+    passagem sobre as transições entre harmonias.
+
+    A chegada tem de cair num tempo forte (início ou meio do compasso) e
+    durar pelo menos CADENCE_MIN_ARRIVAL. PAC: V-I com os dois acordes no
+    estado fundamental e a tónica na voz superior; qualquer outro V(7)/vii°-I
+    é IAC. Cadências a menos de CADENCE_MIN_SPACING compassos da anterior
+    substituem-na (ex.: alternâncias I-V-I-V contam uma vez, no fim).
+
+    Returns:
+        list: dicts com measure (índice), offset, code, key (índice em
+              KEY_NAMES), departure e arrival (índices de sonoridade)
+    """
+    sonorities = table.get_sonorities()
+    if len(sonorities) == 0:
+        return []
+
+    keys = measure_local_keys(table, CADENCE_KEY_WINDOW)
+    harmonies = sonority_harmonies(sonorities)
+    num_harmonies = len(harmonies['first'])
+
+    # Métrica e tonalidade de cada harmonia, calculadas em bloco
+    measure = sonorities.measure[harmonies['first']]
+    position = harmonies['start'] - table.measure_offsets[measure]
+    length = table.measure_lengths[measure]
+    strong = np.isclose(position, 0) | ((length >= 3) & np.isclose(position * 2, length))
+    duration = harmonies['end'] - harmonies['start']
+    key_idx = keys[measure]
+    degree = ((harmonies['root'] - key_idx % 12) % 12).tolist()
+    minor = (key_idx >= 12).tolist()
+
+    root_position = (harmonies['root'] == sonorities.bass[harmonies['first']] % 12).tolist()
+    last_root_position = (harmonies['root'] == sonorities.bass[harmonies['last']] % 12).tolist()
+    soprano = table.pc[sonorities.note_rows[sonorities.pitch_ptr[harmonies['first'] + 1] - 1]].tolist()
+    quality = harmonies['quality'].tolist()
+    strong, duration, measure = strong.tolist(), duration.tolist(), measure.tolist()
+
+    def is_dominant(h, k):
+        d = (harmonies['root'][h] - k % 12) % 12
+        return (d == 7 and quality[h] in DOMINANT_QUALITIES) or (d == 11 and quality[h] in LEADING_TONE_QUALITIES)
+
+    cadences = []
+    for h in range(num_harmonies):
+        k = int(key_idx[h])
+        code = None
+        departure = h - 1
+
+        if h > 0 and strong[h] and duration[h] >= CADENCE_MIN_ARRIVAL:
+            prev = h - 1
+            if degree[h] == 0 and quality[h] in TONIC_QUALITIES:
+                if is_dominant(prev, k):
+                    perfect = ((harmonies['root'][prev] - k % 12) % 12 == 7 and last_root_position[prev]
+                               and root_position[h] and soprano[h] == k % 12)
+                    code = 'PAC' if perfect else 'IAC'
+                elif (harmonies['root'][prev] - k % 12) % 12 == 5 and quality[prev] in SUBDOMINANT_QUALITIES:
+                    code = 'PC'
+            elif is_dominant(prev, k) and (harmonies['root'][prev] - k % 12) % 12 == 7:
+                submediant = (degree[h] == 8 and quality[h] in (QUALITY_INDEX['major'], QUALITY_INDEX['major-seventh'])) if minor[h] \
+                    else (degree[h] == 9 and quality[h] in (QUALITY_INDEX['minor'], QUALITY_INDEX['minor-seventh']))
+                if submediant:
+                    code = 'DC'
+
+        # Cadência à dominante: V no estado fundamental, longo e num tempo forte,
+        # que não continua na dominante e não é ele próprio a preparação de
+        # uma chegada (harmonia seguinte mais curta, depois de pausa ou fora dos tempos fortes)
+        if code is None and degree[h] == 7 and quality[h] == QUALITY_INDEX['major'] \
+                and root_position[h] and strong[h] and duration[h] >= CADENCE_MIN_HALF:
+            following = h + 1
+            if following >= num_harmonies or not is_dominant(following, int(key_idx[following])) and (
+                    degree[following] not in (0, 8, 9) or not strong[following]
+                    or duration[following] < duration[h] or harmonies['start'][following] > harmonies['end'][h]):
+                code = 'HC'
+                departure = h
+
+        if code is None:
+            continue
+
+        cadence = {
+            'measure': measure[h],
+            'offset': float(harmonies['start'][h]),
+            'code': code,
+            'key': k,
+            'departure': int(harmonies['last'][departure]),
+            'arrival': int(harmonies['first'][h])
+        }
+        if cadences and measure[h] - cadences[-1]['measure'] < CADENCE_MIN_SPACING:
+            cadences[-1] = cadence
+        else:
+            cadences.append(cadence)
+
+    return cadences
+
+cadence_key_objects = {}
+
+def cadence_key_object(key_idx):
+    """music21 Key de um índice de KEY_NAMES (memoizado)."""
+    key_obj = cadence_key_objects.get(key_idx)
+    if key_obj is None:
+        tonic, mode = KEY_NAMES[key_idx].split(' ')
+        key_obj = key.Key(tonic, mode)
+        cadence_key_objects[key_idx] = key_obj
+    return key_obj
+
+# ========================================
+
+# ========================================
+# PHRASE SEGMENTATION
+# ========================================
+# Fronteiras de frase por parte, numa só passagem vetorizada sobre os
+# eventos (onsets) da parte. Cada fronteira candidata (entre dois eventos
+# seguidos) é pontuada por pausas, notas longas, saltos melódicos e pontos
+# de cadência; a pontuação é levada ao compasso onde o evento termina e as
+# frases fecham nos máximos locais acima do limiar.
+PHRASE_CUE_WEIGHTS = {'rest': 0.3, 'long_note': 0.2, 'cadence': 0.35, 'leap': 0.15}
+PHRASE_BOUNDARY_THRESHOLD = 0.3
+PHRASE_MIN_MEASURES = 2
+PHRASE_MAX_MEASURES = 16
+
+def part_onset_events(table, part_idx):
+    """
+    Eventos de uma parte: notas (ou acordes) com o mesmo onset formam um
+    evento; continuações de ligaduras prolongam o evento anterior.
+
+    Returns:
+        dict: arrays por evento - onset, end (fim da última nota a soar),
+              top (linha da nota atacada mais aguda), pitch (o seu MIDI) e measure
+    """
+    rows = table.time_ordered_rows(part_idx)
+    rows = rows[table.duration[rows] > 0]
+    attacks = rows[(table.tie[rows] & NoteTable.TIE_STOP) == 0]
+    onset = np.unique(table.offset[attacks])
+    if len(onset) == 0:
+        return None
+
+    # Cada linha pertence ao último evento que começou antes dela (ou nela)
+    event = np.maximum(np.searchsorted(onset, table.offset[rows], side='right') - 1, 0)
+    end = np.full(len(onset), -np.inf)
+    np.maximum.at(end, event, table.end[rows])
+    attack_event = np.searchsorted(onset, table.offset[attacks])
+    order = np.lexsort((table.midi[attacks], attack_event))
+    top = attacks[order][np.searchsorted(attack_event[order], np.arange(len(onset)), side='right') - 1]
+
+    # Sobreposições (várias vozes na parte): o fim de um evento é o maior fim até ele
+    end = np.maximum.accumulate(end)
+    measure = np.searchsorted(table.measure_offsets, onset, side='right') - 1
+    return {'onset': onset, 'end': end, 'top': top, 'pitch': table.midi[top].astype(np.int64),
+            'measure': np.maximum(measure, 0)}
+
+def phrase_boundary_scores(events, cadence_offsets):
+    """
+    Pontuação (0-1) de cada fronteira candidata depois do evento i, e
+    pistas que a formam.
+
+    Returns:
+        tuple: (scores (n,), cues dict nome -> (n,) valores 0-1); o último
+               evento (fim da parte) não tem fronteira candidata
+    """
+    onset, end, pitch = events['onset'], events['end'], events['pitch']
+    num_events = len(onset)
+    ioi = np.diff(onset, append=end[-1])
+    reference = max(float(np.median(ioi)), 1e-6)
+
+    gap = np.zeros(num_events)
+    gap[:-1] = np.maximum(onset[1:] - end[:-1], 0)
+    rest = np.minimum(gap / (2 * reference), 1.0)
+
+    # Nota longa: mudança relativa do intervalo entre onsets (maior que o anterior)
+    long_note = np.zeros(num_events)
+    long_note[1:] = np.clip(1 - ioi[:-1] / np.maximum(ioi[1:], 1e-6), 0, 1)
+
+    leap = np.zeros(num_events)
+    leap[:-1] = np.clip((np.abs(np.diff(pitch)) - 4) / 8, 0, 1)
+
+    # Cadência: fronteira depois do evento que soa na chegada
+    cadence = np.zeros(num_events)
+    if len(cadence_offsets):
+        at = np.searchsorted(onset, cadence_offsets, side='right') - 1
+        cadence[at[at >= 0]] = 1.0
+
+    cues = {'rest': rest, 'long_note': long_note, 'cadence': cadence, 'leap': leap}
+    scores = sum(PHRASE_CUE_WEIGHTS[name] * values for name, values in cues.items())
+    scores[-1] = 0
+    return scores, cues
+
+def segment_phrases(measure_scores, first_measure, last_measure):
+    """
+    Frases [start, end] (índices de compasso) a partir das pontuações por
+    compasso: fecham nos máximos locais acima de PHRASE_BOUNDARY_THRESHOLD,
+    com pelo menos PHRASE_MIN_MEASURES compassos; frases maiores que
+    PHRASE_MAX_MEASURES são cortadas no compasso de maior pontuação.
+    """
+    padded = np.concatenate([[-1.0], measure_scores, [-1.0]])
+    peaks = ((measure_scores >= PHRASE_BOUNDARY_THRESHOLD)
+             & (measure_scores >= padded[:-2]) & (measure_scores > padded[2:]))
+    candidates = np.flatnonzero(peaks).tolist()
+
+    phrases = []
+    start = first_measure
+    for m in candidates + [last_measure]:
+        if m < start + PHRASE_MIN_MEASURES - 1 or m > last_measure:
+            continue
+        while m - start + 1 > PHRASE_MAX_MEASURES:
+            window = measure_scores[start + PHRASE_MIN_MEASURES - 1:start + PHRASE_MAX_MEASURES]
+            cut = start + PHRASE_MIN_MEASURES - 1 + int(window.argmax())
+            phrases.append((start, cut))
+            start = cut + 1
+        if m >= start:
+            phrases.append((start, m))
+            start = m + 1
+
+    if start <= last_measure:
+        if phrases:
+            phrases[-1] = (phrases[-1][0], last_measure)
+        else:
+            phrases.append((start, last_measure))
+    return phrases
+
+def find_phrases(table, cadences=()):
+    """
+    Frases de cada parte da NoteTable.
+
+    Returns:
+        list: dicts com part, start, end (índices de compasso), score da
+              fronteira final e cues (pistas acima de 0.5 nessa fronteira)
+    """
+    cadence_offsets = np.array([c['offset'] for c in cadences], dtype=np.float64)
+    phrases = []
+    for part_idx in range(table.num_parts):
+        events = part_onset_events(table, part_idx)
+        if events is None:
+            continue
+
+        scores, cues = phrase_boundary_scores(events, cadence_offsets)
+        end_measure = np.searchsorted(table.measure_offsets, events['end'], side='left') - 1
+        end_measure = np.clip(end_measure, events['measure'], table.num_measures - 1)
+
+        # Pontuação de cada compasso: a melhor fronteira que termina nele
+        measure_scores = np.zeros(table.num_measures)
+        np.maximum.at(measure_scores, end_measure, scores)
+        best_event = np.full(table.num_measures, -1)
+        order = np.argsort(scores, kind='stable')
+        best_event[end_measure[order]] = order
+
+        for start, end in segment_phrases(measure_scores, int(events['measure'][0]), int(end_measure[-1])):
+            event = int(best_event[end])
+            phrases.append({
+                'part': part_idx,
+                'start': start,
+                'end': end,
+                'score': float(measure_scores[end]),
+                'cues': [name for name, values in cues.items() if event >= 0 and values[event] >= 0.5]
+            })
+    return phrases
+
+# ========================================
+
+# ========================================
+# VERTICAL INTERVALS (ONSET SWEEP LINE)
+# ========================================
+# Intervalos harmónicos entre todas as vozes ativas em cada onset, numa só
+# passagem sobre a NoteTable. Em cada onset contam-se os pares de notas a
+# soar em que pelo menos uma é atacada nesse instante (pares só de notas
+# sustentadas já foram contados no onset anterior).
+#
+# Os pares não são guardados (são quadráticos no número de vozes): só as
+# notas de cada onset, ordenadas por altura. Os histogramas por compasso e
+# por par de partes acumulam-se com bincount percorrendo os grupos por
+# diagonais (passo k: cada nota com a k-ésima nota acima dela no mesmo
+# onset), com memória linear no número de notas. Os pares de uma página de
+# eventos são gerados só para as notas graves dessa página, localizadas
+# pela contagem acumulada de pares dissonantes.
+DISSONANT_SEMITONES = (1, 2, 6, 10, 11)  # 2as, trítono, 7as
+DISSONANCE_PAGE_SIZE = 100
+DISSONANCE_MAX_PAGE_SIZE = 1000
+
+class VerticalIntervals:
+    """
+    Intervalos entre notas simultâneas (ver secção acima).
+
+    Notas de cada onset (ordenadas por onset e altura): row (linha da
+    NoteTable), group_end (fim do grupo do seu onset), attacked e measure.
+    Histogramas de classes de intervalo (0-11): histogram (total),
+    measure_histogram (num_measures, 12) e pair_histogram (num_parts,
+    num_parts, 12, par a <= b). dissonant_before[k] é o número de pares
+    dissonantes cuja nota grave vem antes da nota k (ordem dos eventos).
+    """
+
+    def __init__(self, table, onset, row, group_end, attacked, measure):
+        self.table = table
+        self.onset = onset
+        self.row = row
+        self.group_end = group_end
+        self.attacked = attacked
+        self.measure = measure
+
+        num_parts, num_measures = table.num_parts, table.num_measures
+        self.measure_histogram = np.zeros((num_measures, 12), dtype=np.int64)
+        self.pair_histogram = np.zeros((num_parts, num_parts, 12), dtype=np.int64)
+        dissonant_pairs = np.zeros(len(row), dtype=np.int64)
+
+        # Passo k: pares (nota, k-ésima nota mais aguda do mesmo onset)
+        midi = table.midi[row].astype(np.int64)
+        part = table.part[row].astype(np.int64)
+        low = np.flatnonzero(group_end - np.arange(len(row)) > 1)
+        step = 1
+        while len(low):
+            high = low + step
+            counted = attacked[low] | attacked[high]
+            pair_low, pair_high = low[counted], high[counted]
+            semitones = (midi[pair_high] - midi[pair_low]) % 12
+            a = np.minimum(part[pair_low], part[pair_high])
+            b = np.maximum(part[pair_low], part[pair_high])
+            self.pair_histogram += np.bincount((a * num_parts + b) * 12 + semitones,
+                                               minlength=num_parts * num_parts * 12).reshape(num_parts, num_parts, 12)
+            if num_measures:
+                self.measure_histogram += np.bincount(measure[pair_low] * 12 + semitones,
+                                                      minlength=num_measures * 12).reshape(-1, 12)
+            dissonant = np.isin(semitones, DISSONANT_SEMITONES)
+            dissonant_pairs += np.bincount(pair_low[dissonant], minlength=len(row))
+            step += 1
+            low = low[group_end[low] - low > step]
+
+        self.histogram = self.pair_histogram.sum(axis=(0, 1))
+        self.dissonant_before = np.concatenate(([0], np.cumsum(dissonant_pairs)))
+
+    def __len__(self):
+        return int(self.histogram.sum())
+
+    @property
+    def dissonant_count(self):
+        return int(self.dissonant_before[-1])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.onset, self.row, self.group_end, self.attacked, self.measure,
+                                      self.measure_histogram, self.pair_histogram, self.dissonant_before))
+
+    @classmethod
+    def from_note_table(cls, table):
+        """Agrupa por onset as notas a soar de todas as partes a partir da NoteTable."""
+        rows = np.flatnonzero(table.duration > 0)
+        attack = (table.tie[rows] & NoteTable.TIE_STOP) == 0
+        empty = np.zeros(0, dtype=np.int64)
+        onsets = np.unique(table.offset[rows[attack]])
+        if len(onsets) == 0:
+            return cls(table, np.zeros(0), empty, empty, np.zeros(0, dtype=bool), empty)
+
+        # Onsets [first, last) em que cada nota está a soar, expandidos em pares (onset, nota)
+        note_start = table.offset[rows]
+        first = np.searchsorted(onsets, note_start)
+        counts = np.searchsorted(onsets, table.end[rows]) - first
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        slot = np.repeat(first, counts) + (np.arange(counts.sum()) - run_starts)
+        active = np.repeat(rows, counts)
+        attacked = np.repeat(attack, counts) & (table.offset[active] == onsets[slot])
+
+        order = np.lexsort((table.midi[active], slot))
+        slot, active, attacked = slot[order], active[order], attacked[order]
+        group_end = np.searchsorted(slot, slot, side='right')
+
+        onset = onsets[slot]
+        measure = np.maximum(np.searchsorted(table.measure_offsets, onset, side='right') - 1, 0)
+        return cls(table, onset, active, group_end, attacked, measure)
+
+    def measure_histograms(self):
+        """Histogramas (num_measures, 12) das classes de intervalo por compasso."""
+        return self.measure_histogram
+
+    def part_pair_histograms(self):
+        """Histogramas (num_parts, num_parts, 12) por par de partes (a <= b)."""
+        return self.pair_histogram
+
+    def dissonant_pairs(self, start, stop):
+        """
+        Pares dissonantes [start, stop) pela ordem dos eventos (onset, nota
+        grave, nota aguda), gerados só para as notas graves dessa página.
+
+        Returns:
+            tuple: (low, high) índices das notas (não linhas da NoteTable)
+        """
+        stop = min(stop, self.dissonant_count)
+        if start >= stop:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        table = self.table
+        first = np.searchsorted(self.dissonant_before, start, side='right') - 1
+        last = np.searchsorted(self.dissonant_before, stop, side='left')
+        lows, highs = [], []
+        for low in range(first, last):
+            high = np.arange(low + 1, self.group_end[low])
+            if not self.attacked[low]:
+                high = high[self.attacked[high]]
+            semitones = (table.midi[self.row[high]].astype(np.int64) - table.midi[self.row[low]]) % 12
+            high = high[np.isin(semitones, DISSONANT_SEMITONES)]
+            lows.append(np.full(len(high), low, dtype=np.int64))
+            highs.append(high)
+
+        skip = start - int(self.dissonant_before[first])
+        low, high = np.concatenate(lows)[skip:], np.concatenate(highs)[skip:]
+        return low[:stop - start], high[:stop - start]
+
+    def dissonant_events(self, start, stop):
+        """Pares dissonantes [start, stop) (pela ordem dos onsets), como dicts."""
+        table = self.table
+        low_notes, high_notes = self.dissonant_pairs(start, stop)
+        low, high = self.row[low_notes], self.row[high_notes]
+        low_names = table.pitch_names(low, with_octave=True)
+        high_names = table.pitch_names(high, with_octave=True)
+        steps = (table.diatonic[high].astype(np.int64) - table.diatonic[low]).tolist()
+        semitones = (table.midi[high].astype(np.int64) - table.midi[low]).tolist()
+
+        events = []
+        for k, note in enumerate(low_notes.tolist()):
+            part_low, part_high = int(table.part[low[k]]), int(table.part[high[k]])
+            events.append({
+                'measure': int(self.measure[note]) + 1,
+                'offset': float(self.onset[note]),
+                'from': low_names[k],
+                'to': high_names[k],
+                'interval': interval_directed_name(steps[k], semitones[k]),
+                'instrument': table.part_names[part_low] or f'Part {part_low + 1}',
+                'other_instrument': table.part_names[part_high] or f'Part {part_high + 1}'
+            })
+        return events
+
+# ========================================
+
+# ========================================
+# VOICE LEADING (SHARED ONSET GRID)
+# ========================================
+# Cada parte é tratada como uma voz (a nota mais aguda que soa) e todas são
+# alinhadas na grelha comum dos onsets do score: uma matriz (partes, onsets)
+# de linhas da NoteTable (-1 em pausa). Quintas/oitavas paralelas verificam-se
+# entre todos os pares de partes e as diretas só entre as partes extremas;
+# cruzamentos, sobreposições e afastamento só entre partes vizinhas na ordem
+# da partitura (a de cima deve ser a mais aguda). Tudo em aritmética inteira
+# sobre os MIDI, com todos os pares de cada verificação tratados de uma vez.
+# As paralelas só se assinalam no início de cada trecho em que o par mantém
+# a quinta/oitava: uma dobragem conta uma vez e não em cada onset.
+VOICE_LEADING_ISSUES = {
+    'parallel_fifths': 'Parallel fifths',
+    'parallel_octaves': 'Parallel octaves',
+    'hidden_fifths': 'Hidden fifths',
+    'hidden_octaves': 'Hidden octaves',
+    'voice_crossing': 'Voice crossing',
+    'voice_overlap': 'Voice overlap',
+    'spacing': 'Spacing (> octave)'
+}
+VOICE_LEADING_MAX_SPACING = 12
+VOICE_LEADING_MAX_ISSUES = 500
+VOICE_LEADING_PAIR_BLOCK = 1 << 20  # Células (par de partes x onset) por bloco nas paralelas
+
+def voice_grid(table):
+    """
+    Alinha as partes na grelha comum de onsets.
+
+    Returns:
+        tuple: (grid (G,) onsets, voices (P, G) linhas da NoteTable da nota
+               mais aguda a soar em cada parte, -1 em pausa)
+    """
+    events = [part_onset_events(table, p) for p in range(table.num_parts)]
+    onsets = [e['onset'] for e in events if e is not None]
+    if not onsets:
+        return np.zeros(0), np.full((table.num_parts, 0), -1, dtype=np.int64)
+
+    grid = np.unique(np.concatenate(onsets))
+    voices = np.full((table.num_parts, len(grid)), -1, dtype=np.int64)
+    for p, e in enumerate(events):
+        if e is None:
+            continue
+        idx = np.searchsorted(e['onset'], grid, side='right') - 1
+        sounding = (idx >= 0) & (e['end'][np.maximum(idx, 0)] > grid)
+        voices[p, sounding] = e['top'][idx[sounding]]
+    return grid, voices
+
+def find_voice_leading_issues(table):
+    """
+    Problemas de condução de vozes entre partes, numa passagem sobre a grelha.
+
+    Returns:
+        dict: arrays por problema, por ordem de onset - kind (índice em
+              VOICE_LEADING_ISSUES), grid (índice do onset), upper e lower
+              (partes), upper_row e lower_row (linhas da NoteTable)
+    """
+    grid, voices = voice_grid(table)
+    num_parts = table.num_parts
+    kinds = list(VOICE_LEADING_ISSUES)
+    found = {'kind': [], 'grid': [], 'upper': [], 'lower': []}
+
+    midi = np.where(voices >= 0, table.midi[np.maximum(voices, 0)].astype(np.int64), -1)
+    sounding = voices >= 0
+    # Movimento entre o onset anterior e o atual (0 se a voz não soa em algum dos dois)
+    both = np.zeros_like(sounding)
+    both[:, 1:] = sounding[:, 1:] & sounding[:, :-1]
+    motion = np.zeros_like(midi)
+    motion[:, 1:] = np.where(both[:, 1:], midi[:, 1:] - midi[:, :-1], 0)
+
+    def add(kind, mask, upper, lower):
+        """mask (pares, onsets); upper e lower são as partes de cada linha."""
+        pair, at = np.nonzero(mask)
+        found['kind'].append(np.full(len(at), kinds.index(kind)))
+        found['grid'].append(at)
+        found['upper'].append(upper[pair])
+        found['lower'].append(lower[pair])
+
+    def shifted(mask):
+        """mask no onset anterior (False no primeiro)."""
+        previous = np.zeros_like(mask)
+        previous[:, 1:] = mask[:, :-1]
+        return previous
+
+    # Quintas/oitavas paralelas entre todos os pares de partes, em blocos de
+    # pares (VOICE_LEADING_PAIR_BLOCK células par x onset de cada vez)
+    pair_upper, pair_lower = np.triu_indices(num_parts, 1)
+    block = max(1, VOICE_LEADING_PAIR_BLOCK // max(len(grid), 1))
+    for start in range(0, len(pair_upper), block):
+        a, b = pair_upper[start:start + block], pair_lower[start:start + block]
+        interval_class = np.abs(midi[a] - midi[b]) % 12
+        # Movimento direto: as duas vozes movem-se no mesmo sentido
+        similar = both[a] & both[b] & (np.sign(motion[a]) == np.sign(motion[b])) & (motion[a] != 0)
+        for target, name in ((7, 'fifths'), (0, 'octaves')):
+            held = sounding[a] & sounding[b] & (interval_class == target)
+            parallel = similar & held & shifted(held)
+            # Só a primeira paralela de cada trecho em que o par mantém o
+            # intervalo: uma dobragem conta uma vez, não em cada onset
+            run = np.cumsum(~held, axis=1)
+            pair, at = np.nonzero(parallel)
+            run_start = np.ones(len(at), dtype=bool)
+            run_start[1:] = (pair[1:] != pair[:-1]) | (run[pair[1:], at[1:]] != run[pair[:-1], at[:-1]])
+            first = np.zeros_like(parallel)
+            first[pair[run_start], at[run_start]] = True
+            add(f'parallel_{name}', first, a, b)
+
+    # Quintas/oitavas diretas só entre as partes extremas
+    if num_parts > 1:
+        a, b = np.array([0]), np.array([num_parts - 1])
+        interval = midi[a] - midi[b]
+        interval_class = np.abs(interval) % 12
+        similar = both[a] & both[b] & (np.sign(motion[a]) == np.sign(motion[b])) & (motion[a] != 0)
+        # A voz de cima é a mais aguda das duas no onset atual
+        upper_motion = np.where(interval >= 0, motion[a], motion[b])
+        prev_class = shifted(np.abs(interval)) % 12
+        for target, name in ((7, 'fifths'), (0, 'octaves')):
+            arrives = similar & (interval_class == target)
+            add(f'hidden_{name}', arrives & (prev_class != target) & (np.abs(upper_motion) > 2), a, b)
+
+    # Partes vizinhas: cruzamento (início), sobreposição e afastamento (início);
+    # uníssonos que se movem juntos (dobragens) não contam como sobreposição
+    a = np.arange(num_parts - 1)
+    b = a + 1
+    interval = midi[a] - midi[b]
+    crossed = sounding[a] & sounding[b] & (midi[a] < midi[b])
+    add('voice_crossing', crossed & ~shifted(crossed), a, b)
+
+    doubled = (interval == 0) & (shifted(interval) == 0)
+    overlap = both[a] & both[b] & ~crossed & ~doubled & (((motion[b] != 0) & (midi[b] > shifted(midi[a])))
+                                                         | ((motion[a] != 0) & (midi[a] < shifted(midi[b]))))
+    add('voice_overlap', overlap, a, b)
+
+    wide = sounding[a] & sounding[b] & (midi[a] - midi[b] > VOICE_LEADING_MAX_SPACING)
+    wide[num_parts - 2:] = False  # a parte mais grave (baixo) pode afastar-se
+    add('spacing', wide & ~shifted(wide), a, b)
+
+    issues = {name: np.concatenate(arrays).astype(np.int64) if arrays else np.zeros(0, dtype=np.int64)
+              for name, arrays in found.items()}
+    order = np.lexsort((issues['kind'], issues['lower'], issues['upper'], issues['grid']))
+    issues = {name: values[order] for name, values in issues.items()}
+    issues['onset'] = grid[issues['grid']]
+    issues['upper_row'] = voices[issues['upper'], issues['grid']]
+    issues['lower_row'] = voices[issues['lower'], issues['grid']]
+    return issues
+
+# ========================================
+
+# ========================================
+# TEXTURE PROFILE
+# ========================================
+# Perfil de textura de todas as partes em caixas de tempo (compassos ou
+# tempos de semínima, agrupados bin_size a bin_size): número de notas,
+# onsets distintos, vozes ativas, âmbito registral e independência rítmica.
+# As caixas são um array ordenado de inícios; notas e onsets caem nelas por
+# searchsorted e as contagens são bincounts.
+TEXTURE_RESOLUTIONS = ('measure', 'beat')
+
+def texture_bin_starts(table, resolution='measure', bin_size=1):
+    """Inícios (quarterLength) das caixas de tempo do perfil de textura."""
+    if resolution == 'beat':
+        beats = np.ceil(table.measure_lengths - 1e-9).astype(np.int64)
+        measure_of_beat = np.repeat(np.arange(table.num_measures), beats)
+        beat_in_measure = np.arange(beats.sum()) - np.repeat(np.cumsum(beats) - beats, beats)
+        starts = table.measure_offsets[measure_of_beat] + beat_in_measure
+    else:
+        starts = table.measure_offsets
+    return starts[::bin_size]
+
+def texture_profile(table, resolution='measure', bin_size=1):
+    """
+    Perfil de textura do score inteiro.
+
+    Returns:
+        dict: arrays por caixa - start, measure (índice), note_count
+              (ataques), onsets, active_voices (partes a soar), span
+              (semitons entre a nota mais grave e a mais aguda a soar) e
+              independence (1 - partes que atacam por onset / vozes ativas)
+    """
+    starts = texture_bin_starts(table, resolution, bin_size)
+    num_bins = len(starts)
+    profile = {
+        'start': starts,
+        'measure': np.maximum(np.searchsorted(table.measure_offsets, starts, side='right') - 1, 0)
+    }
+    if num_bins == 0:
+        return profile
+
+    def bin_of(offsets, side='right'):
+        return np.clip(np.searchsorted(starts, offsets, side=side) - 1, 0, num_bins - 1)
+
+    rows = np.flatnonzero(table.duration > 0)
+    attacks = rows[(table.tie[rows] & NoteTable.TIE_STOP) == 0]
+    profile['note_count'] = np.bincount(bin_of(table.offset[attacks]), minlength=num_bins)
+
+    # Onsets distintos e número de partes que atacam em cada um
+    onset_parts = np.unique(np.stack([table.offset[attacks], table.part[attacks].astype(np.float64)]), axis=1)
+    onsets, parts_per_onset = np.unique(onset_parts[0], return_counts=True)
+    onset_bins = bin_of(onsets)
+    profile['onsets'] = np.bincount(onset_bins, minlength=num_bins)
+
+    # Notas a soar em cada caixa: expandidas em pares (caixa, nota)
+    first = bin_of(table.offset[rows])
+    last = np.maximum(bin_of(table.end[rows], side='left'), first)
+    counts = last - first + 1
+    run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    sounding_bin = np.repeat(first, counts) + (np.arange(counts.sum()) - run_starts)
+    sounding = np.repeat(rows, counts)
+
+    voice_codes = np.unique(sounding_bin * table.num_parts + table.part[sounding])
+    profile['active_voices'] = np.bincount(voice_codes // table.num_parts, minlength=num_bins)
+
+    midi = table.midi[sounding].astype(np.int64)
+    low = np.full(num_bins, 128)
+    high = np.full(num_bins, -1)
+    np.minimum.at(low, sounding_bin, midi)
+    np.maximum.at(high, sounding_bin, midi)
+    profile['span'] = np.maximum(high - low, 0)
+
+    attacking = np.bincount(onset_bins, weights=parts_per_onset, minlength=num_bins)
+    mean_attacking = attacking / np.maximum(profile['onsets'], 1)
+    voices = profile['active_voices']
+    profile['independence'] = np.where(voices > 1, 1 - mean_attacking / np.maximum(voices, 1), 0.0)
+    return profile
+
+# ========================================
+
+# ========================================
+# CHROMATICISM (LOCAL KEYS)
+# ========================================
+# Notas cromáticas medidas contra a tonalidade local de cada compasso
+# (measure_local_keys) e não contra a tonalidade global: a pertença à
+# escala é um teste de bits sobre a máscara de pitch classes da tonalidade.
+# Nas tonalidades menores a escala inclui o 6.º e o 7.º graus elevados.
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+MINOR_SCALE = (0, 2, 3, 5, 7, 8, 9, 10, 11)
+CHROMATIC_KEY_WINDOW = 8
+CHROMATIC_MIN_PASSAGE = 4           # notas seguidas numa passagem cromática
+CHROMATIC_MIN_PASSAGE_CHROMATIC = 2  # das quais cromáticas
+
+KEY_SCALE_MASKS = np.array([
+    sum(1 << ((tonic + step) % 12) for step in scale)
+    for scale in (MAJOR_SCALE, MINOR_SCALE)
+    for tonic in range(12)
+], dtype=np.int64)
+
+def true_runs(flags):
+    """Sequências de True seguidos (run-length encoding): (starts, lengths)."""
+    padded = np.concatenate([[False], flags, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[::2], edges[1::2] - edges[::2]
+
+def chromatic_rows(table, keys, rows):
+    """Máscara booleana: a nota de cada linha está fora da escala da tonalidade local do seu compasso."""
+    scale = KEY_SCALE_MASKS[np.maximum(keys[table.measure[rows]], 0)]
+    return ((scale >> table.pc[rows].astype(np.int64)) & 1) == 0
+
+def find_chromatic_passages(table, keys):
+    """
+    Passagens cromáticas da linha superior de cada parte: sequências (por
+    RLE) de notas cromáticas e das suas vizinhas à distância de meio tom,
+    com pelo menos CHROMATIC_MIN_PASSAGE notas e
+    CHROMATIC_MIN_PASSAGE_CHROMATIC cromáticas.
 
-def get_cached_score(file_path):
+    Returns:
+        list: dicts com part, start_measure, end_measure (índices), notes,
+              chromatic_notes e rows (linhas da NoteTable da passagem)
     """
-    Obtém score do cache ou faz parse e guarda no cache.
-    Evita múltiplas chamadas a converter.parse() para o mesmo ficheiro.
+    passages = []
+    for part_idx in range(table.num_parts):
+        events = part_onset_events(table, part_idx)
+        if events is None:
+            continue
+
+        chromatic = chromatic_rows(table, keys, events['top'])
+        semitone = np.abs(np.diff(events['pitch'])) == 1
+        linked = np.zeros(len(chromatic), dtype=bool)
+        linked[1:] |= semitone & chromatic[:-1]
+        linked[:-1] |= semitone & chromatic[1:]
+        chromatic_count = np.concatenate([[0], np.cumsum(chromatic)])
+
+        starts, lengths = true_runs(chromatic | linked)
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            end = start + length
+            count = int(chromatic_count[end] - chromatic_count[start])
+            if length < CHROMATIC_MIN_PASSAGE or count < CHROMATIC_MIN_PASSAGE_CHROMATIC:
+                continue
+            passages.append({
+                'part': part_idx,
+                'start_measure': int(events['measure'][start]),
+                'end_measure': int(events['measure'][end - 1]),
+                'notes': length,
+                'chromatic_notes': count,
+                'rows': events['top'][start:end]
+            })
+    return passages
+
+# ========================================
+
+# ========================================
+# PREFIX-SUM STATISTICS
+# ========================================
+# Histogramas por parte e por compasso (pitch class, altura, ortografia,
+# classe de duração, intervalo melódico), guardados como somas prefixas ao
+# longo dos compassos: as estatísticas de qualquer subconjunto de partes e
+# intervalo de compassos são uma diferença de duas linhas por parte.
+# Contam-se todas as notas atacadas (incluindo as de acordes); continuações
+# de ligaduras não são notas novas.
+INTERVAL_HISTOGRAM_LIMIT = 24  # intervalos maiores agrupados em +-24 semitons
+SPELLING_ALTERS = 5            # alterações de -2 (bb) a +2 (##)
+
+class ScoreHistograms:
+    """
+    Somas prefixas dos histogramas de uma NoteTable: para cada nome em
+    HISTOGRAMS, um array (partes, compassos + 1, bins) cuja linha m é a soma
+    dos compassos [0, m). pitch começa em pitch_base (a nota mais grave).
+    """
+    HISTOGRAMS = ('pc', 'pc_duration', 'pitch', 'spelling', 'duration_class', 'interval')
+
+    def __init__(self, table, pitch_base, prefix):
+        self.table = table
+        self.pitch_base = pitch_base
+        self.prefix = prefix
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.prefix.values())
+
+    @classmethod
+    def from_note_table(cls, table):
+        """Constrói os histogramas de todas as partes a partir da NoteTable."""
+        num_parts, num_measures = table.num_parts, max(table.num_measures, 1)
+        rows = np.flatnonzero((table.duration > 0) & ((table.tie & NoteTable.TIE_STOP) == 0))
+        midi = table.midi[rows].astype(np.int64)
+        measure = np.minimum(table.measure[rows], num_measures - 1)
+        pitch_base = int(midi.min()) if len(rows) else 0
+
+        # Intervalos melódicos entre eventos seguidos da linha superior de cada parte
+        interval_part, interval_measure, interval_bins = [], [], []
+        for part_idx in range(num_parts):
+            events = part_onset_events(table, part_idx)
+            if events is None or len(events['pitch']) < 2:
+                continue
+            steps = np.clip(np.diff(events['pitch']), -INTERVAL_HISTOGRAM_LIMIT, INTERVAL_HISTOGRAM_LIMIT)
+            interval_part.append(np.full(len(steps), part_idx))
+            interval_measure.append(np.minimum(events['measure'][1:], num_measures - 1))
+            interval_bins.append(steps + INTERVAL_HISTOGRAM_LIMIT)
+
+        spelling = ((table.diatonic[rows].astype(np.int64) - 1) % 7 * SPELLING_ALTERS
+                    + np.clip(np.round(table.alter[rows]).astype(np.int64), -2, 2) + 2)
+        sources = {
+            'pc': (table.part[rows], measure, table.pc[rows], None, 12),
+            'pc_duration': (table.part[rows], measure, table.pc[rows], table.duration[rows], 12),
+            'pitch': (table.part[rows], measure, midi - pitch_base, None,
+                      int(midi.max()) - pitch_base + 1 if len(rows) else 1),
+            'spelling': (table.part[rows], measure, spelling, None, 7 * SPELLING_ALTERS),
+            'duration_class': (table.part[rows], measure,
+                               np.digitize(table.duration[rows], RHYTHM_VALUE_BINS), None, len(RHYTHM_VALUE_NAMES)),
+            'interval': (np.concatenate(interval_part) if interval_part else np.zeros(0, dtype=np.int64),
+                         np.concatenate(interval_measure) if interval_measure else np.zeros(0, dtype=np.int64),
+                         np.concatenate(interval_bins) if interval_bins else np.zeros(0, dtype=np.int64),
+                         None, 2 * INTERVAL_HISTOGRAM_LIMIT + 1)
+        }
+
+        prefix = {}
+        for name, (part, part_measure, bins, weights, num_bins) in sources.items():
+            codes = (part.astype(np.int64) * num_measures + part_measure) * num_bins + bins
+            counts = np.bincount(codes, weights=weights, minlength=num_parts * num_measures * num_bins)
+            counts = counts.reshape(num_parts, num_measures, num_bins)
+            if weights is None:
+                counts = counts.astype(np.int32)
+            prefix[name] = np.concatenate([np.zeros((num_parts, 1, num_bins), dtype=counts.dtype),
+                                           np.cumsum(counts, axis=1, dtype=counts.dtype)], axis=1)
+        return cls(table, pitch_base, prefix)
+
+    def query(self, parts, start, end):
+        """Histogramas somados das partes indicadas nos compassos [start, end) (índices)."""
+        parts = list(parts)
+        return {name: (prefix[parts, end] - prefix[parts, start]).sum(axis=0)
+                for name, prefix in self.prefix.items()}
+
+def histogram_entropy(histogram):
+    """Entropia de Shannon (bits) de um histograma."""
+    total = histogram.sum()
+    if total <= 0:
+        return 0.0
+    p = histogram[histogram > 0] / total
+    return float(-(p * np.log2(p)).sum())
+
+# ========================================
+
+# ========================================
+# SYMMETRY ENGINE
+# ========================================
+# Transformações de uma sequência de pitch classes x, cada uma com um
+# índice n/k em 0-11:
+#   retrograde            x[i] == x[j] + n        (T_nR)
+#   inversion             x[i] == k - x[j]        (T_kI, eixo em k/2)
+#   retrograde_inversion  x[i] == k - x[j']       (RT_kI)
+# Na sequência completa j = i e j' = N-1-i; nos segmentos, um segmento A
+# é comparado com o segmento B que se lhe segue (B = transformação de A).
+SYMMETRY_TRANSFORMATIONS = ('retrograde', 'inversion', 'retrograde_inversion')
+SYMMETRY_SEGMENT_LENGTH = 8
+SYMMETRY_MAX_SEGMENTS = 5
+SYMMETRY_MIN_SEGMENT_SCORE = 75.0
+
+def symmetry_operator(transformation, index):
+    """Nome do operador (ex.: 'T3R', 'T5I', 'RT5I')."""
+    if transformation == 'retrograde':
+        return 'R' if index == 0 else f'T{index}R'
+    if transformation == 'inversion':
+        return f'T{index}I'
+    return f'RT{index}I'
+
+def symmetry_match_masks(pcs, inversion_index):
+    """
+    Notas da sequência completa que coincidem com o seu retrógrado, a sua
+    inversão e a sua retrógrada-inversão (eixo dado por inversion_index).
+    """
+    reversed_pcs = pcs[::-1]
+    return {
+        'retrograde': pcs == reversed_pcs,
+        'inversion': pcs == (inversion_index - pcs) % 12,
+        'retrograde_inversion': pcs == (inversion_index - reversed_pcs) % 12
+    }
+
+def symmetry_profiles(pcs):
+    """
+    Percentagem de notas da sequência completa que coincidem com cada
+    transformação, para os 12 índices de transposição/eixo.
+
+    Returns:
+        dict: transformation -> np.ndarray (12,)
+    """
+    reversed_pcs = pcs[::-1]
+    differences = {
+        'retrograde': (pcs - reversed_pcs) % 12,
+        'inversion': (2 * pcs) % 12,
+        'retrograde_inversion': (pcs + reversed_pcs) % 12
+    }
+    return {name: np.bincount(values, minlength=12) * 100.0 / len(pcs) for name, values in differences.items()}
+
+def symmetry_window_counts(pcs, segment_length):
+    """
+    Coincidências entre cada segmento A = pcs[s:s+L] e o segmento seguinte
+    B = pcs[s+L:s+2L], para todas as transformações e os 12 índices, numa
+    só passagem (L = segment_length).
+
+    Returns:
+        tuple: (starts, counts) - counts[transformation] tem forma (len(starts), 12)
+    """
+    length = segment_length
+    starts = np.arange(max(len(pcs) - 2 * length + 1, 0))
+    counts = {name: np.zeros((len(starts), 12), dtype=np.int32) for name in SYMMETRY_TRANSFORMATIONS}
+    if len(starts) == 0:
+        return starts, counts
+
+    # Inversão: B[i] + A[i] = pcs[t + L] + pcs[t], somado em janelas por somas prefixas
+    sums = (pcs[length:] + pcs[:-length]) % 12
+    prefix = np.vstack([np.zeros((1, 12), dtype=np.int32), np.cumsum(np.eye(12, dtype=np.int32)[sums], axis=0)])
+    counts['inversion'] = prefix[starts + length] - prefix[starts]
+
+    # Retrógrados: B[i] contra A[L-1-i], pares à volta do ponto s + L
+    rows = np.arange(len(starts))
+    for i in range(length):
+        later = pcs[starts + length + i]
+        earlier = pcs[starts + length - 1 - i]
+        counts['retrograde'][rows, (later - earlier) % 12] += 1
+        counts['retrograde_inversion'][rows, (later + earlier) % 12] += 1
+
+    return starts, counts
+
+def best_symmetry_segments(pcs, measures, segment_length=SYMMETRY_SEGMENT_LENGTH,
+                           max_segments=SYMMETRY_MAX_SEGMENTS, min_score=SYMMETRY_MIN_SEGMENT_SCORE):
+    """
+    Melhores pares de segmentos (A seguido de uma transformação de A), sem
+    sobreposição, para cada transformação.
 
     Args:
-        file_path: Caminho para ficheiro MusicXML
+        pcs: np.ndarray de pitch classes
+        measures: np.ndarray com o número de compasso de cada nota
+        segment_length: Comprimento L (em notas) de cada segmento
+        max_segments: Máximo de resultados por transformação
+        min_score: Percentagem mínima de coincidências
 
     Returns:
-        music21.stream.Score: Score parseado
+        list: [{'transformation', 'operator', 'index', 'score', 'start_note',
+                'length', 'start_measure', 'pivot_measure', 'end_measure'}]
+    """
+    starts, counts = symmetry_window_counts(pcs, segment_length)
+    segments = []
+    if len(starts) == 0:
+        return segments
+
+    rows = np.arange(len(starts))
+    for name in SYMMETRY_TRANSFORMATIONS:
+        best_index = counts[name].argmax(axis=1)
+        best_score = counts[name][rows, best_index] * 100.0 / segment_length
+        taken = np.zeros(len(pcs), dtype=bool)
+        found = 0
+
+        for start in np.argsort(-best_score, kind='stable').tolist():
+            if found >= max_segments or best_score[start] < min_score:
+                break
+            span = slice(start, start + 2 * segment_length)
+            if taken[span].any():
+                continue
+            taken[span] = True
+            found += 1
+            index = int(best_index[start])
+            segments.append({
+                'transformation': name,
+                'operator': symmetry_operator(name, index),
+                'index': index,
+                'score': round(float(best_score[start]), 2),
+                'start_note': start,
+                'length': segment_length,
+                'start_measure': int(measures[start]),
+                'pivot_measure': int(measures[start + segment_length]),
+                'end_measure': int(measures[start + 2 * segment_length - 1])
+            })
 
-    Raises:
-        Exception: Se falhar o parsing
+    return segments
+
+def symmetry_measures(measures, mask):
+    """Compassos (ordenados, sem o compasso 0) das notas selecionadas por mask."""
+    selected = np.unique(measures[mask])
+    return selected[selected != 0].tolist()
+
+# ========================================
+
+# ========================================
+# TWELVE-TONE ROWS
+# ========================================
+# As 48 formas de uma série P0: P_n, I_n (I0 começa na mesma nota que P0),
+# R_n = retrógrado de P_n e RI_n = retrógrado de I_n. Uma sequência de 12
+# pitch classes é codificada como um inteiro em base 12 para procurar a
+# forma com searchsorted.
+ROW_FORM_TYPES = ('P', 'I', 'R', 'RI')
+ROW_CODE_WEIGHTS = 12 ** np.arange(11, -1, -1, dtype=np.int64)
+AGGREGATE_MASK = (1 << 12) - 1
+
+def build_row_forms(prime):
     """
-    with score_cache_lock:
-        if file_path in score_cache:
-            score, timestamp = score_cache[file_path]
-            if time.time() - timestamp < CACHE_EXPIRY:
-                print(f"[CACHE HIT] Using cached score for {file_path}")
-                return score
-            else:
-                # Expirado, remover
-                print(f"[CACHE EXPIRED] Removing expired cache for {file_path}")
-                del score_cache[file_path]
+    Formas de uma série.
 
-        # Parse e guardar no cache
-        print(f"[CACHE MISS] Parsing and caching {file_path}")
-        score = converter.parse(file_path)
-        score_cache[file_path] = (score, time.time())
-        return score
+    Returns:
+        np.ndarray: (48, 12) - linha t * 12 + n é a forma ROW_FORM_TYPES[t] com índice n
+    """
+    prime = np.asarray(prime, dtype=np.int64)
+    inversion = (2 * prime[0] - prime) % 12
+    transpositions = np.arange(12)[:, None]
+    primes = (prime[None, :] + transpositions) % 12
+    inversions = (inversion[None, :] + transpositions) % 12
+    return np.concatenate([primes, inversions, primes[:, ::-1], inversions[:, ::-1]])
+
+def build_row_form_index(prime):
+    """Índice das 48 formas: (códigos ordenados, labels correspondentes)."""
+    codes = build_row_forms(prime) @ ROW_CODE_WEIGHTS
+    labels = [f"{form_type}{n}" for form_type in ROW_FORM_TYPES for n in range(12)]
+    # Séries simétricas repetem formas: fica o primeiro label de cada código
+    codes, first = np.unique(codes, return_index=True)
+    return codes, [labels[i] for i in first]
+
+def part_row_sequence(table, part_idx):
+    """
+    Pitch classes de uma parte por ordem temporal, sem repetições imediatas
+    da mesma pitch class (que não contam como novas notas da série).
 
-def clear_expired_cache():
-    """Limpar entradas expiradas do cache."""
-    with score_cache_lock:
-        expired_keys = [
-            k for k, (_, timestamp) in score_cache.items()
-            if time.time() - timestamp >= CACHE_EXPIRY
-        ]
-        for key in expired_keys:
-            print(f"[CACHE CLEANUP] Removing expired cache for {key}")
-            del score_cache[key]
+    Returns:
+        tuple: (pcs, rows) - rows são as linhas correspondentes da NoteTable
+    """
+    rows = table.time_ordered_rows(part_idx)
+    pcs = table.pc[rows].astype(np.int64)
+    keep = np.ones(len(pcs), dtype=bool)
+    keep[1:] = pcs[1:] != pcs[:-1]
+    return pcs[keep], rows[keep]
 
-        if expired_keys:
-            print(f"[CACHE CLEANUP] Removed {len(expired_keys)} expired entries")
+def find_aggregates(pcs):
+    """
+    Inícios das janelas de 12 notas seguidas com as 12 pitch classes
+    (máscara de 12 bits deslizante).
+
+    Returns:
+        tuple: (starts, windows) - windows tem forma (len(starts), 12)
+    """
+    if len(pcs) < 12:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 12), dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(pcs, 12)
+    masks = np.bitwise_or.reduce(np.left_shift(1, windows), axis=1)
+    starts = np.flatnonzero(masks == AGGREGATE_MASK)
+    return starts, windows[starts]
+
+def detect_tone_row(table):
+    """
+    Série principal de um score: entre todos os agregados completos de
+    todas as partes, a classe de série (as 48 formas) mais frequente; P0 é a
+    primeira ocorrência dessa classe.
+
+    Returns:
+        tuple: (prime, aggregates) - prime é uma lista de 12 pitch classes
+               (ou None); aggregates[part_idx] = (starts, windows, rows)
+    """
+    aggregates = {}
+    candidates = []
+    for part_idx in range(table.num_parts):
+        pcs, rows = part_row_sequence(table, part_idx)
+        starts, windows = find_aggregates(pcs)
+        aggregates[part_idx] = (starts, windows, rows)
+        for start, window in zip(starts.tolist(), windows):
+            candidates.append((float(table.offset[rows[start]]), part_idx, window))
+
+    if not candidates:
+        return None, aggregates
+
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1]))
+    windows = np.array([window for _, _, window in candidates])
+
+    # Classe de cada agregado: o menor código entre as suas 48 formas
+    inversions = (2 * windows[:, :1] - windows) % 12
+    transpositions = np.arange(12)[None, :, None]
+    forms = np.concatenate([
+        (windows[:, None, :] + transpositions) % 12,
+        (inversions[:, None, :] + transpositions) % 12
+    ], axis=1)
+    forms = np.concatenate([forms, forms[:, :, ::-1]], axis=1)
+    classes = (forms @ ROW_CODE_WEIGHTS).min(axis=1)
+
+    unique_classes, first_index, counts = np.unique(classes, return_index=True, return_counts=True)
+    # Mais frequente; em caso de empate, a que aparece primeiro
+    best = np.lexsort((first_index, -counts))[0]
+    return windows[first_index[best]].tolist(), aggregates
+
+def find_row_forms(table):
+    """
+    Formas da série principal em todas as partes, em tempo linear por parte:
+    cada agregado é procurado no índice das 48 formas e os reconhecidos são
+    escolhidos da esquerda para a direita, sobrepondo-se no máximo numa nota.
+
+    Returns:
+        dict: {'prime_row', 'segments': [{'part', 'part_index', 'form',
+               'start_measure', 'end_measure', 'start_offset', 'end_offset'}],
+               'aggregate_count'}
+    """
+    prime, aggregates = detect_tone_row(table)
+    result = {
+        'prime_row': prime,
+        'segments': [],
+        'aggregate_count': sum(len(starts) for starts, _, _ in aggregates.values())
+    }
+    if prime is None:
+        return result
+
+    index_codes, index_labels = build_row_form_index(prime)
+    for part_idx, (starts, windows, rows) in aggregates.items():
+        if len(starts) == 0:
+            continue
+        codes = windows @ ROW_CODE_WEIGHTS
+        positions = np.minimum(np.searchsorted(index_codes, codes), len(index_codes) - 1)
+        matched = np.flatnonzero(index_codes[positions] == codes)
+
+        part_name = table.part_names[part_idx] or f"Part {part_idx + 1}"
+        next_free = 0
+        for i in matched.tolist():
+            start = int(starts[i])
+            if start < next_free:
+                continue
+            # Formas seguidas podem partilhar a nota de ligação (elisão)
+            next_free = start + 11
+            first_row, last_row = rows[start], rows[start + 11]
+            result['segments'].append({
+                'part': part_name,
+                'part_index': part_idx,
+                'form': index_labels[positions[i]],
+                'start_measure': int(table.measure_numbers[table.measure[first_row]]),
+                'end_measure': int(table.measure_numbers[table.measure[last_row]]),
+                'start_offset': float(table.offset[first_row]),
+                'end_offset': float(table.offset[last_row])
+            })
+
+    result['segments'].sort(key=lambda segment: (segment['start_offset'], segment['part_index']))
+    return result
+
+def row_form_timeline(table, segments):
+    """
+    Formas da série ativas em cada compasso.
+
+    Returns:
+        list: [{'measure': int, 'forms': [{'part': str, 'form': str}]}], só
+              com os compassos onde há formas
+    """
+    timeline = {}
+    for segment in segments:
+        first, last = (np.searchsorted(table.measure_offsets, [segment['start_offset'], segment['end_offset']],
+                                       side='right') - 1).tolist()
+        for measure_idx in range(max(first, 0), last + 1):
+            timeline.setdefault(measure_idx, []).append({'part': segment['part'], 'form': segment['form']})
+    return [
+        {'measure': int(table.measure_numbers[measure_idx]), 'forms': forms}
+        for measure_idx, forms in sorted(timeline.items())
+    ]
+
+# ========================================
+
+# ========================================
+# MELODIC ANALYSIS HELPERS
+# ========================================
+# Classes de duração do relatório: np.digitize(quarterLength, RHYTHM_VALUE_BINS)
+# dá o índice em RHYTHM_VALUE_NAMES.
+RHYTHM_VALUE_BINS = [0.25, 0.5, 1.0, 2.0, 4.0]
+RHYTHM_VALUE_NAMES = ["Smaller value", "Sixteenth Note", "Eighth Note", "Quarter Note", "Half Note", "Whole Note"]
+
+# (passos diatónicos, semitons) -> Interval.directedName
+interval_name_table = {}
+
+def interval_directed_name(diatonic_steps, semitones):
+    """Nome de um intervalo (como Interval.directedName) a partir dos passos diatónicos e semitons."""
+    name = interval_name_table.get((diatonic_steps, semitones))
+    if name is None:
+        generic = diatonic_steps + 1 if diatonic_steps >= 0 else diatonic_steps - 1
+        name = interval.intervalFromGenericAndChromatic(
+            interval.GenericInterval(generic),
+            interval.ChromaticInterval(semitones)
+        ).directedName
+        interval_name_table[(diatonic_steps, semitones)] = name
+    return name
+
+def build_interval_name_table(max_steps=21, max_alteration=3):
+    """Pré-calcula os nomes dos intervalos até max_steps passos diatónicos (3 oitavas)."""
+    for steps in range(-max_steps, max_steps + 1):
+        nominal = round(steps * 12 / 7)
+        for semitones in range(nominal - max_alteration, nominal + max_alteration + 1):
+            interval_directed_name(steps, semitones)
+
+build_interval_name_table()
+
+def lookup_interval_names(diatonic_steps, semitones):
+    """
+    Nomes dos intervalos para arrays de passos diatónicos e semitons.
+
+    Returns:
+        tuple: (codes, names) - codes[i] é o índice em names do intervalo i
+    """
+    pairs = np.stack([diatonic_steps, semitones], axis=1)
+    unique_pairs, codes = np.unique(pairs, axis=0, return_inverse=True)
+    names = [interval_directed_name(steps, semis) for steps, semis in unique_pairs.tolist()]
+    return codes.reshape(-1), names
+
+def most_common_codes(codes, labels):
+    """
+    Contagem de códigos como dict(Counter(...).most_common()): por contagem
+    decrescente e, em caso de empate, pela ordem da primeira ocorrência.
+    Códigos diferentes com o mesmo label são somados.
+    """
+    if len(codes) == 0:
+        return {}
+    unique_codes, first_index, counts = np.unique(codes, return_index=True, return_counts=True)
+
+    merged = {}
+    for idx in np.argsort(first_index, kind='stable').tolist():
+        label = labels[unique_codes[idx]]
+        merged[label] = merged.get(label, 0) + int(counts[idx])
+    return dict(sorted(merged.items(), key=lambda item: -item[1]))
+
+# ========================================
+
+# ========================================
+# MUSICXML EXPORT
+# ========================================
+# Exportação para MusicXML em memória (GeneralObjectExporter, o mesmo que
+# stream.write('musicxml') usa), sem escrever e voltar a ler um ficheiro
+# temporário. Os excertos exportados ficam num cache LRU indexado por
+# (score, tipo de excerto, partes, compassos): voltar a pedir os mesmos
+# compassos nas vistas de pautas não repete trabalho.
+EXCERPT_CACHE_MAX_BYTES = int(os.environ.get('MIAL_EXCERPT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+excerpt_cache = OrderedDict()  # (score_key, kind, parts, measures) -> excerpt (ordem LRU)
+excerpt_cache_lock = Lock()
+excerpt_cache_bytes = 0
+
+def export_musicxml(obj):
+    """MusicXML (str) de um Score/Part do music21, gerado em memória."""
+    return GeneralObjectExporter(obj).parse().decode('utf-8')
+
+def get_musicxml_excerpt(file_path, kind, parts, measures, build):
+    """
+    Excerto exportado de um score, construído com build() na primeira vez.
+
+    Args:
+        file_path: Caminho para ficheiro MusicXML
+        kind: Tipo de excerto ('instrument', 'combined', 'staff')
+        parts: Índices das partes, pela ordem do pedido
+        measures: Compassos do excerto (intervalo ou lista; None = todos)
+        build: Função que devolve um dict com pelo menos 'musicxml'
+
+    Returns:
+        dict: O valor devolvido por build()
+    """
+    global excerpt_cache_bytes
+    cache_key = (get_file_hash(file_path), kind, tuple(parts), measures)
+
+    with excerpt_cache_lock:
+        excerpt = excerpt_cache.get(cache_key)
+        if excerpt is not None:
+            excerpt_cache.move_to_end(cache_key)
+            return excerpt
+
+    excerpt = build()
+    size = len(excerpt['musicxml'])
+
+    with excerpt_cache_lock:
+        if cache_key not in excerpt_cache and size <= EXCERPT_CACHE_MAX_BYTES:
+            excerpt_cache[cache_key] = excerpt
+            excerpt_cache_bytes += size
+            while excerpt_cache_bytes > EXCERPT_CACHE_MAX_BYTES:
+                _, evicted = excerpt_cache.popitem(last=False)
+                excerpt_cache_bytes -= len(evicted['musicxml'])
+    return excerpt
 # ========================================
 
 # ========================================
@@ -123,9 +2821,15 @@ def calculate_gaps(measure_numbers):
         'total_measures': len(sorted_measures)
     }
 
+# Máximo de compassos por excerto quando o ficheiro não é partwise (parse e
+# export completos com music21); o corte direto do XML não tem limite
+FALLBACK_MAX_MEASURES = 50
+
 def extract_measures_from_musicxml(file_path, measure_numbers, part_index=0):
     """
-    Extrai compassos específicos de um MusicXML usando music21.
+    Extrai compassos específicos de um MusicXML: cortados diretamente do XML
+    original (slice_measures_from_musicxml) ou, se o ficheiro não for
+    partwise, com music21.
 
     Args:
         file_path: Caminho para ficheiro MusicXML
@@ -136,65 +2840,1057 @@ def extract_measures_from_musicxml(file_path, measure_numbers, part_index=0):
         str: MusicXML trimado com compassos selecionados
 
     Raises:
-        ValueError: Se measure_numbers inválido ou part_index fora do range
+        ValueError: Se measure_numbers inválido, part_index fora do range ou
+            mais de FALLBACK_MAX_MEASURES compassos sem corte direto do XML
         FileNotFoundError: Se file_path não existe
     """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
 
-    if not measure_numbers or not isinstance(measure_numbers, list):
-        raise ValueError("measure_numbers must be a non-empty list")
+    if not measure_numbers or not isinstance(measure_numbers, list):
+        raise ValueError("measure_numbers must be a non-empty list")
+
+    measures = tuple(sorted(set(measure_numbers)))  # Ordenar e remover duplicados
+
+    if get_part_index(file_path) is not None:
+        return get_musicxml_excerpt(file_path, 'staff', [part_index], measures, lambda: {
+            'musicxml': slice_measures_from_musicxml(file_path, measure_numbers, part_index)
+        })['musicxml']
+
+    if len(measures) > FALLBACK_MAX_MEASURES:
+        raise ValueError(f"Too many measures (max {FALLBACK_MAX_MEASURES})")
+
+    # Só a parte pedida (do score completo)
+    target_part = get_part_score(file_path, part_index)
+
+    # Validar números de compassos
+    total_measures = get_score_metadata(file_path)['total_measures']
+    invalid_measures = [m for m in measure_numbers if m < 1 or m > total_measures]
+    if invalid_measures:
+        raise ValueError(f"Invalid measure numbers {invalid_measures}. Valid range: 1-{total_measures}")
+
+    def build():
+        # Criar novo score apenas com o part selecionado
+        new_score = stream.Score()
+        new_part = stream.Part()
+
+        # Copiar metadata do part original. O score é partilhado (cache) por
+        # todos os pedidos: inserir os seus objetos noutro stream alteraria
+        # os sites/activeSite que outras threads estão a percorrer, por
+        # isso só entram cópias
+        new_part.partName = target_part.partName
+        for element in target_part.getElementsByClass(['Instrument', 'Clef', 'KeySignature', 'TimeSignature']):
+            if element.offset == 0:  # Elementos iniciais
+                new_part.insert(0, copy.deepcopy(element))
+
+        # Extrair compassos solicitados
+        all_measures = target_part.getElementsByClass('Measure')
+        for measure_num in measures:
+            if 1 <= measure_num <= len(all_measures):
+                measure = all_measures[measure_num - 1]  # Índice começa em 0
+                new_part.append(copy.deepcopy(measure))
+
+        new_score.append(new_part)
+
+        # Converter para MusicXML string (em memória)
+        return {'musicxml': export_musicxml(new_score)}
+
+    return get_musicxml_excerpt(file_path, 'staff', [part_index], measures, build)['musicxml']
+
+# ========================================
+
+# ========================================
+# MUSICXML METADATA SCANNER
+# ========================================
+# Título, partes, número de compassos e fórmulas de compasso lidos numa só
+# passagem em streaming (iterparse) sobre o XML, sem music21: é o que o
+# /upload devolve de imediato. O parse completo, a NoteTable, a tonalidade
+# e as cadências são preparados em background (start_preanalysis) e os
+# pedidos seguintes encontram-nos no cache de scores.
+SCORE_METADATA_MAX_ENTRIES = 256
+score_metadata_cache = OrderedDict()  # score_key -> metadata (ordem LRU)
+score_metadata_lock = Lock()
+
+# Elementos cujo atributo number indica a pauta (como no music21)
+STAFF_NUMBER_TAGS = ('clef', 'key', 'time', 'transpose', 'staff-details', 'staff-layout', 'measure-style')
+
+def clean_xml_text(text):
+    """
+    Texto de um elemento como o music21 o lê (sem espaços nas pontas, sem
+    quebras de linha); None se o elemento não existir ou estiver vazio.
+    """
+    return text.strip().replace('\n', ' ') if text else None
+
+def score_part_name(score_part):
+    """
+    Nome de um <score-part> como o music21 o dá a Part.partName: part-name,
+    senão o instrument-name, senão o nome do instrumento do programa MIDI.
+    """
+    name = clean_xml_text(score_part.findtext('part-name'))
+    if name is None:
+        name = clean_xml_text(score_part.findtext('score-instrument/instrument-name'))
+    if name is None:
+        midi = score_part.find('midi-instrument')
+        try:
+            if midi is not None and (midi.findtext('midi-unpitched') or '').strip():
+                name = PercussionMapper().midiPitchToInstrument(max(int(midi.findtext('midi-unpitched')) - 1, 0)).instrumentName
+            elif midi is not None and (midi.findtext('midi-program') or '').strip():
+                name = instrument.instrumentFromMidiProgram(max(int(midi.findtext('midi-program')) - 1, 0)).instrumentName
+        except Exception:
+            name = None
+    return name
+
+def scan_musicxml_metadata(file_path):
+    """
+    Lê os metadados de um MusicXML (partwise ou timewise) com iterparse,
+    libertando cada compasso depois de lido.
+
+    As partes seguem a numeração do music21: um <part> com várias pautas
+    (piano, harpa, órgão) dá uma PartStaff por pauta usada, todas com o
+    nome da parte.
+
+    Returns:
+        dict: title, part_names (como Part.partName, ou 'Part N', uma por
+              parte do music21), part_staves (de cada <part>, pela ordem
+              do ficheiro, o número da pauta de cada uma das suas partes do
+              music21, ou (None,) se não for dividido; None se timewise),
+              total_measures (compassos da primeira parte), time_signatures
+              (ratioString distintas, por ordem) e first_time_signature
+              ((numerador, denominador) ou None)
+    """
+    credit_title = None
+    work_title = None
+    score_part_names = {}
+    score_part_order = []
+    part_ids = []
+    part_staves = []
+    max_staves = 1
+    staff_numbers = set()
+    total_measures = 0
+    time_signatures = []
+    first_time_signature = None
+    timewise = False
+
+    for event, elem in ET.iterparse(file_path, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'part' and not timewise:
+                part_ids.append(elem.get('id'))
+                max_staves = 1
+                staff_numbers = set()
+            elif tag == 'score-timewise':
+                timewise = True
+            continue
+
+        if tag == 'score-part':
+            score_part_names[elem.get('id')] = score_part_name(elem)
+            score_part_order.append(elem.get('id'))
+        elif tag == 'credit' and credit_title is None:
+            if elem.findtext('credit-type') == 'title':
+                credit_title = elem.findtext('credit-words')
+        elif tag in ('work-title', 'movement-title') and work_title is None:
+            work_title = elem.text
+        elif tag == 'staves' and (elem.text or '').strip().isdigit():
+            max_staves = max(max_staves, int(elem.text))
+        elif tag == 'staff' and (elem.text or '').strip().isdigit():
+            staff_numbers.add(int(elem.text))
+        elif tag == 'measure':
+            if timewise or len(part_ids) == 1:
+                total_measures += 1
+            elem.clear()
+        elif tag == 'part' and not timewise:
+            # Como o music21 (PartParser.separateOutPartStaves): com mais de
+            # uma pauta, uma PartStaff por número de pauta usado
+            part_staves.append(tuple(sorted(staff_numbers - {0})) if max_staves > 1 else (None,))
+            elem.clear()
+
+        if tag in STAFF_NUMBER_TAGS and (elem.get('number') or '').isdigit():
+            staff_numbers.add(int(elem.get('number')))
+        if tag == 'time':
+            beats, beat_type = elem.findtext('beats'), elem.findtext('beat-type')
+            if beats and beat_type:
+                ratio = f"{beats.strip()}/{beat_type.strip()}"
+                if ratio not in time_signatures:
+                    time_signatures.append(ratio)
+                if first_time_signature is None and beats.strip().isdigit() and beat_type.strip().isdigit():
+                    first_time_signature = (int(beats), int(beat_type))
+
+    # Nomes pela ordem dos <part> (o music21 procura o <score-part> pelo id)
+    if timewise:
+        names = [score_part_names[part_id] for part_id in score_part_order]
+        part_staves = None
+    else:
+        names = [
+            score_part_names.get(part_id)
+            for part_id, staves in zip(part_ids, part_staves)
+            for _ in staves
+        ]
+
+    return {
+        'title': credit_title or work_title or "Untitled",
+        'part_names': [name or f"Part {i + 1}" for i, name in enumerate(names)],
+        'part_staves': part_staves,
+        'total_measures': total_measures,
+        'time_signatures': time_signatures,
+        'first_time_signature': first_time_signature
+    }
+
+def get_score_metadata(file_path):
+    """
+    Metadados de um score (scan_musicxml_metadata), memorizados pelo hash do
+    conteúdo; se o XML não puder ser lido em streaming, vêm do music21.
+    """
+    score_key = get_file_hash(file_path)
+    with score_metadata_lock:
+        metadata = score_metadata_cache.get(score_key)
+        if metadata is not None:
+            score_metadata_cache.move_to_end(score_key)
+            return metadata
+
+    try:
+        metadata = scan_musicxml_metadata(file_path)
+    except ET.ParseError as e:
+        print(f"[METADATA] Scan failed for {os.path.basename(file_path)} ({e}); using music21")
+        facts = get_score_facts(file_path)
+        ts = facts.first_time_signature
+        metadata = {
+            'title': "Untitled",
+            'part_names': facts.instrument_names,
+            'part_staves': None,
+            'total_measures': facts.total_measures,
+            'time_signatures': facts.time_signatures,
+            'first_time_signature': (ts.numerator, ts.denominator) if ts else None
+        }
+
+    with score_metadata_lock:
+        score_metadata_cache[score_key] = metadata
+        while len(score_metadata_cache) > SCORE_METADATA_MAX_ENTRIES:
+            score_metadata_cache.popitem(last=False)
+    return metadata
+
+def get_cached_facts(file_path):
+    """
+    ScoreFacts (sem score) de um score se já estiver no cache, sem fazer
+    parse; senão None. Só serve para factos já calculados ou que não usam
+    o score (p.ex. o payload do piano roll).
+    """
+    score_key = get_file_hash(file_path)
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        return entry['facts'] if entry is not None else None
+
+# ========================================
+
+# ========================================
+# LAZY PART LOADER
+# ========================================
+# Rotas que só precisam de uma parte (exportação de um instrumento, pautas
+# de compassos, comparação) não devem obrigar ao parse do score inteiro.
+# O MusicXML (partwise) é indexado uma vez: intervalos de bytes de cada
+# <part id> e de cada <score-part> do part-list. Cada parte é depois lida
+# sozinha (cabeçalho + o seu <score-part> + o seu <part>), convertida pelo
+# music21 e guardada no seu próprio cache, tal como a sua NoteTable.
+# Se o score completo já estiver em memória, é usado diretamente.
+#
+# Os índices de parte das rotas são os do music21, em que um <part> com
+# várias pautas dá várias PartStaff: o índice guarda, para cada parte do
+# music21, o <part> e a pauta (part_staves do scan de metadados), e a
+# parte é a PartStaff dessa pauta no parse do <part>.
+#
+# O cache de partes tem o seu próprio orçamento de memória
+# (PART_CACHE_MAX_BYTES), com o tamanho de cada entrada estimado como no
+# cache de scores.
+PART_CACHE_MAX_ENTRIES = int(os.environ.get('MIAL_PART_CACHE_MAX_ENTRIES', 64))
+PART_CACHE_MAX_BYTES = int(os.environ.get('MIAL_PART_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+part_index_cache = OrderedDict()  # score_key -> índice de bytes (ordem LRU)
+part_cache = OrderedDict()  # (score_key, índice do <part>) -> {'score', 'notes', 'expanded_notes', 'size', ...}
+part_cache_lock = Lock()
+part_cache_bytes = 0
+part_cache_inflight = {}  # (score_key, índice do <part>) -> Future dos parses de partes em curso
+
+PART_START_TAG = re.compile(rb'<part(\s[^>]*)?>')
+SCORE_PART_START_TAG = re.compile(rb'<score-part(\s[^>]*)?>')
+XML_ID_ATTRIBUTE = re.compile(rb'\bid\s*=\s*["\']([^"\']*)["\']')
+XML_ENCODING_DECLARATION = re.compile(rb'^\s*<\?xml[^>]*?\bencoding\s*=\s*["\']([^"\']+)["\']')
+
+def musicxml_text(data):
+    """
+    Texto de um documento MusicXML (bytes), descodificado segundo a
+    declaração XML (UTF-8 por omissão). A declaração passa a dizer UTF-8,
+    para que o music21 (que volta a codificar o texto em UTF-8) a respeite.
+    """
+    match = XML_ENCODING_DECLARATION.match(data)
+    if match is None:
+        return data.decode('utf-8-sig')
+    encoding = match.group(1).decode('ascii')
+    return (data[:match.start(1)] + b'UTF-8' + data[match.end(1):]).decode(encoding)
+
+def index_musicxml_parts(file_path):
+    """
+    Localiza as partes de um MusicXML partwise sem o interpretar.
+
+    Returns:
+        dict: header_end (início do primeiro <part>), part_list ((início, fim)
+              do <part-list>), score_parts (id -> (início, fim)) e parts
+              (lista de (id, início, fim), pela ordem do ficheiro)
+
+    Raises:
+        ValueError: Se o ficheiro não for MusicXML partwise (p.ex. timewise)
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    part_list_start = data.find(b'<part-list')
+    part_list_end = data.find(b'</part-list>', part_list_start)
+    if b'<score-partwise' not in data[:max(part_list_start, 0)] or part_list_end < 0:
+        raise ValueError("Not a partwise MusicXML file")
+    part_list_end += len(b'</part-list>')
+
+    score_parts = {}
+    for match in SCORE_PART_START_TAG.finditer(data, part_list_start, part_list_end):
+        part_id = XML_ID_ATTRIBUTE.search(match.group(0))
+        end = data.find(b'</score-part>', match.end(), part_list_end)
+        if part_id and end >= 0:
+            score_parts[part_id.group(1)] = (match.start(), end + len(b'</score-part>'))
+
+    parts = []
+    position = part_list_end
+    while True:
+        match = PART_START_TAG.search(data, position)
+        if match is None:
+            break
+        end = data.find(b'</part>', match.end())
+        if end < 0:
+            raise ValueError("Unterminated <part> element")
+        part_id = XML_ID_ATTRIBUTE.search(match.group(0))
+        parts.append((part_id.group(1) if part_id else b'', match.start(), end + len(b'</part>')))
+        position = end
+
+    if not parts:
+        raise ValueError("No <part> elements found")
+
+    return {
+        'header_end': parts[0][1],
+        'part_list': (part_list_start, part_list_end),
+        'score_parts': score_parts,
+        'parts': parts
+    }
+
+def get_part_index(file_path):
+    """
+    Índice de bytes das partes (index_musicxml_parts) com a localização de
+    cada parte do music21 (locations: (índice do <part>, posição da pauta
+    no <part>, número da pauta ou None se o <part> não for dividido)),
+    memorizado pelo hash do conteúdo; None se o ficheiro não for MusicXML
+    partwise ou se as pautas de cada <part> não forem conhecidas.
+    """
+    score_key = get_file_hash(file_path)
+    with part_cache_lock:
+        if score_key in part_index_cache:
+            part_index_cache.move_to_end(score_key)
+            return part_index_cache[score_key]
+
+    try:
+        index = index_musicxml_parts(file_path)
+        part_staves = get_score_metadata(file_path)['part_staves']
+        if part_staves is None or len(part_staves) != len(index['parts']):
+            raise ValueError("staves per part unknown")
+        index['locations'] = [
+            (xml_idx, staff, staff_number)
+            for xml_idx, staves in enumerate(part_staves)
+            for staff, staff_number in enumerate(staves)
+        ]
+    except ValueError as e:
+        print(f"[PART CACHE] {os.path.basename(file_path)} not indexed ({e}); using the full score")
+        index = None
+
+    with part_cache_lock:
+        part_index_cache[score_key] = index
+        while len(part_index_cache) > PART_CACHE_MAX_ENTRIES:
+            part_index_cache.popitem(last=False)
+    return index
+
+def get_part_location(file_path, part_idx):
+    """
+    (índice do <part>, posição da pauta, número da pauta, número de pautas)
+    da parte part_idx do music21; None se o ficheiro não estiver indexado.
+
+    Raises:
+        ValueError: Se part_idx estiver fora do intervalo
+    """
+    index = get_part_index(file_path)
+    if index is None:
+        return None
+    locations = index['locations']
+    if not 0 <= part_idx < len(locations):
+        raise ValueError(f"Part index {part_idx} out of range (total parts: {len(locations)})")
+    xml_idx, staff, staff_number = locations[part_idx]
+    return xml_idx, staff, staff_number, sum(1 for location in locations if location[0] == xml_idx)
+
+def part_musicxml_bytes(file_path, part_idx):
+    """
+    MusicXML de um só <part> (part_idx pela ordem do ficheiro): cabeçalho
+    do score, part-list reduzido ao <score-part> da parte e o seu <part>,
+    lidos por intervalos de bytes.
+    """
+    index = get_part_index(file_path)
+    if index is None:
+        raise ValueError("Not a partwise MusicXML file")
+    if not 0 <= part_idx < len(index['parts']):
+        raise ValueError(f"Part index {part_idx} out of range (total parts: {len(index['parts'])})")
+
+    part_id, part_start, part_end = index['parts'][part_idx]
+    part_list_start, part_list_end = index['part_list']
+
+    with open(file_path, 'rb') as f:
+        header = f.read(index['header_end'])
+        f.seek(part_start)
+        part_data = f.read(part_end - part_start)
+
+    score_part = b''
+    if part_id in index['score_parts']:
+        start, end = index['score_parts'][part_id]
+        score_part = header[start:end]
+
+    return b''.join([
+        header[:part_list_start],
+        b'<part-list>', score_part, b'</part-list>',
+        header[part_list_end:],
+        part_data,
+        b'\n</score-partwise>\n'
+    ])
+
+def get_memory_score(file_path):
+    """Score completo se estiver no cache em memória (sem fazer parse); senão None."""
+    score_key = get_file_hash(file_path)
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is None or entry['score'] is None:
+            return None
+        score_cache.move_to_end(score_key)
+        return entry['score']
+
+def get_memory_note_table(file_path, expand_repeats=False):
+    """NoteTable do score completo se estiver no cache em memória (sem fazer parse); senão None."""
+    score_key = get_file_hash(file_path)
+    with score_cache_lock:
+        entry = score_cache.get(score_key)
+        if entry is None:
+            return None
+        return entry['expanded_notes' if expand_repeats else 'notes']
+
+def get_part_entry(file_path, part_idx):
+    """
+    Entrada do cache de partes do <part> part_idx (pela ordem do ficheiro),
+    fazendo o parse só dessa parte se necessário.
+
+    Tal como em get_cached_score, cada parte em parse tem um Future em
+    part_cache_inflight: pedidos concorrentes para a mesma parte esperam
+    por esse parse em vez de repetirem o trabalho.
+    """
+    cache_key = (get_file_hash(file_path), part_idx)
+    with part_cache_lock:
+        entry = part_cache.get(cache_key)
+        if entry is not None:
+            part_cache.move_to_end(cache_key)
+            update_part_entry_size(entry)
+            return entry
+
+        pending = part_cache_inflight.get(cache_key)
+        if pending is None:
+            pending = Future()
+            part_cache_inflight[cache_key] = pending
+            is_owner = True
+        else:
+            is_owner = False
+
+    if not is_owner:
+        print(f"[PART CACHE] Waiting for in-flight parse of part {part_idx} of {os.path.basename(file_path)}")
+        return pending.result()
+
+    try:
+        start = time.time()
+        part_score = converter.parseData(musicxml_text(part_musicxml_bytes(file_path, part_idx)), format='musicxml')
+        print(f"[PART CACHE] Parsed part {part_idx} of {os.path.basename(file_path)} in {time.time() - start:.2f}s")
+    except Exception as e:
+        with part_cache_lock:
+            part_cache_inflight.pop(cache_key, None)
+        pending.set_exception(e)
+        raise
+
+    entry = {
+        'cache_key': cache_key,
+        'score': part_score,
+        'score_elements': sum(1 for _ in part_score.recurse()),
+        'notes': None,
+        'expanded_notes': None,
+        'size': 0
+    }
+    with part_cache_lock:
+        part_cache[cache_key] = entry
+        part_cache.move_to_end(cache_key)
+        part_cache_inflight.pop(cache_key, None)
+        update_part_entry_size(entry)
+    pending.set_result(entry)
+    return entry
+
+def update_part_entry_size(entry):
+    """
+    Recalcula o tamanho de uma entrada do cache de partes (as suas NoteTables
+    podem ter crescido) e remove as entradas menos recentes enquanto
+    PART_CACHE_MAX_BYTES for ultrapassado. Deve ser chamada com
+    part_cache_lock adquirido; a própria entrada nunca é removida.
+    """
+    global part_cache_bytes
+    if part_cache.get(entry['cache_key']) is not entry:
+        return
+    new_size = estimate_entry_size(entry)
+    part_cache_bytes += new_size - entry['size']
+    entry['size'] = new_size
+
+    for cache_key in list(part_cache.keys()):
+        if part_cache_bytes <= PART_CACHE_MAX_BYTES:
+            break
+        if cache_key == entry['cache_key']:
+            continue
+        part_cache_bytes -= part_cache.pop(cache_key)['size']
+        print(f"[PART CACHE] Evicted part {cache_key[1]} of {cache_key[0][:12]}")
+
+def get_staff_entry(file_path, part_idx):
+    """
+    (entrada do cache de partes, pauta) da parte part_idx do music21, ou
+    None se for preciso o score completo: ficheiro não indexado, ou o parse
+    do <part> não deu as pautas esperadas.
+    """
+    location = get_part_location(file_path, part_idx)
+    if location is None:
+        return None
+    xml_idx, staff, _, staves = location
+    entry = get_part_entry(file_path, xml_idx)
+    if len(entry['score'].parts) != staves:
+        print(f"[PART CACHE] Part {xml_idx} of {os.path.basename(file_path)} has "
+              f"{len(entry['score'].parts)} staves (expected {staves}); using the full score")
+        return None
+    return entry, staff
+
+def get_part_score(file_path, part_idx):
+    """
+    Parte part_idx de um score (music21 Part ou PartStaff): do score
+    completo se já estiver em memória, senão de um parse só do seu <part>.
+
+    Raises:
+        ValueError: Se part_idx estiver fora do intervalo
+    """
+    score = get_memory_score(file_path)
+    if score is None:
+        staff_entry = get_staff_entry(file_path, part_idx)
+        if staff_entry is not None:
+            entry, staff = staff_entry
+            return entry['score'].parts[staff]
+        # Não indexado (p.ex. timewise): parse completo
+        score = get_cached_score(file_path)
+
+    if not 0 <= part_idx < len(score.parts):
+        raise ValueError(f"Part index {part_idx} out of range (total parts: {len(score.parts)})")
+    return score.parts[part_idx]
+
+def get_part_count(file_path):
+    """
+    Número de partes do score na numeração do music21 (uma por PartStaff):
+    do score em memória ou, sem fazer parse, do scan de metadados.
+    """
+    score = get_memory_score(file_path)
+    if score is not None:
+        return len(score.parts)
+    return len(get_score_metadata(file_path)['part_names'])
+
+def get_part_note_table(file_path, part_idx, expand_repeats=False):
+    """
+    NoteTable com a parte part_idx do music21, para rotas que comparam
+    poucas partes sem precisarem do score completo: a do seu <part> (uma
+    parte por pauta) ou, se for preciso, a do score completo.
+
+    Returns:
+        tuple: (NoteTable, índice da parte nessa tabela)
+    """
+    staff_entry = get_staff_entry(file_path, part_idx)
+    if staff_entry is None:
+        return get_note_table(file_path, expand_repeats), part_idx
+
+    entry, staff = staff_entry
+    table_name = 'expanded_notes' if expand_repeats else 'notes'
+    if entry[table_name] is None:
+        part_score = entry['score']
+        if expand_repeats:
+            try:
+                part_score = part_score.expandRepeats()
+            except Exception as e:
+                print(f"Warning: Could not expand repeats: {e}")
+        table = NoteTable.from_score(part_score)
+        with part_cache_lock:
+            entry[table_name] = table
+            update_part_entry_size(entry)
+    return entry[table_name], staff
+# ========================================
+
+# ========================================
+# MEASURE INDEX
+# ========================================
+# Excertos de compassos (render-staff) cortados diretamente do MusicXML
+# original, sem passar pelo music21: para cada parte, o intervalo de bytes
+# de cada <measure> e os atributos ativos no seu início (divisions, key,
+# time, staves, clef, transpose). Cada grupo de compassos contíguos do
+# excerto começa com um <attributes> com esse estado.
+#
+# Uma parte do music21 que seja uma pauta de um <part> com várias pautas
+# (PartStaff) fica só com o conteúdo dessa pauta, como no music21: notas,
+# indicações e atributos dessa pauta ou sem pauta, com os <backup>/<forward>
+# refeitos a partir das posições no compasso.
+MEASURE_ATTRIBUTE_TAGS = ('divisions', 'key', 'time', 'staves', 'clef', 'transpose')
+MEASURE_START_TAG = re.compile(rb'<measure(\s[^>]*)?>')
+ATTRIBUTES_ELEMENT = re.compile(rb'<attributes(\s[^>]*)?>.*?</attributes>', re.DOTALL)
+
+measure_index_cache = OrderedDict()  # (score_key, part_idx) -> índice de compassos (ordem LRU)
+
+def index_part_measures(part_data):
+    """
+    Compassos de um <part> (bytes), pela ordem do ficheiro.
+
+    Returns:
+        list: (início, fim, atributos) por compasso, com os intervalos
+              relativos a part_data e atributos = {tag: {número: bytes}}
+              ativos no início do compasso
+    """
+    measures = []
+    state = {}
+    position = 0
+
+    while True:
+        match = MEASURE_START_TAG.search(part_data, position)
+        if match is None:
+            break
+        if match.group(0).endswith(b'/>'):
+            end = match.end()
+        else:
+            end = part_data.find(b'</measure>', match.end())
+            if end < 0:
+                raise ValueError("Unterminated <measure> element")
+            end += len(b'</measure>')
+
+        measures.append((match.start(), end, state))
+
+        # Estado para o compasso seguinte (o mesmo dict se nada mudar)
+        for attributes_match in ATTRIBUTES_ELEMENT.finditer(part_data, match.end(), end):
+            changed = {tag: dict(values) for tag, values in state.items()}
+            for child in ET.fromstring(attributes_match.group(0)):
+                if child.tag in MEASURE_ATTRIBUTE_TAGS:
+                    child.tail = None
+                    number = child.get('number', '')
+                    if not number:
+                        # Sem number, o elemento vale para todas as pautas
+                        changed[child.tag] = {}
+                    changed.setdefault(child.tag, {})[number] = ET.tostring(child)
+            state = changed
+
+        position = end
+
+    return measures
+
+def get_part_measure_index(file_path, part_idx):
+    """Índice de compassos (index_part_measures) de uma parte, memorizado por score e parte."""
+    cache_key = (get_file_hash(file_path), part_idx)
+    with part_cache_lock:
+        measures = measure_index_cache.get(cache_key)
+        if measures is not None:
+            measure_index_cache.move_to_end(cache_key)
+            return measures
+
+    _, part_start, part_end = get_part_index(file_path)['parts'][part_idx]
+    with open(file_path, 'rb') as f:
+        f.seek(part_start)
+        measures = index_part_measures(f.read(part_end - part_start))
+
+    with part_cache_lock:
+        measure_index_cache[cache_key] = measures
+        while len(measure_index_cache) > PART_CACHE_MAX_ENTRIES:
+            measure_index_cache.popitem(last=False)
+    return measures
+
+def attributes_xml(state):
+    """Elemento <attributes> (bytes) com o estado ativo, na ordem do schema MusicXML."""
+    children = [
+        element
+        for tag in MEASURE_ATTRIBUTE_TAGS
+        for _, element in sorted(state.get(tag, {}).items())
+    ]
+    return b'<attributes>' + b''.join(children) + b'</attributes>'
+
+def musicxml_encoding(data):
+    """Codificação declarada num documento MusicXML (bytes do início); UTF-8 por omissão."""
+    match = XML_ENCODING_DECLARATION.match(data)
+    return match.group(1).decode('ascii') if match else 'utf-8'
+
+def staff_element(element, staff_number, keep_unassigned=True):
+    """
+    Elemento da pauta staff_number (ou None se for de outra), sem o número
+    da pauta: o filho <staff> de notas e indicações, o atributo number de
+    claves, armações, compassos...
+    """
+    staff = element.find('staff')
+    if staff is not None:
+        if (staff.text or '').strip() != str(staff_number):
+            return None
+        element.remove(staff)
+    number = element.get('number')
+    if element.tag in STAFF_NUMBER_TAGS and number is not None:
+        if number != str(staff_number):
+            return None
+        del element.attrib['number']
+    elif staff is None and not keep_unassigned:
+        return None
+    return element
+
+def staff_attributes_state(state, staff_number):
+    """Estado de atributos (index_part_measures) de uma só pauta, sem <staves>."""
+    staff_state = {}
+    for tag, values in state.items():
+        if tag == 'staves':
+            continue
+        value = values.get(str(staff_number), values.get(''))
+        if value is not None:
+            element = staff_element(ET.fromstring(value), staff_number)
+            staff_state[tag] = {'': ET.tostring(element)}
+    return staff_state
+
+def staff_measure_xml(measure_data, staff_number, encoding):
+    """
+    Compasso (bytes) de um <part> com várias pautas reduzido à pauta
+    staff_number, como a PartStaff do music21: ficam as notas, indicações
+    e atributos dessa pauta ou sem pauta, e os <backup>/<forward> são
+    refeitos a partir da posição de cada elemento no compasso.
+    """
+    measure = ET.fromstring(measure_data.decode(encoding))
+    children = list(measure)
+    for child in children:
+        measure.remove(child)
+
+    output_position = 0
+
+    def move_to(onset):
+        # <forward>/<backup> da posição do compasso reduzido até onset
+        nonlocal output_position
+        if onset != output_position:
+            shift = ET.SubElement(measure, 'forward' if onset > output_position else 'backup')
+            ET.SubElement(shift, 'duration').text = str(abs(onset - output_position))
+            shift.tail = children[0].tail if children else None
+            output_position = onset
+
+    position = 0
+    note_onset = 0
+    head_kept = False
+    for child in children:
+        tag = child.tag
+        if tag in ('backup', 'forward'):
+            duration = int(child.findtext('duration') or 0)
+            position += duration if tag == 'forward' else -duration
+            continue
+
+        if tag == 'note':
+            duration = 0 if child.find('grace') is not None else int(child.findtext('duration') or 0)
+            chord_tone = child.find('chord')
+            if chord_tone is None:
+                note_onset = position
+                position += duration
+            if staff_element(child, staff_number) is None:
+                if chord_tone is None:
+                    head_kept = False
+                continue
+            if chord_tone is not None and head_kept:
+                measure.append(child)
+                continue
+            if chord_tone is not None:
+                # Acorde entre pautas cuja primeira nota era de outra pauta
+                child.remove(chord_tone)
+            head_kept = True
+            move_to(note_onset)
+            measure.append(child)
+            output_position = note_onset + duration
+        elif tag == 'attributes':
+            for attribute in list(child):
+                if attribute.tag == 'staves' or staff_element(attribute, staff_number) is None:
+                    child.remove(attribute)
+            if len(child):
+                move_to(position)
+                measure.append(child)
+        elif tag == 'print':
+            for layout in child.findall('staff-layout'):
+                if staff_element(layout, staff_number) is None:
+                    child.remove(layout)
+            measure.append(child)
+        elif tag in ('direction', 'harmony', 'figured-bass', 'sound'):
+            if staff_element(child, staff_number) is not None:
+                move_to(position)
+                measure.append(child)
+        else:
+            measure.append(child)
+
+    return ET.tostring(measure, encoding='unicode').encode(encoding, 'xmlcharrefreplace')
+
+def slice_measures_from_musicxml(file_path, measure_numbers, part_index):
+    """
+    MusicXML da parte part_index (numeração do music21) só com os compassos
+    pedidos (posições a partir de 1, como em extract_measures_from_musicxml),
+    cortado do ficheiro original; uma PartStaff fica só com a sua pauta.
+
+    Raises:
+        ValueError: Se part_index estiver fora do intervalo ou houver
+                    compassos inválidos
+    """
+    index = get_part_index(file_path)
+    xml_idx, _, staff_number, _ = get_part_location(file_path, part_index)
+
+    measures = get_part_measure_index(file_path, xml_idx)
+    invalid_measures = [m for m in measure_numbers if m < 1 or m > len(measures)]
+    if invalid_measures:
+        raise ValueError(f"Invalid measure numbers {invalid_measures}. Valid range: 1-{len(measures)}")
+
+    part_id, part_start, part_end = index['parts'][xml_idx]
+    part_list_start, part_list_end = index['part_list']
+
+    with open(file_path, 'rb') as f:
+        header = f.read(index['header_end'])
+        f.seek(part_start)
+        part_data = f.read(part_end - part_start)
+    encoding = musicxml_encoding(header)
+
+    score_part = b''
+    if part_id in index['score_parts']:
+        start, end = index['score_parts'][part_id]
+        score_part = header[start:end]
+
+    chunks = [
+        header[:part_list_start],
+        b'<part-list>', score_part, b'</part-list>',
+        header[part_list_end:],
+        part_data[:part_data.index(b'>') + 1]
+    ]
+    previous = None
+    for measure_num in sorted(set(measure_numbers)):
+        start, end, state = measures[measure_num - 1]
+        measure_data = part_data[start:end]
+        if staff_number is not None:
+            measure_data = staff_measure_xml(measure_data, staff_number, encoding)
+            state = staff_attributes_state(state, staff_number)
+        if previous != measure_num - 1 and state:
+            # Início de um grupo contíguo: repor clave, armação, compasso...
+            tag_end = measure_data.index(b'>') + 1
+            if measure_data[tag_end - 2:tag_end] != b'/>':
+                measure_data = measure_data[:tag_end] + attributes_xml(state) + measure_data[tag_end:]
+        chunks.append(measure_data)
+        previous = measure_num
+    chunks.append(b'</part>\n</score-partwise>\n')
+
+    return musicxml_text(b''.join(chunks))
+# ========================================
+
+# ========================================
+# PRE-ANALYSIS PIPELINE
+# ========================================
+# Depois de um upload, os resultados que os separadores pedem quase sempre
+# (relatório, piano roll, estatísticas) são calculados em background, por
+# ordem de prioridade, e guardados nos ScoreFacts do score; as rotas
+# encontram-nos já prontos. Cada score tem no máximo um pipeline ativo,
+# partilhado pelos clientes que o pediram (client_id do upload, ou o
+# endereço remoto); é cancelado entre etapas quando nenhum cliente o quer
+# (/api/preanalysis/cancel, ou um novo upload do mesmo cliente). Os
+# pipelines correm num pool de PREANALYSIS_WORKERS threads; os restantes
+# ficam em fila.
+PREANALYSIS_ENABLED = os.environ.get('MIAL_PREANALYSIS', '1') != '0'
+PREANALYSIS_WORKERS = int(os.environ.get('MIAL_PREANALYSIS_WORKERS', 2))
+
+preanalysis_jobs = {}  # score_key -> {'cancel': Event, 'clients': set, 'stage': str, 'completed': [...]}
+preanalysis_lock = Lock()
+preanalysis_executor = ThreadPoolExecutor(max_workers=PREANALYSIS_WORKERS, thread_name_prefix='preanalysis')
+
+def build_chord_report(table, parts, reduction_key):
+    """
+    Acordes e funções tonais por compasso da redução harmónica das partes
+    parts (secção harmonic_analysis.chord_report de /analyze).
+    """
+    sonorities = table.get_sonorities(parts)
+    chord_report = []
+
+    for measure_idx in range(table.num_measures):
+        measure_data = {
+            'measure': measure_idx + 1,
+            'chords': [],
+            'tonal_functions': []
+        }
+
+        last_forte = None
+        for i in range(*sonorities.measure_bounds(measure_idx)):
+            forte = get_pcset_table()[sonorities.mask[i]]['forte_class']
+            if forte == last_forte:
+                continue
+            last_forte = forte
 
-    # Usar cache para evitar re-parsing
-    score = get_cached_score(file_path)
+            try:
+                measure_data['chords'].append(sonority_chord_name(sonorities, i))
+            except:
+                measure_data['chords'].append("Unknown chord")
 
-    if part_index >= len(score.parts):
-        raise ValueError(f"Part index {part_index} out of range (total parts: {len(score.parts)})")
+            try:
+                measure_data['tonal_functions'].append(sonority_roman_figure(sonorities, i, reduction_key))
+            except:
+                measure_data['tonal_functions'].append("Unknown")
+
+        if not measure_data['chords']:
+            measure_data['chords'].append("No chords")
+            measure_data['tonal_functions'].append("No tonal functions")
+
+        chord_report.append(measure_data)
+
+    return chord_report
+
+def analysis_succeeded(result):
+    """Falso para os resultados de erro ({'error': ...}), que não devem ser memorizados."""
+    return 'error' not in result
+
+def get_chord_report(facts, table, parts):
+    """Chord report das partes parts, calculado uma vez por conjunto de partes."""
+    parts = tuple(sorted(set(parts)))
+    reduction_key = facts.parts_key(parts)
+    return facts.get(('chord_report', parts), lambda: build_chord_report(table, parts, reduction_key))
+
+def build_piano_roll_instruments(table):
+    """Notas de cada parte, por ordem temporal, no formato de /api/piano_roll."""
+    instruments_data = []
+
+    for index, part_name in enumerate(table.part_names):
+        part_name = part_name if part_name else "Instrument"
+
+        # Rows of this part in absolute time order
+        rows = table.time_ordered_rows(index)
+        notes_data = [
+            {
+                'pitch': midi,
+                'name': name,
+                'start': start,
+                'duration': duration,
+                'velocity': velocity
+            }
+            for midi, name, start, duration, velocity in zip(
+                table.midi[rows].tolist(),
+                table.pitch_names(rows, with_octave=True),
+                table.offset[rows].tolist(),
+                table.duration[rows].tolist(),
+                table.velocity[rows].tolist()
+            )
+        ]
 
-    # Validar números de compassos
-    total_measures = len(score.parts[0].getElementsByClass('Measure'))
-    invalid_measures = [m for m in measure_numbers if m < 1 or m > total_measures]
-    if invalid_measures:
-        raise ValueError(f"Invalid measure numbers {invalid_measures}. Valid range: 1-{total_measures}")
+        instruments_data.append({
+            'index': index,
+            'name': part_name,
+            'notes': notes_data
+        })
 
-    # Criar novo score apenas com o part selecionado
-    new_score = stream.Score()
-    target_part = score.parts[part_index]
-    new_part = stream.Part()
-
-    # Copiar metadata do part original
-    new_part.partName = target_part.partName
-    for element in target_part.getElementsByClass(['Instrument', 'Clef', 'KeySignature', 'TimeSignature']):
-        if element.offset == 0:  # Elementos iniciais
-            new_part.insert(0, element)
-
-    # Extrair compassos solicitados
-    all_measures = target_part.getElementsByClass('Measure')
-    for measure_num in sorted(set(measure_numbers)):  # Ordenar e remover duplicados
-        if 1 <= measure_num <= len(all_measures):
-            measure = all_measures[measure_num - 1]  # Índice começa em 0
-            new_part.append(measure)
-
-    new_score.append(new_part)
-
-    # Converter para MusicXML string
-    musicxml_result = new_score.write('musicxml')
-
-    # music21 pode retornar string ou Path, precisamos garantir que é string
-    if hasattr(musicxml_result, '__fspath__') or not isinstance(musicxml_result, str):
-        # É um Path object, ler o ficheiro
-        musicxml_path = str(musicxml_result)
-        with open(musicxml_path, 'r', encoding='utf-8') as f:
-            musicxml_content = f.read()
-        try:
-            os.remove(musicxml_path)  # Limpar ficheiro temporário
-        except:
-            pass
-        return musicxml_content
+    return instruments_data
+
+def preanalysis_stages(file_path, speculative=True):
+    """
+    Etapas do pipeline por ordem de prioridade: (nome, função). As quatro
+    primeiras são sempre feitas (o /upload e o /api/detect-tonality
+    dependem delas); as restantes só se speculative.
+    """
+    def facts():
+        return get_score_facts(file_path)
+
+    def notes():
+        return get_note_table(file_path)
+
+    stages = [
+        ('parse', facts),
+        ('note_table', notes),
+        ('key', lambda: facts().global_key),
+        ('cadences', lambda: facts().get('cadences', lambda: find_cadences(notes())))
+    ]
+    if speculative:
+        stages += [
+            ('chord_report', lambda: get_chord_report(facts(), notes(), range(notes().num_parts))),
+            ('piano_roll', lambda: facts().get(
+                'piano_roll', lambda: build_piano_roll_instruments(get_note_table(file_path, expand_repeats=True))
+            )),
+            ('statistics', lambda: facts().get(
+                'statistics', lambda: analyze_complete_statistics(facts().score, notes()),
+                memoize_if=analysis_succeeded
+            ))
+        ]
+    return stages
 
-    # Já é uma string
-    return musicxml_result
+def run_preanalysis(file_path, score_key, job, stages):
+    """Executa as etapas em sequência, parando se o job for cancelado."""
+    start = time.time()
+    name = os.path.basename(file_path)
+    try:
+        for stage, compute in stages:
+            if job['cancel'].is_set():
+                print(f"[PRE-ANALYSIS] {name} cancelled before '{stage}'")
+                return
+            job['stage'] = stage
+            compute()
+            job['completed'].append(stage)
+        print(f"[PRE-ANALYSIS] {name} ready in {time.time() - start:.2f}s ({', '.join(job['completed'])})")
+    except Exception as e:
+        print(f"[PRE-ANALYSIS] Failed for {file_path} at '{job['stage']}': {e}")
+    finally:
+        job['stage'] = None
+        with preanalysis_lock:
+            if preanalysis_jobs.get(score_key) is job:
+                del preanalysis_jobs[score_key]
+
+def release_preanalysis_job(job, client):
+    """Retira o cliente de um job (com preanalysis_lock); cancela-o se ficar sem clientes."""
+    job['clients'].discard(client)
+    if not job['clients']:
+        job['cancel'].set()
+
+def start_preanalysis(file_path, client, speculative=PREANALYSIS_ENABLED):
+    """
+    Lança o pipeline de um score em background para um cliente, libertando
+    os pipelines de outros scores que o mesmo cliente ainda tinha em curso
+    (pipelines de outros clientes não são afetados). Se já houver um para o
+    score, o cliente junta-se a ele.
+    """
+    score_key = get_file_hash(file_path)
+    with preanalysis_lock:
+        for other_key, other in preanalysis_jobs.items():
+            if other_key != score_key and client in other['clients']:
+                release_preanalysis_job(other, client)
+        job = preanalysis_jobs.get(score_key)
+        if job is not None and not job['cancel'].is_set():
+            job['clients'].add(client)
+            return
+        job = {'cancel': Event(), 'clients': {client}, 'stage': None, 'completed': []}
+        preanalysis_jobs[score_key] = job
+
+    stages = preanalysis_stages(file_path, speculative)
+    preanalysis_executor.submit(run_preanalysis, file_path, score_key, job, stages)
+
+def cancel_preanalysis(file_path, client):
+    """
+    Retira o cliente do pipeline de um score; se mais nenhum cliente o quiser,
+    a etapa em curso termina (e fica em cache) e as seguintes não são feitas.
 
+    Returns:
+        dict: cancelled e as etapas já completas, ou None se não houver pipeline
+    """
+    score_key = get_file_hash(file_path)
+    with preanalysis_lock:
+        job = preanalysis_jobs.get(score_key)
+        if job is None:
+            return None
+        release_preanalysis_job(job, client)
+        return {'cancelled': job['cancel'].is_set(), 'stage': job['stage'], 'completed': list(job['completed'])}
 # ========================================
 
 def load_config():
@@ -228,15 +3924,7 @@ def load_ai_models_config():
 
 def obter_titulo_do_xml(file_path):
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        for credit in root.findall("credit"):
-            credit_type = credit.find("credit-type")
-            if credit_type is not None and credit_type.text == "title":
-                credit_words = credit.find("credit-words")
-                if credit_words is not None:
-                    return credit_words.text
+        return get_score_metadata(file_path)['title']
     except:
         pass
     return "Untitled"
@@ -316,6 +4004,22 @@ def update_prompts():
         print(f"Error updating prompts: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss/eviction counters and memory usage of the score cache"""
+    return jsonify(get_cache_stats())
+
+@app.route('/api/preanalysis/cancel', methods=['POST'])
+def cancel_preanalysis_route():
+    data = request.json or {}
+    file_path = data.get('file_path')
+
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'File not found'}), 400
+
+    status = cancel_preanalysis(file_path, data.get('client_id') or request.remote_addr)
+    return jsonify(status or {'cancelled': False})
+
 @app.route('/upload', methods=['POST'])
 def upload():
     if 'file' not in request.files:
@@ -330,33 +4034,37 @@ def upload():
     file.save(file_path)
 
     try:
-        score = converter.parse(file_path)
-
-        total_instruments = len(score.parts)
-        instrument_names = [p.partName if p.partName else f"Part {i+1}" for i, p in enumerate(score.parts)]
+        # Metadados lidos diretamente do XML; o parse do music21 fica em background
+        metadata = get_score_metadata(file_path)
+
+        # Parse, tonalidade e resultados dos separadores em background;
+        # preanalyze=0 limita o pipeline ao parse, tonalidade e cadências
+        start_preanalysis(
+            file_path,
+            request.form.get('client_id') or request.remote_addr,
+            PREANALYSIS_ENABLED and request.form.get('preanalyze', '1') != '0'
+        )
 
-        overall_key = score.analyze('key')
-        total_measures = len(score.parts[0].getElementsByClass('Measure')) if score.parts else 0
+        # Tonalidade só se já estiver calculada (score carregado antes); senão
+        # o cliente obtém-na de /api/detect-tonality, que espera pelo parse
+        overall_key = None
+        facts = get_cached_facts(file_path)
+        if facts is not None and 'global_key' in facts.values:
+            key_obj = facts.values['global_key']
+            overall_key = f"{key_obj.tonic.name} {key_obj.mode}"
 
-        time_signatures = set()
-        first_time_signature = None
-        measure_duration_beats = 4  # Default value
-        
-        for ts in score.recurse().getElementsByClass(meter.TimeSignature):
-            time_signatures.add(ts.ratioString)
-            if first_time_signature is None:
-                first_time_signature = ts
-                measure_duration_beats = ts.numerator
+        numerator, denominator = metadata['first_time_signature'] or (4, 4)
 
         result = {
-            'title': obter_titulo_do_xml(file_path),
-            'total_instruments': total_instruments,
-            'instrument_names': instrument_names,
-            'overall_key': f"{overall_key.tonic.name} {overall_key.mode}",
-            'total_measures': total_measures,
-            'time_signatures': list(time_signatures),
-            'first_time_signature': f"{measure_duration_beats}/{first_time_signature.denominator if first_time_signature else 4}",
-            'measure_duration_beats': measure_duration_beats,
+            'title': metadata['title'],
+            'total_instruments': len(metadata['part_names']),
+            'instrument_names': metadata['part_names'],
+            'overall_key': overall_key,
+            'total_measures': metadata['total_measures'],
+            'time_signatures': list(metadata['time_signatures']),
+            'first_time_signature': f"{numerator}/{denominator}",
+            'measure_duration_beats': numerator,
+            'analysis_pending': overall_key is None,
             'file_path': file_path
         }
 
@@ -383,30 +4091,25 @@ def analyze():
         return jsonify({'error': 'File not found'}), 400
 
     try:
-        score = converter.parse(file_path)
+        score = get_cached_score(file_path)
+        facts = get_score_facts(file_path)
 
         part_indices = [int(idx) for idx in harmonic_parts]
 
-        total_instruments = len(score.parts)
-        instrument_names = [p.partName if p.partName else f"Part {i+1}" for i, p in enumerate(score.parts)]
+        total_instruments = facts.num_parts
+        instrument_names = facts.instrument_names
 
-        overall_key = score.analyze('key')
-        total_measures = len(score.parts[0].getElementsByClass('Measure')) if score.parts else 0
+        overall_key = facts.global_key
+        total_measures = facts.total_measures
 
-        time_signatures = set()
-        first_time_signature = None
-        measure_duration_beats = 4  # Default value
-        
-        for ts in score.recurse().getElementsByClass(meter.TimeSignature):
-            time_signatures.add(ts.ratioString)
-            if first_time_signature is None:
-                first_time_signature = ts
-                measure_duration_beats = ts.numerator
+        time_signatures = facts.time_signatures
+        first_time_signature = facts.first_time_signature
+        measure_duration_beats = first_time_signature.numerator if first_time_signature else 4
 
+        table = get_note_table(file_path)
         notes_per_instrument = {}
-        for p in score.parts:
-            notas = p.recurse().notes
-            notes_per_instrument[p.partName if p.partName else "Part"] = len(notas)
+        for p, event_count in zip(score.parts, table.part_event_counts.tolist()):
+            notes_per_instrument[p.partName if p.partName else "Part"] = event_count
 
         melodic_analysis = {}
 
@@ -415,87 +4118,54 @@ def analyze():
             melodic_analysis[name] = {}
 
         if analyze_intervals or analyze_direction:
-            for p in score.parts:
+            for part_idx, p in enumerate(score.parts):
                 name = p.partName if p.partName else "Part"
-                notes_list = [n for n in p.recurse().notes if isinstance(n, note.Note)]
-
-                interval_counter = Counter()
-                ascending = descending = 0
+                rows = table.single_note_rows(part_idx)
 
-                for i in range(1, len(notes_list)):
-                    intv = interval.Interval(notes_list[i - 1], notes_list[i])
-                    interval_name = intv.directedName
+                # Intervalos entre notas consecutivas, em semitons e passos diatónicos
+                semitones = np.diff(table.midi[rows].astype(np.int32))
+                diatonic_steps = np.diff(table.diatonic[rows].astype(np.int32))
 
-                    if analyze_intervals:
-                        interval_counter[interval_name] += 1
+                interval_counts = {}
+                if analyze_intervals and len(semitones):
+                    codes, interval_names = lookup_interval_names(diatonic_steps, semitones)
+                    interval_counts = most_common_codes(codes, interval_names)
 
-                    if analyze_direction:
-                        if intv.semitones > 0:
-                            ascending += 1
-                        elif intv.semitones < 0:
-                            descending += 1
+                ascending = descending = 0
+                if analyze_direction:
+                    ascending = int(np.count_nonzero(semitones > 0))
+                    descending = int(np.count_nonzero(semitones < 0))
 
                 total_moves = ascending + descending
                 mean_direction = (ascending - descending) / total_moves if total_moves > 0 else 0
 
-                melodic_analysis[name]["intervals"] = dict(interval_counter.most_common())
+                melodic_analysis[name]["intervals"] = interval_counts
                 melodic_analysis[name]["ascending"] = ascending
                 melodic_analysis[name]["descending"] = descending
                 melodic_analysis[name]["mean_direction"] = round(mean_direction, 2)
 
         if analyze_rhythm:
-            for p in score.parts:
+            for part_idx, p in enumerate(score.parts):
                 name = p.partName if p.partName else "Part"
-                notes_list = [n for n in p.recurse().notes if isinstance(n, note.Note)]
+                rows = table.single_note_rows(part_idx)
 
-                rhythmic_values = Counter()
-                total_notes = len(notes_list)
+                total_notes = len(rows)
                 total_measures_part = len(p.getElementsByClass('Measure'))
-
-                for n in notes_list:
-                    duration = n.quarterLength
-                    if duration >= 4.0:
-                        value_name = "Whole Note"
-                    elif duration >= 2.0:
-                        value_name = "Half Note"
-                    elif duration >= 1.0:
-                        value_name = "Quarter Note"
-                    elif duration >= 0.5:
-                        value_name = "Eighth Note"
-                    elif duration >= 0.25:
-                        value_name = "Sixteenth Note"
-                    else:
-                        value_name = "Smaller value"
-
-                    rhythmic_values[value_name] += 1
+                value_codes = np.digitize(table.duration[rows], RHYTHM_VALUE_BINS)
 
                 density = total_notes / total_measures_part if total_measures_part > 0 else 0
 
                 melodic_analysis[name]["rhythm"] = {
-                    "values": dict(rhythmic_values.most_common()),
+                    "values": most_common_codes(value_codes, RHYTHM_VALUE_NAMES),
                     "density": round(density, 2)
                 }
 
-        reduction = stream.Score()
-        for i in part_indices:
-            if i < len(score.parts):
-                reduction.append(score.parts[i])
-
-        reduction_key = reduction.analyze('key') if len(reduction.parts) > 0 else overall_key
-
-        chord_report = []
-        if len(reduction.parts) > 0:
-            for m in reduction.parts[0].getElementsByClass('Measure'):
-                chords = m.chordify()
-                measure_info = []
-                last_chord = None
-
-                for c in chords.flatten().getElementsByClass('Chord'):
-                    if not c.isRest and (last_chord is None or c.forteClass != last_chord.forteClass):
-                        measure_info.append(c)
-                        last_chord = c
+        reduction_parts = [i for i in part_indices if i < len(score.parts)]
+        reduction_key = facts.parts_key(reduction_parts) if reduction_parts else overall_key
 
-                chord_report.append(measure_info)
+        # Sonoridades verticais de todas as partes selecionadas (sweep line),
+        # já calculadas pela pré-análise quando são todas as partes
+        chord_report = get_chord_report(facts, table, reduction_parts) if reduction_parts else []
 
         selected_instruments = []
         for i in part_indices:
@@ -517,36 +4187,11 @@ def analyze():
             'melodic_analysis': melodic_analysis,
             'harmonic_analysis': {
                 'selected_instruments': selected_instruments,
-                'reduction_key': f"{reduction_key.tonic.name} {reduction_key.mode}" if len(reduction.parts) > 0 else "N/A",
-                'chord_report': []
+                'reduction_key': f"{reduction_key.tonic.name} {reduction_key.mode}" if reduction_parts else "N/A",
+                'chord_report': chord_report
             }
         }
 
-        for idx, chords in enumerate(chord_report):
-            measure_data = {
-                'measure': idx + 1,
-                'chords': [],
-                'tonal_functions': []
-            }
-
-            if not chords:
-                measure_data['chords'].append("No chords")
-                measure_data['tonal_functions'].append("No tonal functions")
-            else:
-                for c in chords:
-                    try:
-                        measure_data['chords'].append(c.pitchedCommonName)
-                    except:
-                        measure_data['chords'].append("Unknown chord")
-
-                    try:
-                        rn = roman.romanNumeralFromChord(c, reduction_key)
-                        measure_data['tonal_functions'].append(rn.figure)
-                    except:
-                        measure_data['tonal_functions'].append("Unknown")
-
-            result['harmonic_analysis']['chord_report'].append(measure_data)
-
         return jsonify(result)
 
     except Exception as e:
@@ -670,50 +4315,15 @@ def get_piano_roll_data():
         return jsonify({'error': 'File not found'}), 400
 
     try:
-        score = converter.parse(file_path)
-        
-        # Expand repeats to ensure accurate timing and duration
-        try:
-            score = score.expandRepeats()
-        except Exception as e:
-            print(f"Warning: Could not expand repeats: {e}")
-            
-        instruments_data = []
-
-        for index, part in enumerate(score.parts):
-            part_name = part.partName if part.partName else "Instrument"
-            notes_data = []
-
-            # Flatten the part to get all notes/chords in absolute time
-            flat_part = part.flatten()
-
-            for element in flat_part.notes:
-                offset = float(element.offset)
-                duration = float(element.quarterLength)
+        # Note table of the score with repeats expanded (accurate timing and duration)
+        table = get_note_table(file_path, expand_repeats=True)
 
-                if element.isNote:
-                    notes_data.append({
-                        'pitch': element.pitch.midi,
-                        'name': element.pitch.nameWithOctave,
-                        'start': offset,
-                        'duration': duration,
-                        'velocity': element.volume.velocity if element.volume.velocity else 64
-                    })
-                elif element.isChord:
-                    for chord_note in element.notes:
-                        notes_data.append({
-                            'pitch': chord_note.pitch.midi,
-                            'name': chord_note.pitch.nameWithOctave,
-                            'start': offset,
-                            'duration': duration,
-                            'velocity': element.volume.velocity if element.volume.velocity else 64
-                        })
-
-            instruments_data.append({
-                'index': index,
-                'name': part_name,
-                'notes': notes_data
-            })
+        # Payload usually prepared by the pre-analysis pipeline
+        facts = get_cached_facts(file_path)
+        if facts is not None:
+            instruments_data = facts.get('piano_roll', lambda: build_piano_roll_instruments(table))
+        else:
+            instruments_data = build_piano_roll_instruments(table)
 
         return jsonify({
             'instruments': instruments_data,
@@ -829,11 +4439,11 @@ def render_staff():
         if not measures:
             return jsonify({'error': 'No measures provided'}), 400
 
-        if not isinstance(measures, list):
-            return jsonify({'error': 'measures must be a list'}), 400
+        if not isinstance(measures, list) or not all(isinstance(m, int) for m in measures):
+            return jsonify({'error': 'measures must be a list of integers'}), 400
 
-        if len(measures) > 50:
-            return jsonify({'error': 'Too many measures (max 50)'}), 400
+        if not isinstance(part_index, int):
+            return jsonify({'error': 'part_index must be an integer'}), 400
 
         if not file_path:
             return jsonify({'error': 'No file_path provided'}), 400
@@ -861,10 +4471,7 @@ def render_staff():
         gap_info = calculate_gaps(measures)
 
         # Obter nome do instrumento
-        score = get_cached_score(file_path)
-        part_name = "Unknown"
-        if part_index < len(score.parts):
-            part_name = score.parts[part_index].partName or f"Part {part_index + 1}"
+        part_name = get_score_metadata(file_path)['part_names'][part_index]
 
         metadata = {
             'measures': sorted(set(measures)),
@@ -897,52 +4504,44 @@ def get_comparison_data():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 400
         
-        # Parse the score
-        score = converter.parse(file_path)
-        
-        # Expand repeats to ensure accurate timing and duration
-        try:
-            score = score.expandRepeats()
-        except Exception as e:
-            print(f"Warning: Could not expand repeats: {e}")
-        
+        # Note table with repeats expanded (accurate timing and duration):
+        # the full score's if it is in memory, otherwise one table per selected part
+        table = get_memory_note_table(file_path, expand_repeats=True)
+        if table is None and (get_memory_score(file_path) is not None or get_part_index(file_path) is None):
+            table = get_note_table(file_path, expand_repeats=True)
+
         # Get measure duration
-        time_sig = score.flatten().getElementsByClass(meter.TimeSignature)
-        measure_duration_beats = time_sig[0].beatCount if time_sig else 4
-        
-        # Get all parts
-        parts = score.parts
-        
+        metadata = get_score_metadata(file_path)
+        first_time_signature = metadata['first_time_signature']
+        time_sig = meter.TimeSignature("{}/{}".format(*first_time_signature)) if first_time_signature else None
+        measure_duration_beats = time_sig.beatCount if time_sig else 4
+        num_parts = len(metadata['part_names'])
+
         result_instruments = []
-        
+
         # Extract notes from selected instruments
         for idx in instrument_indices:
-            if idx < len(parts):
-                part = parts[idx]
-                instrument_name = part.partName or f"Instrument {idx + 1}"
-                
-                notes_data = []
-                # Use flatten().notes to get all notes/chords with absolute offsets
-                for element in part.flatten().notes:
-                    offset = float(element.offset)
-                    duration = float(element.quarterLength)
-                    
-                    if isinstance(element, note.Note):
-                        notes_data.append({
-                            'pitch': element.pitch.midi,
-                            'start_time': offset,
-                            'duration': duration,
-                            'name': element.pitch.nameWithOctave
-                        })
-                    elif isinstance(element, chord.Chord):
-                        for n in element.notes:
-                            notes_data.append({
-                                'pitch': n.pitch.midi,
-                                'start_time': offset,
-                                'duration': duration,
-                                'name': n.pitch.nameWithOctave
-                            })
-                
+            if 0 <= idx < num_parts:
+                part_table, part_idx = (table, idx) if table is not None else get_part_note_table(file_path, idx, expand_repeats=True)
+                instrument_name = part_table.part_names[part_idx] or f"Instrument {idx + 1}"
+
+                # Rows in absolute time order (chord notes share start and duration)
+                rows = part_table.time_ordered_rows(part_idx)
+                notes_data = [
+                    {
+                        'pitch': midi,
+                        'start_time': start,
+                        'duration': duration,
+                        'name': name
+                    }
+                    for midi, start, duration, name in zip(
+                        part_table.midi[rows].tolist(),
+                        part_table.offset[rows].tolist(),
+                        part_table.duration[rows].tolist(),
+                        part_table.pitch_names(rows, with_octave=True)
+                    )
+                ]
+
                 result_instruments.append({
                     'index': idx,
                     'name': instrument_name,
@@ -1029,15 +4628,18 @@ def detect_tonality():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 400
 
-        score = converter.parse(file_path)
-        key_sig = score.analyze('key')
+        facts = get_score_facts(file_path)
+        key_sig = facts.global_key
 
         if key_sig:
+            table = get_note_table(file_path)
             return jsonify({
                 'tonality_detected': True,
                 'tonality': str(key_sig.tonic),
                 'mode': key_sig.mode,  # 'major' ou 'minor'
-                'tonic_pitch_class': key_sig.tonic.pitchClass
+                'tonic_pitch_class': key_sig.tonic.pitchClass,
+                'overall_key': f"{key_sig.tonic.name} {key_sig.mode}",
+                'total_cadences': len(facts.get('cadences', lambda: find_cadences(table)))
             })
         else:
             return jsonify({
@@ -1061,35 +4663,87 @@ def advanced_analysis():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 400
 
-        score = converter.parse(file_path)
+        score = get_cached_score(file_path)
+        table = get_note_table(file_path)
+        facts = get_score_facts(file_path)
         result = {}
 
         if analysis_type == 'cadences':
-            result = analyze_cadences_advanced(score)
+            result = analyze_cadences_advanced(score, table, facts)
         elif analysis_type == 'modulation':
-            result = analyze_modulation(score)
+            try:
+                window_size = int(data.get('window_size', 4))
+                hop = int(data.get('hop', window_size))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'window_size and hop must be integers'}), 400
+            if window_size < 1 or hop < 1:
+                return jsonify({'error': 'window_size and hop must be at least 1'}), 400
+            result = analyze_modulation(score, table, window_size, hop)
         elif analysis_type == 'voice_leading':
-            result = analyze_voice_leading(score)
+            result = analyze_voice_leading(score, table)
         elif analysis_type == 'dissonance':
-            result = analyze_dissonance(score)
+            try:
+                page = int(data.get('page', 1))
+                page_size = int(data.get('page_size', DISSONANCE_PAGE_SIZE))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'page and page_size must be integers'}), 400
+            if page < 1 or not 1 <= page_size <= DISSONANCE_MAX_PAGE_SIZE:
+                return jsonify({'error': f'page must be at least 1 and page_size between 1 and {DISSONANCE_MAX_PAGE_SIZE}'}), 400
+            result = analyze_dissonance(score, table, bool(data.get('include_events', False)), page, page_size)
         elif analysis_type == 'harmonic_functions':
-            result = analyze_harmonic_functions_advanced(score)
+            result = analyze_harmonic_functions_advanced(score, table, facts)
         elif analysis_type == 'phrase_structure':
-            result = analyze_phrase_structure(score)
+            result = analyze_phrase_structure(score, table, facts)
         elif analysis_type == 'texture_advanced':
-            result = analyze_texture_advanced(score)
+            resolution = data.get('resolution', 'measure')
+            try:
+                bin_size = int(data.get('bin_size', 1))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'bin_size must be an integer'}), 400
+            if resolution not in TEXTURE_RESOLUTIONS or bin_size < 1:
+                return jsonify({'error': f'resolution must be one of {", ".join(TEXTURE_RESOLUTIONS)} and bin_size at least 1'}), 400
+            result = analyze_texture_advanced(score, table, resolution, bin_size)
         elif analysis_type == 'chromatic_analysis':
-            result = analyze_chromatic_advanced(score)
-        elif analysis_type == 'symmetry':
+            try:
+                window_size = int(data.get('window_size', CHROMATIC_KEY_WINDOW))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'window_size must be an integer'}), 400
+            if window_size < 1:
+                return jsonify({'error': 'window_size must be at least 1'}), 400
+            result = analyze_chromatic_advanced(score, table, window_size)
+        elif analysis_type in ('symmetry', 'symmetry_music21'):
+            try:
+                segment_length = int(data.get('segment_length', SYMMETRY_SEGMENT_LENGTH))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'segment_length must be an integer'}), 400
+            if segment_length < 2:
+                return jsonify({'error': 'segment_length must be at least 2'}), 400
+
             # Use environment-aware analysis
-            if environment == 'serial':
-                result = analyze_symmetry_music21(score, part_index)
+            if analysis_type == 'symmetry_music21' or environment == 'serial':
+                result = analyze_symmetry_music21(score, table, part_index, segment_length)
             else:
-                result = analyze_symmetry_tonal(score, part_index)
-        elif analysis_type == 'symmetry_music21':
-            result = analyze_symmetry_music21(score, part_index)
+                result = analyze_symmetry_tonal(score, facts, table, part_index, segment_length)
+        elif analysis_type == 'twelve_tone':
+            result = analyze_twelve_tone(score, table)
         elif analysis_type == 'statistics':
-            result = analyze_complete_statistics(score)
+            parts = data.get('parts')
+            try:
+                start_measure = int(data['start_measure']) if data.get('start_measure') is not None else None
+                end_measure = int(data['end_measure']) if data.get('end_measure') is not None else None
+                if parts is not None:
+                    parts = [int(p) for p in parts]
+            except (TypeError, ValueError):
+                return jsonify({'error': 'parts, start_measure and end_measure must be integers'}), 400
+            if parts is not None and any(not 0 <= p < table.num_parts for p in parts):
+                return jsonify({'error': 'Invalid part index'}), 400
+            if (start_measure is not None and start_measure < 1) or (end_measure is not None and end_measure < 1):
+                return jsonify({'error': 'start_measure and end_measure must be at least 1'}), 400
+            if parts is None and start_measure is None and end_measure is None:
+                result = facts.get('statistics', lambda: analyze_complete_statistics(score, table),
+                                   memoize_if=analysis_succeeded)
+            else:
+                result = analyze_complete_statistics(score, table, parts, start_measure, end_measure)
         else:
             return jsonify({'error': 'Unknown analysis type'}), 400
 
@@ -1111,13 +4765,12 @@ def get_parts():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 400
 
-        score = converter.parse(file_path)
+        facts = get_score_facts(file_path)
+        table = get_note_table(file_path)
         parts_info = []
 
-        for idx, part in enumerate(score.parts):
-            part_name = part.partName or f"Part {idx + 1}"
-            instrument_name = part.getInstrument().instrumentName if part.getInstrument() else "Unknown"
-            notes_count = len([n for n in part.recurse().notes if isinstance(n, note.Note)])
+        for idx, (part_name, instrument_name) in enumerate(zip(facts.instrument_names, facts.part_instruments)):
+            notes_count = len(table.single_note_rows(idx))
 
             parts_info.append({
                 'index': idx,
@@ -1132,92 +4785,60 @@ def get_parts():
         print(f"Get parts error: {e}")
         return jsonify({'error': str(e)}), 500
 
-def analyze_cadences_advanced(score):
-    """Detect musical cadences using music21's cadence detector"""
+def analyze_cadences_advanced(score, table, facts):
+    """Detect PAC/IAC/HC/plagal/deceptive cadences over the whole score, relative to local keys"""
     try:
-        cadences_found = []
-
-        for part_idx, part in enumerate(score.parts):
-            measures = part.getElementsByClass('Measure')
+        cadences = facts.get('cadences', lambda: find_cadences(table))
+        sonorities = table.get_sonorities()
 
-            # Get the overall key
-            try:
-                key_obj = score.analyze('key')
-            except:
-                key_obj = None
-
-            # Look for cadences in the last measures
-            for i in range(max(0, len(measures) - 8), len(measures)):
-                measure = measures[i]
-                try:
-                    chords = measure.chordify()
-
-                    # Check for authentic cadence (V-I)
-                    if i > 0:
-                        prev_measure = measures[i - 1]
-                        prev_chords = prev_measure.chordify()
-
-                        current_bass = chords.notes[0].pitch.pitchClass if chords.notes else None
-                        prev_bass = prev_chords.notes[0].pitch.pitchClass if prev_chords.notes else None
-
-                        if current_bass is not None and prev_bass is not None:
-                            # V to I pattern (7 to 0 in pitch class)
-                            if prev_bass == 7 and current_bass == 0:
-                                cadences_found.append({
-                                    'measure': i + 1,
-                                    'type': 'Authentic (V-I)',
-                                    'strength': 0.95,
-                                    'instrument': part.partName or f'Part {part_idx + 1}'
-                                })
-                            # IV to I pattern (5 to 0)
-                            elif prev_bass == 5 and current_bass == 0:
-                                cadences_found.append({
-                                    'measure': i + 1,
-                                    'type': 'Plagal (IV-I)',
-                                    'strength': 0.80,
-                                    'instrument': part.partName or f'Part {part_idx + 1}'
-                                })
-                except:
-                    pass
+        cadences_found = []
+        counts = {}
+        for cadence in cadences:
+            cadence_type, strength = CADENCE_TYPES[cadence['code']]
+            key_obj = cadence_key_object(cadence['key'])
+            arrival = sonority_roman_figure(sonorities, cadence['arrival'], key_obj)
+            if cadence['code'] == 'HC':
+                progression = arrival
+            else:
+                progression = f"{sonority_roman_figure(sonorities, cadence['departure'], key_obj)}-{arrival}"
+
+            cadences_found.append({
+                'measure': cadence['measure'] + 1,
+                'type': cadence_type,
+                'strength': strength,
+                'instrument': 'Full score',
+                'key': KEY_NAMES[cadence['key']],
+                'progression': progression,
+                'offset': cadence['offset']
+            })
+            counts[cadence_type] = counts.get(cadence_type, 0) + 1
 
         return {
             'cadences': cadences_found,
             'total_cadences': len(cadences_found),
+            'cadence_counts': counts,
             'summary': f'Found {len(cadences_found)} cadences in score'
         }
     except Exception as e:
         return {'error': f'Cadence detection failed: {str(e)}', 'cadences': []}
 
-def analyze_modulation(score):
-    """Detect key modulations throughout the score"""
+def analyze_modulation(score, table, window_size=4, hop=None):
+    """Detect key modulations throughout the score (sliding-window key tracking over all parts)"""
     try:
         modulations = []
         local_keys = []
 
-        # Analyze key changes by section
-        parts = score.parts
-        if not parts:
+        if not score.parts:
             return {'error': 'No parts found', 'modulations': []}
 
-        first_part = parts[0]
-        measures = first_part.getElementsByClass('Measure')
-
-        # Analyze every 4 measures for key changes
-        window_size = 4
-        for i in range(0, len(measures) - window_size, window_size):
-            section = stream.Score()
-            for j in range(i, min(i + window_size, len(measures))):
-                section.append(measures[j])
-
-            try:
-                key_obj = section.analyze('key')
-                local_keys.append({
-                    'measure': i + 1,
-                    'key': f"{key_obj.tonic.name} {key_obj.mode}",
-                    'confidence': 0.7
-                })
-            except:
-                pass
+        hop = hop or window_size
+        for window in track_local_keys(table, window_size, hop):
+            local_keys.append({
+                'measure': window['start'] + 1,
+                'end_measure': window['end'],
+                'key': window['key'],
+                'confidence': round(window['correlation'], 3)
+            })
 
         # Check for modulations (key changes)
         for i in range(1, len(local_keys)):
@@ -1233,108 +4854,136 @@ def analyze_modulation(score):
             'local_keys': local_keys,
             'modulations': modulations,
             'total_modulations': len(modulations),
+            'window_size': window_size,
+            'hop': hop,
             'summary': f'Found {len(modulations)} key modulations'
         }
     except Exception as e:
         return {'error': f'Modulation analysis failed: {str(e)}', 'modulations': []}
 
-def analyze_voice_leading(score):
-    """Analyze voice leading patterns and movements"""
+def analyze_voice_leading(score, table):
+    """Analyze per-voice motion and cross-part voice leading (parallels, hidden, crossing, overlap, spacing)"""
     try:
         voice_leading_data = []
 
-        for part_idx, part in enumerate(score.parts):
-            notes_list = [n for n in part.recurse().notes if isinstance(n, note.Note)]
+        for part_idx in range(table.num_parts):
+            rows = table.single_note_rows(part_idx)
 
-            if len(notes_list) < 2:
+            if len(rows) < 2:
                 continue
 
+            pitches = table.midi[rows].astype(np.int32)
+            semitones = np.abs(np.diff(pitches))
+            leap_intervals = semitones[semitones > 2]  # Leap = more than 2 semitones
+
             voice_info = {
-                'instrument': part.partName or f'Part {part_idx + 1}',
-                'total_notes': len(notes_list),
-                'leaps': 0,
+                'instrument': table.part_names[part_idx] or f'Part {part_idx + 1}',
+                'total_notes': len(rows),
+                'leaps': int(len(leap_intervals)),
                 'average_leap': 0,
-                'stepwise_motion': 0,
-                'pitch_range': None
+                'stepwise_motion': int(len(semitones) - len(leap_intervals)),
+                'pitch_range': f"{pitches.min()} - {pitches.max()} MIDI"
             }
 
-            leap_intervals = []
-            stepwise = 0
-
-            for i in range(1, len(notes_list)):
-                intv = interval.Interval(notes_list[i - 1], notes_list[i])
-                semitones = abs(intv.semitones)
-
-                if semitones > 2:  # Leap = more than 2 semitones
-                    voice_info['leaps'] += 1
-                    leap_intervals.append(semitones)
-                else:
-                    stepwise += 1
-
-            voice_info['stepwise_motion'] = stepwise
-
-            if leap_intervals:
-                voice_info['average_leap'] = round(sum(leap_intervals) / len(leap_intervals), 2)
-
-            pitches = [n.pitch.midi for n in notes_list]
-            voice_info['pitch_range'] = f"{min(pitches)} - {max(pitches)} MIDI"
+            if len(leap_intervals):
+                voice_info['average_leap'] = round(float(leap_intervals.mean()), 2)
 
             voice_leading_data.append(voice_info)
 
+        # Problemas entre partes (paralelas, diretas, cruzamentos, sobreposições, afastamento)
+        issues = find_voice_leading_issues(table)
+        labels = list(VOICE_LEADING_ISSUES.values())
+        counts = np.bincount(issues['kind'], minlength=len(labels))
+        shown = slice(0, VOICE_LEADING_MAX_ISSUES)
+        upper_names = table.pitch_names(issues['upper_row'][shown], with_octave=True)
+        lower_names = table.pitch_names(issues['lower_row'][shown], with_octave=True)
+        measures = np.searchsorted(table.measure_offsets, issues['onset'][shown], side='right')
+
+        issue_list = []
+        for k, (kind, upper, lower) in enumerate(zip(issues['kind'][shown].tolist(), issues['upper'][shown].tolist(),
+                                                     issues['lower'][shown].tolist())):
+            issue_list.append({
+                'type': labels[kind],
+                'measure': int(max(measures[k], 1)),
+                'offset': float(issues['onset'][k]),
+                'voices': [table.part_names[upper] or f'Part {upper + 1}', table.part_names[lower] or f'Part {lower + 1}'],
+                'pitches': [upper_names[k], lower_names[k]]
+            })
+
         return {
             'voice_analysis': voice_leading_data,
-            'summary': f'Analyzed {len(voice_leading_data)} voices'
+            'issue_counts': {label: int(count) for label, count in zip(labels, counts)},
+            'issues': issue_list,
+            'total_issues': len(issues['kind']),
+            'issues_truncated': len(issues['kind']) > VOICE_LEADING_MAX_ISSUES,
+            'summary': f'Analyzed {len(voice_leading_data)} voices, found {len(issues["kind"])} voice-leading issues'
         }
     except Exception as e:
         return {'error': f'Voice leading analysis failed: {str(e)}', 'voice_analysis': []}
 
-def analyze_dissonance(score):
-    """Analyze dissonance and consonance patterns"""
+def analyze_dissonance(score, table, include_events=False, page=1, page_size=DISSONANCE_PAGE_SIZE):
+    """Analyze harmonic (vertical) dissonance between all sounding voices at each onset"""
     try:
+        intervals = table.get_vertical_intervals()
+        total_intervals = len(intervals)
+        dissonant_count = intervals.dissonant_count
+
         dissonance_data = {
-            'dissonant_intervals': [],
-            'consonant_intervals': [],
-            'dissonance_moments': [],
-            'dissonance_percentage': 0
+            'dissonance_percentage': round((dissonant_count / total_intervals) * 100, 2) if total_intervals else 0,
+            'interval_histogram': intervals.histogram.tolist(),
+            'dissonant_semitones': list(DISSONANT_SEMITONES)
         }
 
-        dissonant_semitones = [1, 2, 6, 10, 11]  # Minor 2nd, Major 2nd, Tritone, etc.
-        consonant_semitones = [0, 3, 4, 5, 7, 8, 9, 12]  # Unison, 3rd, 4th, 5th, etc.
-
-        total_intervals = 0
-        dissonant_count = 0
-
-        for part_idx, part in enumerate(score.parts):
-            notes_list = [n for n in part.recurse().notes if isinstance(n, note.Note)]
-
-            for i in range(1, len(notes_list)):
-                intv = interval.Interval(notes_list[i - 1], notes_list[i])
-                semitones = intv.semitones % 12
-                total_intervals += 1
-
-                if semitones in dissonant_semitones:
-                    dissonant_count += 1
-                    dissonance_data['dissonant_intervals'].append({
-                        'from': str(notes_list[i - 1].pitch),
-                        'to': str(notes_list[i].pitch),
-                        'interval': intv.name,
-                        'instrument': part.partName or f'Part {part_idx + 1}'
-                    })
-                else:
-                    dissonance_data['consonant_intervals'].append(intv.name)
+        # Histogramas por compasso (só compassos com intervalos)
+        measure_histograms = intervals.measure_histograms()
+        measure_totals = measure_histograms.sum(axis=1)
+        measure_dissonant = measure_histograms[:, list(DISSONANT_SEMITONES)].sum(axis=1)
+        dissonance_data['measures'] = [
+            {
+                'measure': m + 1,
+                'histogram': measure_histograms[m].tolist(),
+                'dissonance_percentage': round(measure_dissonant[m] / measure_totals[m] * 100, 2)
+            }
+            for m in np.flatnonzero(measure_totals).tolist()
+        ]
 
-        if total_intervals > 0:
-            dissonance_data['dissonance_percentage'] = round((dissonant_count / total_intervals) * 100, 2)
+        # Histogramas por par de partes
+        pair_histograms = intervals.part_pair_histograms()
+        dissonance_data['part_pairs'] = []
+        for a, b in zip(*[idx.tolist() for idx in np.nonzero(pair_histograms.sum(axis=2))]):
+            histogram = pair_histograms[a, b]
+            dissonance_data['part_pairs'].append({
+                'parts': [table.part_names[a] or f'Part {a + 1}', table.part_names[b] or f'Part {b + 1}'],
+                'part_indices': [a, b],
+                'histogram': histogram.tolist(),
+                'total': int(histogram.sum()),
+                'dissonance_percentage': round(histogram[list(DISSONANT_SEMITONES)].sum() / histogram.sum() * 100, 2)
+            })
 
-        return {
+        result = {
             'dissonance': dissonance_data,
             'total_intervals_analyzed': total_intervals,
+            'total_dissonant_intervals': dissonant_count,
             'summary': f'{dissonance_data["dissonance_percentage"]}% dissonance detected'
         }
+
+        # Eventos detalhados só a pedido, paginados
+        if include_events:
+            total_pages = max(1, -(-dissonant_count // page_size))
+            start = (page - 1) * page_size
+            dissonance_data['dissonant_intervals'] = intervals.dissonant_events(start, start + page_size)
+            result['events_page'] = {
+                'page': page,
+                'page_size': page_size,
+                'total_events': dissonant_count,
+                'total_pages': total_pages
+            }
+
+        return result
     except Exception as e:
         return {'error': f'Dissonance analysis failed: {str(e)}', 'dissonance': {}}
 
-def analyze_harmonic_functions_advanced(score):
+def analyze_harmonic_functions_advanced(score, table, facts):
     """Analyze advanced harmonic functions (7ths, tensions, extensions)"""
     try:
         harmonic_data = {
@@ -1346,35 +4995,30 @@ def analyze_harmonic_functions_advanced(score):
         }
 
         try:
-            key_obj = score.analyze('key')
+            key_obj = facts.global_key
         except:
             key_obj = None
 
-        for part in score.parts:
-            measures = part.getElementsByClass('Measure')
+        # Sonoridades verticais de todas as partes (sweep line)
+        sonorities = table.get_sonorities()
+        pitch_counts = sonorities.pitch_counts
 
-            for measure in measures:
-                chords = measure.chordify()
+        for i in range(len(sonorities)):
+            pitches = int(pitch_counts[i])
 
-                for c in chords.flatten().getElementsByClass('Chord'):
-                    if c.isRest:
-                        continue
-
-                    pitches = len(c.pitches)
-
-                    # Classify chord type
-                    if pitches == 3:
-                        harmonic_data['triads'] += 1
-                    elif pitches == 4:
-                        harmonic_data['seventh_chords'] += 1
-                    else:
-                        harmonic_data['extended_chords'] += 1
+            # Classify chord type
+            if pitches == 3:
+                harmonic_data['triads'] += 1
+            elif pitches == 4:
+                harmonic_data['seventh_chords'] += 1
+            else:
+                harmonic_data['extended_chords'] += 1
 
-                    try:
-                        chord_name = c.pitchedCommonName
-                        harmonic_data['chord_breakdown'][chord_name] = harmonic_data['chord_breakdown'].get(chord_name, 0) + 1
-                    except:
-                        pass
+            try:
+                chord_name = sonority_chord_name(sonorities, i)
+                harmonic_data['chord_breakdown'][chord_name] = harmonic_data['chord_breakdown'].get(chord_name, 0) + 1
+            except:
+                pass
 
         return {
             'harmonic_functions': harmonic_data,
@@ -1383,37 +5027,22 @@ def analyze_harmonic_functions_advanced(score):
     except Exception as e:
         return {'error': f'Harmonic functions analysis failed: {str(e)}', 'harmonic_functions': {}}
 
-def analyze_phrase_structure(score):
-    """Analyze phrase structure and boundaries"""
+def analyze_phrase_structure(score, table, facts):
+    """Segment each part into phrases from rests, long notes, cadence points and melodic leaps"""
     try:
+        cadences = facts.get('cadences', lambda: find_cadences(table))
         phrases = []
 
-        for part_idx, part in enumerate(score.parts):
-            measures = part.getElementsByClass('Measure')
-            current_phrase_start = 1
-
-            # Simple heuristic: new phrase every 4 measures or at rests
-            for i, measure in enumerate(measures):
-                notes = measure.notes
-
-                # Check for long rest or measure boundary
-                if i > 0 and i % 4 == 0:
-                    phrases.append({
-                        'instrument': part.partName or f'Part {part_idx + 1}',
-                        'start_measure': current_phrase_start,
-                        'end_measure': i + 1,
-                        'length': i - current_phrase_start + 2
-                    })
-                    current_phrase_start = i + 2
-
-            # Add final phrase
-            if current_phrase_start <= len(measures):
-                phrases.append({
-                    'instrument': part.partName or f'Part {part_idx + 1}',
-                    'start_measure': current_phrase_start,
-                    'end_measure': len(measures),
-                    'length': len(measures) - current_phrase_start + 1
-                })
+        for phrase in facts.get('phrases', lambda: find_phrases(table, cadences)):
+            part_idx = phrase['part']
+            phrases.append({
+                'instrument': table.part_names[part_idx] or f'Part {part_idx + 1}',
+                'start_measure': phrase['start'] + 1,
+                'end_measure': phrase['end'] + 1,
+                'length': phrase['end'] - phrase['start'] + 1,
+                'boundary_strength': round(phrase['score'], 3),
+                'cues': phrase['cues']
+            })
 
         return {
             'phrases': phrases,
@@ -1423,38 +5052,56 @@ def analyze_phrase_structure(score):
     except Exception as e:
         return {'error': f'Phrase structure analysis failed: {str(e)}', 'phrases': []}
 
-def analyze_texture_advanced(score):
-    """Advanced texture analysis including density and sonority"""
+def analyze_texture_advanced(score, table, resolution='measure', bin_size=1):
+    """Texture profile of all parts: note and onset density, active voices, registral span and rhythmic independence"""
     try:
+        profile = texture_profile(table, resolution, bin_size)
         texture_data = {
             'sections': [],
             'average_note_density': 0,
-            'harmonic_rhythm': []
+            'harmonic_rhythm': [],
+            'resolution': resolution,
+            'bin_size': bin_size
         }
 
-        measures = score.parts[0].getElementsByClass('Measure') if score.parts else []
-        total_notes_per_measure = []
-
-        for i, measure in enumerate(measures):
-            note_count = len(measure.flatten().notes)
-            total_notes_per_measure.append(note_count)
-
-            # Classify texture density
-            if note_count < 5:
-                density = 'Sparse'
-            elif note_count < 10:
-                density = 'Moderate'
-            else:
-                density = 'Dense'
-
-            texture_data['harmonic_rhythm'].append({
-                'measure': i + 1,
-                'note_count': note_count,
-                'density': density
+        if len(profile['start']) == 0:
+            return {'texture': texture_data, 'summary': 'No measures found'}
+
+        # Densidade classificada por voz ativa e por compasso (os limiares eram
+        # para uma só parte, compasso a compasso), qualquer que seja a caixa
+        bin_lengths = np.diff(profile['start'], append=table.measure_offsets[-1] + table.measure_lengths[-1])
+        bin_measures = np.maximum(bin_lengths, 1e-9) / np.maximum(table.measure_lengths[profile['measure']], 1e-9)
+        per_voice = profile['note_count'] / np.maximum(profile['active_voices'], 1) / bin_measures
+        density = np.where(per_voice < 5, 'Sparse', np.where(per_voice < 10, 'Moderate', 'Dense'))
+        beats = profile['start'] - table.measure_offsets[profile['measure']] + 1
+
+        for k, measure_idx in enumerate(profile['measure'].tolist()):
+            entry = {
+                'measure': measure_idx + 1,
+                'note_count': int(profile['note_count'][k]),
+                'density': str(density[k]),
+                'onsets': int(profile['onsets'][k]),
+                'active_voices': int(profile['active_voices'][k]),
+                'registral_span': int(profile['span'][k]),
+                'rhythmic_independence': round(float(profile['independence'][k]), 3)
+            }
+            if resolution == 'beat':
+                entry['beat'] = round(float(beats[k]), 3)
+            texture_data['harmonic_rhythm'].append(entry)
+
+        # Secções: caixas seguidas com a mesma classe de densidade
+        changes = np.flatnonzero(density[1:] != density[:-1]) + 1
+        bounds = np.concatenate([[0], changes, [len(density)]])
+        for first, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            texture_data['sections'].append({
+                'start_measure': int(profile['measure'][first]) + 1,
+                'end_measure': int(profile['measure'][end - 1]) + 1,
+                'density': str(density[first]),
+                'average_active_voices': round(float(profile['active_voices'][first:end].mean()), 2)
             })
 
-        if total_notes_per_measure:
-            texture_data['average_note_density'] = round(sum(total_notes_per_measure) / len(total_notes_per_measure), 2)
+        notes_per_measure = np.bincount(profile['measure'], weights=profile['note_count'], minlength=table.num_measures)
+        texture_data['average_note_density'] = round(float(notes_per_measure.mean()), 2)
 
         return {
             'texture': texture_data,
@@ -1463,50 +5110,66 @@ def analyze_texture_advanced(score):
     except Exception as e:
         return {'error': f'Texture analysis failed: {str(e)}', 'texture': {}}
 
-def analyze_chromatic_advanced(score):
-    """Advanced chromatic analysis including accidentals and chromatic motion"""
+def analyze_chromatic_advanced(score, table, window_size=CHROMATIC_KEY_WINDOW):
+    """Chromatic analysis against a per-measure local key track, with chromatic passages"""
     try:
         chromatic_data = {
             'chromatic_notes': 0,
             'accidentals': {},
             'chromatic_passages': [],
-            'diatonic_percentage': 0
+            'diatonic_percentage': 0,
+            'local_keys': [],
+            'key_window': window_size
         }
 
-        try:
-            key_obj = score.analyze('key')
-            diatonic_pitches = [p.pitchClass for p in key_obj.getPitches()]
-        except:
-            diatonic_pitches = [0, 2, 4, 5, 7, 9, 11]  # Default C major
-
-        total_notes = 0
-        chromatic_count = 0
-
-        for part in score.parts:
-            notes_list = [n for n in part.recurse().notes if isinstance(n, note.Note)]
+        keys = measure_local_keys(table, window_size)
+        rows = np.flatnonzero((table.duration > 0) & ((table.tie & NoteTable.TIE_STOP) == 0))
+        total_notes = len(rows)
 
-            for n in notes_list:
-                total_notes += 1
-                pitch_class = n.pitch.pitchClass
+        chromatic_notes = rows[chromatic_rows(table, keys, rows)]
+        chromatic_count = len(chromatic_notes)
 
-                if pitch_class not in diatonic_pitches:
-                    chromatic_count += 1
-                    accidental = str(n.pitch.accidental) if n.pitch.accidental else 'natural'
-                    chromatic_data['accidentals'][accidental] = chromatic_data['accidentals'].get(accidental, 0) + 1
+        for alter, count in Counter(table.alter[chromatic_notes].tolist()).items():
+            accidental = pitch.Accidental(alter).name if alter else 'natural'
+            chromatic_data['accidentals'][accidental] = chromatic_data['accidentals'].get(accidental, 0) + count
 
         chromatic_data['chromatic_notes'] = chromatic_count
+        chromatic_data['total_notes'] = total_notes
 
         if total_notes > 0:
             chromatic_data['diatonic_percentage'] = round(((total_notes - chromatic_count) / total_notes) * 100, 2)
 
+        # Trilho de tonalidades locais, compactado em sequências de compassos
+        changes = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        bounds = np.concatenate([[0], changes, [len(keys)]]).tolist()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if keys[start] >= 0:
+                chromatic_data['local_keys'].append({
+                    'start_measure': start + 1,
+                    'end_measure': end,
+                    'key': KEY_NAMES[keys[start]]
+                })
+
+        for passage in find_chromatic_passages(table, keys):
+            part_idx = passage['part']
+            chromatic_data['chromatic_passages'].append({
+                'instrument': table.part_names[part_idx] or f'Part {part_idx + 1}',
+                'start_measure': passage['start_measure'] + 1,
+                'end_measure': passage['end_measure'] + 1,
+                'notes': passage['notes'],
+                'chromatic_notes': passage['chromatic_notes'],
+                'pitches': table.pitch_names(passage['rows'][:16], with_octave=True)
+            })
+
         return {
             'chromaticism': chromatic_data,
-            'summary': f'{chromatic_data["diatonic_percentage"]}% diatonic notes'
+            'summary': f'{chromatic_data["diatonic_percentage"]}% diatonic notes (local keys), '
+                       f'{len(chromatic_data["chromatic_passages"])} chromatic passages'
         }
     except Exception as e:
         return {'error': f'Chromatic analysis failed: {str(e)}', 'chromaticism': {}}
 
-def analyze_symmetry_tonal(score, part_index=0):
+def analyze_symmetry_tonal(score, facts, table, part_index=0, segment_length=SYMMETRY_SEGMENT_LENGTH):
     """
     Analyze musical symmetry patterns in TONAL environment
 
@@ -1517,10 +5180,13 @@ def analyze_symmetry_tonal(score, part_index=0):
     - Retrograde: Reverse of pitch-class sequence
     - Inversion: Mirror around the tonic pitch
     - Retrograde-Inversion: Retrograde + Inversion
+
+    Besides the tonic-axis scores, all 12 transpositions/axes are scored and
+    the best segments followed by their R/I/RI are reported (symmetry engine).
     """
     try:
         # 1. OBTER TONALIDADE
-        key_sig = score.analyze('key')
+        key_sig = facts.global_key
         if key_sig:
             tonic_pc = key_sig.tonic.pitchClass
             tonality_name = str(key_sig.tonic)
@@ -1531,18 +5197,17 @@ def analyze_symmetry_tonal(score, part_index=0):
             mode = "unknown"
 
         # 2. VALIDAR PARTES
-        if not score.parts:
+        if table.num_parts == 0:
             return {'error': 'No parts found', 'symmetry': {}}
 
-        if part_index >= len(score.parts):
+        if part_index >= table.num_parts:
             return {'error': f'Part index {part_index} out of range', 'symmetry': {}}
 
         # 3. EXTRAIR NOTAS
-        target_part = score.parts[part_index]
-        part_name = target_part.partName or f"Part {part_index + 1}"
-        notes_list = [n for n in target_part.recurse().notes if isinstance(n, note.Note)]
+        part_name = table.part_names[part_index] or f"Part {part_index + 1}"
+        rows = table.single_note_rows(part_index)
 
-        if len(notes_list) < 4:
+        if len(rows) < 4:
             return {
                 'symmetry': {
                     'retrograde_score': 0,
@@ -1557,47 +5222,30 @@ def analyze_symmetry_tonal(score, part_index=0):
                 'summary': f'{part_name}: Too short for symmetry analysis'
             }
 
-        pitch_sequence = [n.pitch.pitchClass for n in notes_list]
-
-        # 4. CÁLCULO DE RETROGRADO
-        # Fórmula: reversed_sequence
-        reversed_sequence = pitch_sequence[::-1]
-        retrograde_matches = sum(1 for i in range(len(pitch_sequence))
-                                if pitch_sequence[i] == reversed_sequence[i])
-        retrograde_score = (retrograde_matches / len(pitch_sequence)) * 100 if pitch_sequence else 0
-        retrograde_measures = [notes_list[i].measureNumber for i in range(len(pitch_sequence))
-                              if notes_list[i].measureNumber and
-                              pitch_sequence[i] == reversed_sequence[i]]
-
-        # 5. CÁLCULO DE INVERSÃO (COM EIXO NA TÓNICA)
-        # Fórmula: inverted = (2 * tonic - pitch) % 12
-        inverted_sequence = [(2 * tonic_pc - p) % 12 for p in pitch_sequence]
-        inversion_matches = sum(1 for i in range(len(pitch_sequence))
-                               if pitch_sequence[i] == inverted_sequence[i])
-        inversion_score = (inversion_matches / len(pitch_sequence)) * 100 if pitch_sequence else 0
-        inversion_measures = [notes_list[i].measureNumber for i in range(len(pitch_sequence))
-                             if notes_list[i].measureNumber and
-                             pitch_sequence[i] == inverted_sequence[i]]
-
-        # 6. CÁLCULO DE RETROGRADE-INVERSION
-        # Aplicar inversão primeiro, depois retrograde
-        ri_sequence = [(2 * tonic_pc - p) % 12 for p in pitch_sequence[::-1]]
-        ri_matches = sum(1 for i in range(len(pitch_sequence))
-                        if pitch_sequence[i] == ri_sequence[i])
-        ri_score = (ri_matches / len(pitch_sequence)) * 100 if pitch_sequence else 0
-        ri_measures = [notes_list[i].measureNumber for i in range(len(pitch_sequence))
-                      if notes_list[i].measureNumber and
-                      pitch_sequence[i] == ri_sequence[i]]
-
-        # 7. RETORNAR RESULTADO
+        pitch_sequence = table.pc[rows].astype(np.int64)
+        measures = table.measure_numbers[table.measure[rows]]
+
+        # 4-6. RETROGRADO, INVERSÃO E RETROGRADE-INVERSION (EIXO NA TÓNICA)
+        # Fórmula da inversão: inverted = (2 * tonic - pitch) % 12
+        masks = symmetry_match_masks(pitch_sequence, 2 * tonic_pc)
+        retrograde_score = masks['retrograde'].mean() * 100
+        inversion_score = masks['inversion'].mean() * 100
+        ri_score = masks['retrograde_inversion'].mean() * 100
+
+        # 7. TODAS AS TRANSPOSIÇÕES / EIXOS E SEGMENTOS SIMÉTRICOS
+        profiles = symmetry_profiles(pitch_sequence)
+
+        # 8. RETORNAR RESULTADO
         return {
             'symmetry': {
                 'retrograde_score': round(retrograde_score, 2),
                 'inversion_score': round(inversion_score, 2),
                 'retrograde_inversion_score': round(ri_score, 2),
-                'retrograde_measures': list(set(retrograde_measures)),
-                'inversion_measures': list(set(inversion_measures)),
-                'ri_measures': list(set(ri_measures)),
+                'retrograde_measures': symmetry_measures(measures, masks['retrograde']),
+                'inversion_measures': symmetry_measures(measures, masks['inversion']),
+                'ri_measures': symmetry_measures(measures, masks['retrograde_inversion']),
+                'all_transformations': {name: np.round(values, 2).tolist() for name, values in profiles.items()},
+                'segments': best_symmetry_segments(pitch_sequence, measures, segment_length),
                 'method': 'tonal',
                 'tonality': tonality_name,
                 'tonic_pitch_class': tonic_pc,
@@ -1609,68 +5257,7 @@ def analyze_symmetry_tonal(score, part_index=0):
     except Exception as e:
         return {'error': f'Tonal symmetry analysis failed: {str(e)}', 'symmetry': {}}
 
-def analyze_symmetry_advanced(score, part_index=0):
-    """Analyze musical symmetry patterns (retrograde, inversion)"""
-    try:
-        symmetry_data = {
-            'retrograde_score': 0,
-            'inversion_score': 0,
-            'retrograde_measures': [],
-            'inversion_measures': [],
-            'mirror_sections': []
-        }
-
-        if not score.parts:
-            return {'error': 'No parts found', 'symmetry': symmetry_data}
-
-        if part_index >= len(score.parts):
-            return {'error': f'Part index {part_index} out of range', 'symmetry': symmetry_data}
-
-        target_part = score.parts[part_index]
-        part_name = target_part.partName or f"Part {part_index + 1}"
-        notes_list = [n for n in target_part.recurse().notes if isinstance(n, note.Note)]
-
-        if len(notes_list) < 4:
-            return {'symmetry': symmetry_data, 'summary': f'{part_name}: Too short for symmetry analysis'}
-
-        # Get pitch sequence
-        pitch_sequence = [n.pitch.pitchClass for n in notes_list]
-
-        # Check retrograde similarity (reversed sequence)
-        reversed_sequence = pitch_sequence[::-1]
-        retrograde_measures = []
-        retrograde_matches = 0
-        for i in range(len(pitch_sequence)):
-            if pitch_sequence[i] == reversed_sequence[i]:
-                retrograde_matches += 1
-                measure_num = notes_list[i].measureNumber
-                if measure_num and measure_num not in retrograde_measures:
-                    retrograde_measures.append(measure_num)
-        symmetry_data['retrograde_score'] = round((retrograde_matches / len(pitch_sequence)) * 100, 2)
-        symmetry_data['retrograde_measures'] = sorted(retrograde_measures)
-
-        # Check inversion similarity
-        inverted_sequence = [(12 - p) % 12 for p in pitch_sequence]
-        inversion_measures = []
-        inversion_matches = 0
-        for i in range(len(pitch_sequence)):
-            if pitch_sequence[i] == inverted_sequence[i]:
-                inversion_matches += 1
-                measure_num = notes_list[i].measureNumber
-                if measure_num and measure_num not in inversion_measures:
-                    inversion_measures.append(measure_num)
-        symmetry_data['inversion_score'] = round((inversion_matches / len(pitch_sequence)) * 100, 2)
-        symmetry_data['inversion_measures'] = sorted(inversion_measures)
-
-        return {
-            'symmetry': symmetry_data,
-            'part_name': part_name,
-            'summary': f'{part_name} - Retrograde: {symmetry_data["retrograde_score"]}%, Inversion: {symmetry_data["inversion_score"]}%'
-        }
-    except Exception as e:
-        return {'error': f'Symmetry analysis failed: {str(e)}', 'symmetry': {}}
-
-def analyze_symmetry_music21(score, part_index=0):
+def analyze_symmetry_music21(score, table, part_index=0, segment_length=SYMMETRY_SEGMENT_LENGTH):
     """Analyze musical symmetry patterns using music21 native methods"""
     try:
         from music21 import serial
@@ -1685,62 +5272,50 @@ def analyze_symmetry_music21(score, part_index=0):
             'method': 'music21'
         }
 
-        if not score.parts:
+        if table.num_parts == 0:
             return {'error': 'No parts found', 'symmetry': symmetry_data}
 
-        if part_index >= len(score.parts):
+        if part_index >= table.num_parts:
             return {'error': f'Part index {part_index} out of range', 'symmetry': symmetry_data}
 
-        target_part = score.parts[part_index]
-        part_name = target_part.partName or f"Part {part_index + 1}"
-        notes_list = [n for n in target_part.recurse().notes if isinstance(n, note.Note)]
+        part_name = table.part_names[part_index] or f"Part {part_index + 1}"
+        rows = table.single_note_rows(part_index)
 
-        if len(notes_list) < 4:
+        if len(rows) < 4:
             return {'symmetry': symmetry_data, 'part_name': part_name, 'summary': f'{part_name}: Too short for symmetry analysis'}
 
-        pitch_sequence = [n.pitch.pitchClass for n in notes_list]
-
-        row_length = min(12, len(pitch_sequence))
-        original_series = serial.pcToToneRow(pitch_sequence[:row_length])
-
-        retrograde_series = original_series.zeroCenteredTransformation('R', 0)
-        retrograde_pitches = retrograde_series.pitchClasses()
-        retrograde_measures = []
-        retrograde_matches = 0
-        for i in range(len(pitch_sequence)):
-            if pitch_sequence[i] == retrograde_pitches[i % len(retrograde_pitches)]:
-                retrograde_matches += 1
-                measure_num = notes_list[i].measureNumber
-                if measure_num and measure_num not in retrograde_measures:
-                    retrograde_measures.append(measure_num)
-        symmetry_data['retrograde_score'] = round((retrograde_matches / len(pitch_sequence)) * 100, 2)
-        symmetry_data['retrograde_measures'] = sorted(retrograde_measures)
-
-        inversion_series = original_series.zeroCenteredTransformation('I', 0)
-        inversion_pitches = inversion_series.pitchClasses()
-        inversion_measures = []
-        inversion_matches = 0
-        for i in range(len(pitch_sequence)):
-            if pitch_sequence[i] == inversion_pitches[i % len(inversion_pitches)]:
-                inversion_matches += 1
-                measure_num = notes_list[i].measureNumber
-                if measure_num and measure_num not in inversion_measures:
-                    inversion_measures.append(measure_num)
-        symmetry_data['inversion_score'] = round((inversion_matches / len(pitch_sequence)) * 100, 2)
-        symmetry_data['inversion_measures'] = sorted(inversion_measures)
-
-        retrograde_inversion_series = original_series.zeroCenteredTransformation('RI', 0)
-        ri_pitches = retrograde_inversion_series.pitchClasses()
-        ri_measures = []
-        ri_matches = 0
-        for i in range(len(pitch_sequence)):
-            if pitch_sequence[i] == ri_pitches[i % len(ri_pitches)]:
-                ri_matches += 1
-                measure_num = notes_list[i].measureNumber
-                if measure_num and measure_num not in ri_measures:
-                    ri_measures.append(measure_num)
-        symmetry_data['retrograde_inversion_score'] = round((ri_matches / len(pitch_sequence)) * 100, 2)
-        symmetry_data['ri_measures'] = sorted(ri_measures)
+        pitch_sequence = table.pc[rows].astype(np.int64)
+        measures = table.measure_numbers[table.measure[rows]]
+        positions = np.arange(len(pitch_sequence))
+
+        # Row: the score's main tone row if it has complete aggregates, else the first notes
+        row_forms = find_row_forms(table)
+        if row_forms['prime_row'] is not None:
+            row_pitches = row_forms['prime_row']
+        else:
+            row_pitches = pitch_sequence[:min(12, len(pitch_sequence))].tolist()
+        original_series = serial.pcToToneRow(row_pitches)
+        part_segments = [segment for segment in row_forms['segments'] if segment['part_index'] == part_index]
+        symmetry_data['tone_row'] = {
+            'row': row_pitches,
+            'source': 'aggregates' if row_forms['prime_row'] is not None else 'first_notes',
+            'row_forms': part_segments,
+            'timeline': row_form_timeline(table, part_segments)
+        }
+
+        # Compare the whole sequence, cyclically, with each form of the row
+        for transformation, score_name, measures_name in (('R', 'retrograde_score', 'retrograde_measures'),
+                                                          ('I', 'inversion_score', 'inversion_measures'),
+                                                          ('RI', 'retrograde_inversion_score', 'ri_measures')):
+            form = np.array(original_series.zeroCenteredTransformation(transformation, 0).pitchClasses())
+            matches = pitch_sequence == form[positions % len(form)]
+            symmetry_data[score_name] = round(matches.mean() * 100, 2)
+            symmetry_data[measures_name] = symmetry_measures(measures, matches)
+
+        # All transpositions/axes and symmetric segments over the whole part
+        profiles = symmetry_profiles(pitch_sequence)
+        symmetry_data['all_transformations'] = {name: np.round(values, 2).tolist() for name, values in profiles.items()}
+        symmetry_data['segments'] = best_symmetry_segments(pitch_sequence, measures, segment_length)
 
         return {
             'symmetry': symmetry_data,
@@ -1750,41 +5325,90 @@ def analyze_symmetry_music21(score, part_index=0):
     except Exception as e:
         return {'error': f'Music21 symmetry analysis failed: {str(e)}', 'symmetry': {}}
 
-def analyze_complete_statistics(score):
-    """Complete statistical summary of the score"""
+def analyze_twelve_tone(score, table):
+    """Detect the tone row and the row forms (P/I/R/RI) used in every part"""
+    try:
+        row_forms = find_row_forms(table)
+        if row_forms['prime_row'] is None:
+            return {
+                'tone_row': None,
+                'row_forms': [],
+                'timeline': [],
+                'aggregate_count': 0,
+                'summary': 'No complete twelve-tone aggregates found'
+            }
+
+        row_names = [pitch.Pitch(pc).name for pc in row_forms['prime_row']]
+        return {
+            'tone_row': row_forms['prime_row'],
+            'tone_row_names': row_names,
+            'row_forms': row_forms['segments'],
+            'timeline': row_form_timeline(table, row_forms['segments']),
+            'aggregate_count': row_forms['aggregate_count'],
+            'summary': f'P0 = {" ".join(row_names)}: {len(row_forms["segments"])} row forms in {row_forms["aggregate_count"]} aggregates'
+        }
+    except Exception as e:
+        return {'error': f'Twelve-tone analysis failed: {str(e)}', 'row_forms': []}
+
+def analyze_complete_statistics(score, table, parts=None, start_measure=None, end_measure=None):
+    """Statistical summary of any part subset and measure range, from prefix-sum histograms"""
     try:
+        parts = list(range(table.num_parts)) if parts is None else sorted(set(parts))
+        start = (start_measure or 1) - 1
+        end = min(end_measure or table.num_measures, table.num_measures)
+
         stats = {
             'total_notes': 0,
-            'unique_pitches': set(),
+            'unique_pitches': 0,
             'average_duration': 0,
-            'total_measures': 0,
-            'parts_count': len(score.parts),
+            'total_measures': max(end - start, 0),
+            'parts_count': len(parts),
             'average_notes_per_measure': 0,
-            'pitch_distribution': {}
+            'pitch_distribution': {},
+            'parts': [table.part_names[p] or f'Part {p + 1}' for p in parts],
+            'measure_range': [start + 1, end]
         }
+        if not parts or end <= start:
+            return {'statistics': stats, 'summary': 'No notes in the selected parts and measures'}
 
-        total_duration = 0
+        histograms = table.get_histograms()
+        totals = histograms.query(parts, start, end)
+        pc_counts, pc_duration = totals['pc'], totals['pc_duration']
 
-        for part in score.parts:
-            notes_list = [n for n in part.recurse().notes if isinstance(n, note.Note)]
+        stats['total_notes'] = int(pc_counts.sum())
+        stats['unique_pitches'] = int(np.count_nonzero(pc_counts))
+        total_duration = float(pc_duration.sum())
 
-            for n in notes_list:
-                stats['total_notes'] += 1
-                stats['unique_pitches'].add(n.pitch.pitchClass)
-                total_duration += n.quarterLength
-
-                pitch_name = n.pitch.name
-                stats['pitch_distribution'][pitch_name] = stats['pitch_distribution'].get(pitch_name, 0) + 1
-
-        stats['unique_pitches'] = len(stats['unique_pitches'])
-
-        if score.parts and score.parts[0].getElementsByClass('Measure'):
-            stats['total_measures'] = len(score.parts[0].getElementsByClass('Measure'))
+        spelled = np.flatnonzero(totals['spelling'])
+        stats['pitch_distribution'] = {
+            STEP_NAMES[b // SPELLING_ALTERS] + ACCIDENTAL_MODIFIERS[float(b % SPELLING_ALTERS - 2)]: int(totals['spelling'][b])
+            for b in spelled.tolist()
+        }
 
         if stats['total_notes'] > 0:
             stats['average_duration'] = round(total_duration / stats['total_notes'], 2)
-            if stats['total_measures'] > 0:
-                stats['average_notes_per_measure'] = round(stats['total_notes'] / stats['total_measures'], 2)
+            stats['average_notes_per_measure'] = round(stats['total_notes'] / stats['total_measures'], 2)
+
+            pitches = np.flatnonzero(totals['pitch'])
+            lowest, highest = int(pitches[0]) + histograms.pitch_base, int(pitches[-1]) + histograms.pitch_base
+            stats['pitch_range'] = {
+                'lowest': pitch.Pitch(midi=lowest).nameWithOctave,
+                'highest': pitch.Pitch(midi=highest).nameWithOctave,
+                'semitones': highest - lowest
+            }
+
+        # Distribuições de pitch classes (contagem e pesada pela duração) e entropia
+        stats['pitch_class_histogram'] = pc_counts.tolist()
+        stats['pitch_class_duration'] = [round(float(d), 3) for d in pc_duration]
+        stats['pitch_class_entropy'] = round(histogram_entropy(pc_counts), 4)
+        stats['pitch_class_duration_entropy'] = round(histogram_entropy(pc_duration), 4)
+        stats['duration_distribution'] = {
+            name: int(count) for name, count in zip(RHYTHM_VALUE_NAMES, totals['duration_class']) if count
+        }
+        stats['interval_distribution'] = {
+            str(b - INTERVAL_HISTOGRAM_LIMIT): int(totals['interval'][b])
+            for b in np.flatnonzero(totals['interval']).tolist()
+        }
 
         return {
             'statistics': stats,
@@ -1811,60 +5435,55 @@ def get_instrument_musicxml():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'Invalid file path'}), 400
 
-        # Load score
-        score = converter.parse(file_path)
-
-        # Get all parts
-        parts = score.parts
-        if instrument_index >= len(parts):
+        # Indices follow music21's numbering (one per PartStaff), the same in the
+        # lazy part loader and the full score, so excerpts can be cached by index
+        if not isinstance(instrument_index, int) or not 0 <= instrument_index < get_part_count(file_path):
             return jsonify({'error': f'Instrument index {instrument_index} out of range'}), 400
 
-        # Extract specific part
-        part = parts[instrument_index]
+        def build():
+            # Extract specific part (from the cached score, or parsing only this part).
+            # The part is shared by all requests: only copies of its objects go into
+            # new streams (the exporter itself works on a copy)
+            part = get_part_score(file_path, instrument_index)
+            export_part = part
 
-        # Filter by measure range if specified
-        if end_measure:
-            # Create a new stream with only selected measures
-            new_part = stream.Part()
-            new_part.id = part.id
-            new_part.partName = part.partName
+            # Filter by measure range if specified
+            if end_measure:
+                # Create a new stream with only selected measures
+                new_part = stream.Part()
+                new_part.id = part.id
+                new_part.partName = part.partName
 
-            # Copy metadata
-            for elem in part.flatten():
-                if isinstance(elem, (clef.Clef, key.KeySignature, meter.TimeSignature)):
-                    new_part.insert(0, elem)
-                    break
+                # Copy metadata
+                first_attribute = part.recurse().getElementsByClass((clef.Clef, key.KeySignature, meter.TimeSignature)).first()
+                if first_attribute is not None:
+                    new_part.insert(0, copy.deepcopy(first_attribute))
 
-            # Extract measures in range
-            measures = part.getElementsByClass('Measure')
-            for m in measures:
-                if hasattr(m, 'number') and start_measure <= m.number <= end_measure:
-                    new_part.append(m)
+                # Extract measures in range
+                measures = part.getElementsByClass('Measure')
+                for m in measures:
+                    if hasattr(m, 'number') and start_measure <= m.number <= end_measure:
+                        new_part.append(copy.deepcopy(m))
 
-            part = new_part
+                export_part = new_part
 
-        # Export to MusicXML string
-        # Create temporary file, write MusicXML, read it back, then delete
-        temp_xml = tempfile.NamedTemporaryFile(mode='w', suffix='.musicxml', delete=False, encoding='utf-8')
-        temp_xml_path = temp_xml.name
-        temp_xml.close()
+            # Export to MusicXML string (in memory)
+            return {
+                'musicxml': export_musicxml(export_part),
+                'instrument_name': export_part.partName or f'Instrument {instrument_index}'
+            }
 
-        try:
-            part.write('musicxml', fp=temp_xml_path)
-            with open(temp_xml_path, 'r', encoding='utf-8') as f:
-                musicxml_string = f.read()
-            os.remove(temp_xml_path)
-        except Exception as e:
-            if os.path.exists(temp_xml_path):
-                os.remove(temp_xml_path)
-            raise e
+        measure_range = (start_measure, end_measure) if end_measure else None
+        excerpt = get_musicxml_excerpt(file_path, 'instrument', [instrument_index], measure_range, build)
 
         return jsonify({
-            'musicxml': musicxml_string,
-            'instrument_name': part.partName or f'Instrument {instrument_index}',
+            'musicxml': excerpt['musicxml'],
+            'instrument_name': excerpt['instrument_name'],
             'measures': f'{start_measure}-{end_measure or "end"}'
         })
 
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error exporting MusicXML: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -1890,73 +5509,66 @@ def get_combined_musicxml():
         if not instrument_indices or len(instrument_indices) == 0:
             return jsonify({'error': 'No instruments selected'}), 400
 
-        # Load score
-        score = converter.parse(file_path)
-
-        # Get all parts
-        all_parts = score.parts
-
-        # Validate instrument indices
+        # Validate instrument indices (music21 numbering, one per PartStaff)
+        num_parts = get_part_count(file_path)
         for idx in instrument_indices:
-            if idx >= len(all_parts):
+            if not isinstance(idx, int) or not 0 <= idx < num_parts:
                 return jsonify({'error': f'Instrument index {idx} out of range'}), 400
 
-        # Create a new score with selected instruments
-        combined_score = stream.Score()
-
-        # Copy metadata from original score
-        for elem in score.flatten():
-            if isinstance(elem, (meter.TimeSignature, key.KeySignature)):
-                combined_score.insert(0, elem)
-                break
-
-        # Add each selected instrument
-        instrument_names = []
-        for idx in instrument_indices:
-            part = all_parts[idx]
-            instrument_names.append(part.partName or f'Instrument {idx}')
-
-            # Filter by measure range if specified
-            if end_measure:
-                # Create a new part with only selected measures
-                new_part = stream.Part()
-                new_part.id = part.id
-                new_part.partName = part.partName
-
-                # Copy clef, key signature, time signature
-                for elem in part.flatten():
-                    if isinstance(elem, (clef.Clef, key.KeySignature, meter.TimeSignature)):
-                        new_part.insert(0, elem)
-                        break
-
-                # Extract measures in range
-                measures = part.getElementsByClass('Measure')
-                for m in measures:
-                    if hasattr(m, 'number') and start_measure <= m.number <= end_measure:
-                        new_part.append(m)
-
-                combined_score.insert(0, new_part)
-            else:
-                combined_score.insert(0, part)
+        def build():
+            # Load score (shared cache) and get all parts. The score is shared by
+            # all requests: only copies of its objects go into the new score
+            score = get_cached_score(file_path)
+            all_parts = score.parts
+
+            # Create a new score with selected instruments
+            combined_score = stream.Score()
+
+            # Copy metadata from original score
+            first_signature = score.recurse().getElementsByClass((meter.TimeSignature, key.KeySignature)).first()
+            if first_signature is not None:
+                combined_score.insert(0, copy.deepcopy(first_signature))
+
+            # Add each selected instrument
+            instrument_names = []
+            for idx in instrument_indices:
+                part = all_parts[idx]
+                instrument_names.append(part.partName or f'Instrument {idx}')
+
+                # Filter by measure range if specified
+                if end_measure:
+                    # Create a new part with only selected measures
+                    new_part = stream.Part()
+                    new_part.id = part.id
+                    new_part.partName = part.partName
+
+                    # Copy clef, key signature, time signature
+                    first_attribute = part.recurse().getElementsByClass((clef.Clef, key.KeySignature, meter.TimeSignature)).first()
+                    if first_attribute is not None:
+                        new_part.insert(0, copy.deepcopy(first_attribute))
+
+                    # Extract measures in range
+                    measures = part.getElementsByClass('Measure')
+                    for m in measures:
+                        if hasattr(m, 'number') and start_measure <= m.number <= end_measure:
+                            new_part.append(copy.deepcopy(m))
+
+                    combined_score.insert(0, new_part)
+                else:
+                    combined_score.insert(0, copy.deepcopy(part))
 
-        # Export to MusicXML string
-        temp_xml = tempfile.NamedTemporaryFile(mode='w', suffix='.musicxml', delete=False, encoding='utf-8')
-        temp_xml_path = temp_xml.name
-        temp_xml.close()
+            # Export to MusicXML string (in memory)
+            return {
+                'musicxml': export_musicxml(combined_score),
+                'instrument_names': instrument_names
+            }
 
-        try:
-            combined_score.write('musicxml', fp=temp_xml_path)
-            with open(temp_xml_path, 'r', encoding='utf-8') as f:
-                musicxml_string = f.read()
-            os.remove(temp_xml_path)
-        except Exception as e:
-            if os.path.exists(temp_xml_path):
-                os.remove(temp_xml_path)
-            raise e
+        measure_range = (start_measure, end_measure) if end_measure else None
+        excerpt = get_musicxml_excerpt(file_path, 'combined', instrument_indices, measure_range, build)
 
         return jsonify({
-            'musicxml': musicxml_string,
-            'instrument_names': instrument_names,
+            'musicxml': excerpt['musicxml'],
+            'instrument_names': excerpt['instrument_names'],
             'instrument_count': len(instrument_indices),
             'measures': f'{start_measure}-{end_measure or "end"}'
         })
@@ -1967,4 +5579,6 @@ def get_combined_musicxml():
 
 
 if __name__ == '__main__':
+    # Pré-carregar em background os scores usados mais recentemente
+    Thread(target=prewarm_score_cache, daemon=True).start()
     app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""
+Benchmark do cache de scores: latência de cache hits com N misses em curso.
+
+Gera N+1 cópias de uma peça do corpus do music21 (cada uma com um comentário
+diferente, logo com um SHA-256 diferente), aquece uma delas e mede a latência
+de get_cached_score() para essa cópia enquanto as outras N são parseadas em
+threads paralelas.
+
+Uso:
+    python benchmarks/bench_score_cache.py [--misses 8] [--piece bach/bwv66.6]
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from music21 import corpus  # noqa: E402
+
+import app as mial  # noqa: E402
+
+
+def make_copies(piece, count, target_dir):
+    score = corpus.parse(piece)
+    source_path = str(score.write('musicxml', fp=os.path.join(target_dir, 'source.musicxml')))
+    with open(source_path, 'rb') as f:
+        content = f.read()
+
+    paths = []
+    for i in range(count):
+        path = os.path.join(target_dir, f'copy_{i}.musicxml')
+        with open(path, 'wb') as f:
+            f.write(content + f'\n<!-- bench copy {i} -->\n'.encode('utf-8'))
+        paths.append(path)
+    return paths
+
+
+def measure_hits(file_path, stop_condition, min_samples=200):
+    samples = []
+    while len(samples) < min_samples or not stop_condition():
+        start = time.perf_counter()
+        mial.get_cached_score(file_path)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(0, int(len(ordered) * fraction) - 1)]
+
+
+def describe(samples):
+    return (f"n={len(samples)} p50={statistics.median(samples):.3f}ms "
+            f"p95={percentile(samples, 0.95):.3f}ms p99={percentile(samples, 0.99):.3f}ms "
+            f"max={max(samples):.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--misses', type=int, default=8, help='Número de parses concorrentes (misses)')
+    parser.add_argument('--piece', default='bach/bwv66.6', help='Peça do corpus do music21')
+    args = parser.parse_args()
+
+    # Os logs [CACHE HIT] de cada pedido distorcem a medição
+    with tempfile.TemporaryDirectory() as target_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        paths = make_copies(args.piece, args.misses + 1, target_dir)
+        hot_path, miss_paths = paths[0], paths[1:]
+
+        # Aquecer o score usado para os hits
+        mial.get_cached_score(hot_path)
+
+        idle = measure_hits(hot_path, lambda: True)
+
+        parse_times = []
+        def parse_miss(path):
+            start = time.perf_counter()
+            mial.get_cached_score(path)
+            parse_times.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=parse_miss, args=(p,)) for p in miss_paths]
+        misses_start = time.perf_counter()
+        for t in threads:
+            t.start()
+        busy = measure_hits(hot_path, lambda: not any(t.is_alive() for t in threads), min_samples=1)
+        misses_wall = time.perf_counter() - misses_start
+        for t in threads:
+            t.join()
+
+    mean_parse_ms = statistics.mean(parse_times) * 1000
+    print(f"Piece: {args.piece}  |  concurrent misses: {args.misses}")
+    print(f"Misses: wall={misses_wall:.2f}s mean parse={mean_parse_ms:.0f}ms")
+    print(f"Hits (idle):           {describe(idle)}")
+    print(f"Hits (misses running): {describe(busy)}")
+
+    # Com o lock global antigo um hit esperava por um parse inteiro; o máximo
+    # isolado reflete apenas a troca do GIL entre threads.
+    flat = percentile(busy, 0.99) < mean_parse_ms * 0.1
+    print(f"Result: {'FLAT' if flat else 'BLOCKED'} (p99 hit latency vs 10% of mean parse time)")
+    return 0 if flat else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Verificação das sonoridades (SonorityTable) contra o chordify() do music21.
+
+Para cada peça do corpus (sem notas de ornamento), verifica que cada
+sonoridade da NoteTable começa num acorde do chordify() com as mesmas
+notas. Por omissão inclui peças com tercinas, em que somar offset +
+duration em float deixava o fim de uma nota 1 ulp antes do onset seguinte
+e criava sonoridades de largura zero.
+
+Uso:
+    python benchmarks/check_sonorities.py [--piece mozart/k80/movement1 ...]
+"""
+import argparse
+import bisect
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from music21 import corpus  # noqa: E402
+
+import app as mial  # noqa: E402
+
+DEFAULT_PIECES = ['mozart/k80/movement1', 'bach/bwv66.6', 'beethoven/opus18no1/movement1']
+
+
+def chordify_sonorities(score):
+    """(início, notas) de cada acorde do chordify(), sem notas repetidas."""
+    chords = score.chordify().flatten().getElementsByClass('Chord')
+    return [
+        (float(c.offset), sorted({p.nameWithOctave for p in c.pitches}))
+        for c in chords
+    ]
+
+
+def table_sonorities(score):
+    """(início, notas) de cada sonoridade da NoteTable."""
+    sonorities = mial.NoteTable.from_score(score).get_sonorities()
+    return [
+        (float(sonorities.start[i]), sorted(set(sonorities.pitch_names(i))))
+        for i in range(len(sonorities))
+    ]
+
+
+def remove_grace_notes(score):
+    """Remove as notas de ornamento (duração zero, que a SonorityTable ignora)."""
+    for grace in [n for n in score.recurse().notes if n.duration.isGrace]:
+        grace.activeSite.remove(grace)
+
+
+def check(piece):
+    score = corpus.parse(piece)
+    remove_grace_notes(score)
+    expected = chordify_sonorities(score)
+    actual = table_sonorities(score)
+
+    # O chordify() também corta em pausas de outras partes, pelo que pode ter
+    # mais acordes; cada sonoridade tem de começar num acorde do chordify()
+    # com as mesmas notas
+    expected_starts = [start for start, _ in expected]
+    problems = []
+    for i, (start, pitches) in enumerate(actual):
+        j = bisect.bisect_left(expected_starts, start - 1e-9)
+        if j == len(expected) or abs(expected_starts[j] - start) > 1e-9:
+            problems.append(f"#{i} at {start!r} {pitches}: no chordify chord starts there")
+        elif expected[j][1] != pitches:
+            problems.append(f"#{i} at {start!r}: {pitches} vs chordify {expected[j][1]}")
+
+    status = 'OK' if not problems else 'FAIL'
+    print(f"{status} {piece}: {len(actual)} sonorities, {len(expected)} chordify chords")
+    for problem in problems[:5]:
+        print(f"    {problem}")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--piece', action='append', help='Peça do corpus (pode repetir)')
+    args = parser.parse_args()
+
+    results = [check(piece) for piece in args.piece or DEFAULT_PIECES]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 let currentFilePath = null;
 let analysisData = null;
 let currentSymmetryPartIndex = 0;
+// Identifies this tab to the server, so a new upload only cancels this tab's pre-analysis
+const clientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
 
 const fileInput = document.getElementById('musicxml-file');
 const fileName = document.getElementById('file-name');
@@ -244,6 +246,7 @@ async function handleFileUpload(event) {
 
     const formData = new FormData();
     formData.append('file', file);
+    formData.append('client_id', clientId);
 
     try {
         showLoading(true);
@@ -286,7 +289,7 @@ async function handleFileUpload(event) {
 
 function displayScoreInfo(data) {
     document.getElementById('score-title').textContent = data.title;
-    document.getElementById('score-key').textContent = data.overall_key;
+    document.getElementById('score-key').textContent = data.overall_key || 'Analyzing...';
     document.getElementById('score-measures').textContent = data.total_measures;
     document.getElementById('score-instruments').textContent = data.total_instruments;
 }
@@ -3550,7 +3553,8 @@ async function selectAdvancedAnalysis(analysisType) {
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
                 file_path: currentFilePath,
-                analysis_type: analysisType
+                analysis_type: analysisType,
+                ...(analysisType === 'dissonance' ? { include_events: true, page_size: DISSONANCE_EVENTS_PAGE_SIZE } : {})
             })
         });
 
@@ -3579,6 +3583,7 @@ function renderAdvancedAnalysisResult(analysisType, data) {
         'chromatic_analysis': '🎹 Chromaticism',
         'symmetry': '↔️ Symmetry Analysis',
         'symmetry_music21': '🎼 Symmetry (Music21)',
+        'twelve_tone': '🔢 Twelve-Tone Rows',
         'statistics': '📈 Statistics'
     };
 
@@ -3606,6 +3611,8 @@ function renderAdvancedAnalysisResult(analysisType, data) {
         html = renderSymmetryAdvanced(data);
     } else if (analysisType === 'symmetry_music21') {
         html = renderSymmetryAdvanced(data);
+    } else if (analysisType === 'twelve_tone') {
+        html = renderTwelveTone(data);
     } else if (analysisType === 'statistics') {
         html = renderStatisticsAdvanced(data);
     } else {
@@ -3628,13 +3635,15 @@ function renderCadencesAdvanced(data) {
     let html = `<div class="analysis-result">
         <p style="margin-bottom: 20px; color: #4d9eff;"><strong>${data.summary}</strong></p>
         <table class="statistics-table">
-            <thead><tr><th>Measure</th><th>Type</th><th>Strength</th><th>Instrument</th></tr></thead>
+            <thead><tr><th>Measure</th><th>Type</th><th>Progression</th><th>Key</th><th>Strength</th><th>Instrument</th></tr></thead>
             <tbody>`;
 
     data.cadences.forEach(cadence => {
         html += `<tr>
             <td>M. ${cadence.measure}</td>
             <td>${cadence.type}</td>
+            <td>${cadence.progression || '-'}</td>
+            <td>${cadence.key || '-'}</td>
             <td>${(cadence.strength * 100).toFixed(0)}%</td>
             <td>${cadence.instrument}</td>
         </tr>`;
@@ -3675,6 +3684,36 @@ function renderModulation(data) {
     return html;
 }
 
+function renderTwelveTone(data) {
+    if (data.error) {
+        return `<div style="padding: 20px; color: #ff6b6b;">${data.error}</div>`;
+    }
+
+    let html = `<div class="analysis-result">
+        <p style="margin-bottom: 20px; color: #4d9eff;"><strong>${data.summary}</strong></p>`;
+
+    if (data.timeline && data.timeline.length > 0) {
+        html += `<table class="statistics-table">
+            <thead><tr><th>Measure</th><th>Row Forms</th></tr></thead>
+            <tbody>`;
+
+        data.timeline.forEach(entry => {
+            const forms = entry.forms.map(f => `${f.form} (${f.part})`).join(', ');
+            html += `<tr>
+                <td>${entry.measure}</td>
+                <td>${forms}</td>
+            </tr>`;
+        });
+
+        html += `</tbody></table>`;
+    } else {
+        html += `<p style="color: #999;">No row forms detected.</p>`;
+    }
+
+    html += `</div>`;
+    return html;
+}
+
 function renderVoiceLeading(data) {
     if (data.error) {
         return `<div style="padding: 20px; color: #ff6b6b;">${data.error}</div>`;
@@ -3702,10 +3741,101 @@ function renderVoiceLeading(data) {
         html += `</tbody></table>`;
     }
 
+    if (data.issue_counts) {
+        html += `<h4 style="margin-top: 15px;">Voice-Leading Issues:</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Issue</th><th>Count</th></tr></thead>
+            <tbody>`;
+
+        Object.entries(data.issue_counts).forEach(([issue, count]) => {
+            html += `<tr><td>${issue}</td><td>${count}</td></tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
+    if (data.issues && data.issues.length > 0) {
+        html += `<h4 style="margin-top: 15px;">Locations (first ${Math.min(data.issues.length, 50)} of ${data.total_issues}):</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Measure</th><th>Issue</th><th>Voices</th><th>Pitches</th></tr></thead>
+            <tbody>`;
+
+        data.issues.slice(0, 50).forEach(issue => {
+            html += `<tr>
+                <td>M. ${issue.measure}</td>
+                <td>${issue.type}</td>
+                <td>${issue.voices.join(' / ')}</td>
+                <td>${issue.pitches.join(' / ')}</td>
+            </tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
     html += `</div>`;
     return html;
 }
 
+const DISSONANCE_EVENTS_PAGE_SIZE = 20;
+const INTERVAL_CLASS_NAMES = ['P1/P8', 'm2', 'M2', 'm3', 'M3', 'P4', 'TT', 'P5', 'm6', 'M6', 'm7', 'M7'];
+
+async function loadDissonancePage(page) {
+    const container = document.getElementById('dissonance-events');
+    if (!container) return;
+    container.innerHTML = '<div class="spinner" style="margin: 20px auto;"></div>';
+
+    try {
+        const response = await fetch('/api/advanced-analysis', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                file_path: currentFilePath,
+                analysis_type: 'dissonance',
+                include_events: true,
+                page: page,
+                page_size: DISSONANCE_EVENTS_PAGE_SIZE
+            })
+        });
+
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+        container.innerHTML = renderDissonanceEvents(data);
+    } catch (error) {
+        console.error('Error loading dissonance events:', error);
+        container.innerHTML = `<div style="color: #ff6b6b; padding: 20px;">Error: ${error.message}</div>`;
+    }
+}
+
+function renderDissonanceEvents(data) {
+    const events = (data.dissonance || {}).dissonant_intervals || [];
+    const pageInfo = data.events_page;
+    if (!pageInfo || events.length === 0) {
+        return '';
+    }
+
+    let html = `<h4 style="margin-top: 15px;">Dissonant Intervals (page ${pageInfo.page} of ${pageInfo.total_pages}, ${pageInfo.total_events} total):</h4>
+        <table class="statistics-table">
+        <thead><tr><th>Measure</th><th>From</th><th>To</th><th>Interval</th><th>Voices</th></tr></thead>
+        <tbody>`;
+
+    events.forEach(interval => {
+        html += `<tr>
+            <td>M. ${interval.measure}</td>
+            <td>${interval.from}</td>
+            <td>${interval.to}</td>
+            <td>${interval.interval}</td>
+            <td>${interval.instrument} / ${interval.other_instrument}</td>
+        </tr>`;
+    });
+
+    html += `</tbody></table>
+        <div style="margin-top: 10px; display: flex; gap: 10px; align-items: center;">
+            <button class="nav-btn" ${pageInfo.page <= 1 ? 'disabled' : ''} onclick="loadDissonancePage(${pageInfo.page - 1})">Previous</button>
+            <button class="nav-btn" ${pageInfo.page >= pageInfo.total_pages ? 'disabled' : ''} onclick="loadDissonancePage(${pageInfo.page + 1})">Next</button>
+        </div>`;
+    return html;
+}
+
 function renderDissonance(data) {
     if (data.error) {
         return `<div style="padding: 20px; color: #ff6b6b;">${data.error}</div>`;
@@ -3717,24 +3847,33 @@ function renderDissonance(data) {
         <p><strong>Dissonance Ratio:</strong> ${diss.dissonance_percentage}%</p>
         <p><strong>Total Intervals Analyzed:</strong> ${data.total_intervals_analyzed}</p>`;
 
-    if (diss.dissonant_intervals && diss.dissonant_intervals.length > 0 && diss.dissonant_intervals.length <= 20) {
-        html += `<h4 style="margin-top: 15px;">Sample Dissonant Intervals (first 20):</h4>
+    if (diss.interval_histogram) {
+        html += `<h4 style="margin-top: 15px;">Harmonic Intervals:</h4>
             <table class="statistics-table">
-            <thead><tr><th>From</th><th>To</th><th>Interval</th><th>Voice</th></tr></thead>
+            <thead><tr>${INTERVAL_CLASS_NAMES.map(name => `<th>${name}</th>`).join('')}</tr></thead>
+            <tbody><tr>${diss.interval_histogram.map(count => `<td>${count}</td>`).join('')}</tr></tbody>
+            </table>`;
+    }
+
+    if (diss.part_pairs && diss.part_pairs.length > 0) {
+        const pairs = [...diss.part_pairs].sort((a, b) => b.dissonance_percentage - a.dissonance_percentage).slice(0, 10);
+        html += `<h4 style="margin-top: 15px;">Most Dissonant Voice Pairs:</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Voices</th><th>Intervals</th><th>Dissonance</th></tr></thead>
             <tbody>`;
 
-        diss.dissonant_intervals.slice(0, 20).forEach(interval => {
+        pairs.forEach(pair => {
             html += `<tr>
-                <td>${interval.from}</td>
-                <td>${interval.to}</td>
-                <td>${interval.interval}</td>
-                <td>${interval.instrument}</td>
+                <td>${pair.parts[0]} / ${pair.parts[1]}</td>
+                <td>${pair.total}</td>
+                <td>${pair.dissonance_percentage}%</td>
             </tr>`;
         });
 
         html += `</tbody></table>`;
     }
 
+    html += `<div id="dissonance-events">${renderDissonanceEvents(data)}</div>`;
     html += `</div>`;
     return html;
 }
@@ -3789,15 +3928,17 @@ function renderPhraseStructure(data) {
 
     if (data.phrases && data.phrases.length > 0) {
         html += `<table class="statistics-table">
-            <thead><tr><th>Voice</th><th>Start</th><th>End</th><th>Length</th></tr></thead>
+            <thead><tr><th>Voice</th><th>Start</th><th>End</th><th>Length</th><th>Boundary</th></tr></thead>
             <tbody>`;
 
         data.phrases.forEach(phrase => {
+            const cues = (phrase.cues || []).map(cue => cue.replace('_', ' ')).join(', ');
             html += `<tr>
                 <td>${phrase.instrument}</td>
                 <td>M. ${phrase.start_measure}</td>
                 <td>M. ${phrase.end_measure}</td>
                 <td>${phrase.length} measures</td>
+                <td>${phrase.boundary_strength !== undefined ? (phrase.boundary_strength * 100).toFixed(0) + '%' : '-'}${cues ? ` (${cues})` : ''}</td>
             </tr>`;
         });
 
@@ -3826,16 +3967,19 @@ function renderTextureAdvanced(data) {
     if (tex.harmonic_rhythm && tex.harmonic_rhythm.length > 0) {
         const sampled = tex.harmonic_rhythm.filter((_, i) => i % 4 === 0).slice(0, 15);
 
-        html += `<h4 style="margin-top: 15px;">Texture Progression (sampled every 4 measures):</h4>
+        html += `<h4 style="margin-top: 15px;">Texture Progression (sampled every 4 ${tex.resolution === 'beat' ? 'beats' : 'measures'}):</h4>
             <table class="statistics-table">
-            <thead><tr><th>Measure</th><th>Note Count</th><th>Density</th></tr></thead>
+            <thead><tr><th>Measure</th><th>Note Count</th><th>Density</th><th>Active Voices</th><th>Span</th><th>Rhythmic Independence</th></tr></thead>
             <tbody>`;
 
         sampled.forEach(item => {
             html += `<tr>
-                <td>M. ${item.measure}</td>
+                <td>M. ${item.measure}${item.beat !== undefined ? `, beat ${item.beat}` : ''}</td>
                 <td>${item.note_count}</td>
                 <td>${item.density}</td>
+                <td>${item.active_voices !== undefined ? item.active_voices : '-'}</td>
+                <td>${item.registral_span !== undefined ? `${item.registral_span} st` : '-'}</td>
+                <td>${item.rhythmic_independence !== undefined ? `${(item.rhythmic_independence * 100).toFixed(0)}%` : '-'}</td>
             </tr>`;
         });
 
@@ -3878,6 +4022,37 @@ function renderChromaticAdvanced(data) {
         html += `</tbody></table>`;
     }
 
+    if (chrom.local_keys && chrom.local_keys.length > 0) {
+        html += `<h4 style="margin-top: 15px;">Local Keys:</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Measures</th><th>Key</th></tr></thead>
+            <tbody>`;
+
+        chrom.local_keys.forEach(span => {
+            html += `<tr><td>M. ${span.start_measure}-${span.end_measure}</td><td>${span.key}</td></tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
+    if (chrom.chromatic_passages && chrom.chromatic_passages.length > 0) {
+        html += `<h4 style="margin-top: 15px;">Chromatic Passages:</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Voice</th><th>Measures</th><th>Notes</th><th>Pitches</th></tr></thead>
+            <tbody>`;
+
+        chrom.chromatic_passages.forEach(passage => {
+            html += `<tr>
+                <td>${passage.instrument}</td>
+                <td>M. ${passage.start_measure}-${passage.end_measure}</td>
+                <td>${passage.chromatic_notes}/${passage.notes}</td>
+                <td>${passage.pitches.join(' ')}${passage.notes > passage.pitches.length ? ' ...' : ''}</td>
+            </tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
     html += `</div>`;
     return html;
 }
@@ -3957,7 +4132,41 @@ function renderSymmetryAdvanced(data) {
     }
 
     html += `
-        </table>
+        </table>`;
+
+    if (sym.tone_row && sym.tone_row.timeline && sym.tone_row.timeline.length > 0) {
+        html += `<table class="statistics-table" style="margin-top: 15px;">
+            <thead><tr><th>Measure</th><th>Row Forms</th></tr></thead>
+            <tbody>`;
+
+        sym.tone_row.timeline.forEach(entry => {
+            html += `<tr>
+                <td>${entry.measure}</td>
+                <td>${entry.forms.map(f => f.form).join(', ')}</td>
+            </tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
+    if (sym.segments && sym.segments.length > 0) {
+        html += `<table class="statistics-table" style="margin-top: 15px;">
+            <thead><tr><th>Operator</th><th>Measures</th><th>Pivot</th><th>Match</th></tr></thead>
+            <tbody>`;
+
+        sym.segments.forEach(seg => {
+            html += `<tr>
+                <td>${seg.operator}</td>
+                <td>${seg.start_measure}–${seg.end_measure}</td>
+                <td>${seg.pivot_measure}</td>
+                <td>${seg.score}%</td>
+            </tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
+
+    html += `
         <p style="margin-top: 15px; font-size: 0.9rem; color: #999;">
             Higher percentages indicate stronger symmetrical patterns in the pitch sequence.
         </p>
@@ -4084,8 +4293,36 @@ function renderStatisticsAdvanced(data) {
             <tr>
                 <td><strong>Average Notes per Measure:</strong></td>
                 <td>${stats.average_notes_per_measure}</td>
-            </tr>
-        </table>`;
+            </tr>`;
+
+    if (stats.pitch_range) {
+        html += `<tr>
+                <td><strong>Range:</strong></td>
+                <td>${stats.pitch_range.lowest} - ${stats.pitch_range.highest} (${stats.pitch_range.semitones} semitones)</td>
+            </tr>`;
+    }
+
+    if (stats.pitch_class_entropy !== undefined) {
+        html += `<tr>
+                <td><strong>Pitch-Class Entropy:</strong></td>
+                <td>${stats.pitch_class_entropy} bits (duration-weighted: ${stats.pitch_class_duration_entropy} bits)</td>
+            </tr>`;
+    }
+
+    html += `</table>`;
+
+    if (stats.duration_distribution && Object.keys(stats.duration_distribution).length > 0) {
+        html += `<h4 style="margin-top: 15px;">Duration Distribution:</h4>
+            <table class="statistics-table">
+            <thead><tr><th>Value</th><th>Count</th></tr></thead>
+            <tbody>`;
+
+        Object.entries(stats.duration_distribution).forEach(([value, count]) => {
+            html += `<tr><td>${value}</td><td>${count}</td></tr>`;
+        });
+
+        html += `</tbody></table>`;
+    }
 
     if (stats.pitch_distribution && Object.keys(stats.pitch_distribution).length > 0) {
         html += `<h4 style="margin-top: 15px;">Pitch Distribution:</h4>
@@ -4337,6 +4574,10 @@ async function detectTonality(filePath) {
 
         const data = await response.json();
 
+        if (data.overall_key) {
+            document.getElementById('score-key').textContent = data.overall_key;
+        }
+
         if (data.tonality_detected) {
             // Store tonality info globally
             window.detectedTonality = {